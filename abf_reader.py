@@ -0,0 +1,199 @@
+import struct
+import numpy as np
+
+BLOCK_SIZE = 512  # ABF2 section positions are given in 512 byte blocks
+EPISODIC_MODE = 5  # nOperationMode of episodic stimulation (fixed-length sweeps)
+
+# Byte positions of section descriptors in the ABF2 header
+PROTOCOL_SECTION = 76
+ADC_SECTION = 92
+STRINGS_SECTION = 220
+DATA_SECTION = 236
+SYNCH_ARRAY_SECTION = 316
+
+
+def first_sample(t_min, sampling_rate):
+    """
+    :param t_min: Start of the time window in seconds, None means start of the sweep
+    :param sampling_rate: Sampling rate in Hz
+    :return: index of the first sample of the window (t_min is rounded to the nearest sample the same way as in mne)
+    """
+    return 0 if t_min is None else max(int(round(t_min * sampling_rate)), 0)
+
+
+def sample_range(t_min, t_max, sampling_rate, n_samples):
+    """
+    Converts time window of the epoch into sample indices the same way as mne does when it selects tmin and tmax
+    (both ends are rounded to the nearest sample and included).
+    :param t_min: Start of the window in seconds, None means start of the sweep
+    :param t_max: End of the window in seconds, None means end of the sweep
+    :param sampling_rate: Sampling rate in Hz
+    :param n_samples: Number of samples in the sweep
+    :return: slice object of the window samples
+    """
+    start = first_sample(t_min, sampling_rate)
+    stop = n_samples if t_max is None else min(int(round(t_max * sampling_rate)) + 1, n_samples)
+    return slice(start, stop)
+
+
+class ABFMemmap:
+    """
+    Reader of episodic ABF2 files which parses only header sections needed for analysis (sampling rate, channels,
+    sweep length, scaling factors and data position) and exposes int16 data section as memory-mapped array, so only
+    the channels and time windows that are read get loaded from disk. Values are scaled the same way as in pyabf.
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: name of the .abf file, for example, '2022_05_12.abf'
+        :raises NotImplementedError: if file is not an episodic ABF2 file with int16 data and fixed-length sweeps
+        """
+        self.filename = filename
+        with open(filename, 'rb') as fb:
+            header = fb.read(BLOCK_SIZE)
+            if header[:4] != b'ABF2':
+                raise NotImplementedError(f"{filename}: only ABF2 files are supported")
+            sweep_count, = struct.unpack_from('<I', header, 12)
+            data_format, = struct.unpack_from('<H', header, 30)
+            if data_format != 0:
+                raise NotImplementedError(f"{filename}: only int16 data is supported")
+
+            protocol = self._section(fb, header, PROTOCOL_SECTION)[0]
+            operation_mode, sequence_interval = struct.unpack_from('<hf', protocol, 0)
+            adc_range, = struct.unpack_from('<f', protocol, 110)
+            adc_resolution, = struct.unpack_from('<i', protocol, 118)
+            if operation_mode != EPISODIC_MODE:
+                raise NotImplementedError(f"{filename}: only episodic recordings are supported")
+
+            strings = self._indexed_strings(self._section(fb, header, STRINGS_SECTION)[0])
+            data_block, point_size, point_count = struct.unpack_from('<IIq', header, DATA_SECTION)
+
+            self.sampling_rate = int(1e6 / sequence_interval)
+            self.sweep_count = max(sweep_count, 1)
+            self.adc_names, self.adc_units, self.gains, self.offsets = [], [], [], []
+            for entry in self._section(fb, header, ADC_SECTION):
+                telegraph_enable, = struct.unpack_from('<h', entry, 2)
+                telegraph_gain, = struct.unpack_from('<f', entry, 6)
+                programmable_gain, = struct.unpack_from('<f', entry, 28)
+                scale_factor, instrument_offset, signal_gain, signal_offset = struct.unpack_from('<ffff', entry, 40)
+                name_index, units_index = struct.unpack_from('<ii', entry, 74)
+                # Same order of operations as in pyabf, so scaled values are identical
+                gain = 1
+                gain /= scale_factor
+                gain /= signal_gain
+                gain /= programmable_gain
+                if telegraph_enable == 1:
+                    gain /= telegraph_gain
+                gain *= adc_range
+                gain /= adc_resolution
+                self.gains.append(gain)
+                self.offsets.append(0 + instrument_offset - signal_offset)
+                self.adc_names.append(strings[name_index] or '?')
+                self.adc_units.append(strings[units_index] or '?')
+
+            self.channel_count = len(self.gains)
+            synch = self._section(fb, header, SYNCH_ARRAY_SECTION)
+            if len({struct.unpack_from('<i', entry, 4)[0] for entry in synch}) > 1:
+                raise NotImplementedError(f"{filename}: sweeps have different lengths")
+            if point_size != 2 or point_count % (self.sweep_count * self.channel_count):
+                raise NotImplementedError(f"{filename}: data section does not match sweeps and channels")
+
+        self.sweep_length = point_count // (self.sweep_count * self.channel_count)  # samples per sweep
+        # In the file samples of all channels are interleaved, so (sweeps, samples, channels) memory map
+        # is transposed into (sweeps, channels, samples) view without copying
+        self.raw = np.memmap(filename, dtype='<i2', mode='r', offset=data_block * BLOCK_SIZE,
+                             shape=(self.sweep_count, self.sweep_length, self.channel_count)).transpose(0, 2, 1)
+
+    @staticmethod
+    def _section(fb, header, position):
+        # Returns list of raw entries (bytes) of the section described at given header position
+        block, entry_size, entry_count = struct.unpack_from('<IIq', header, position)
+        if entry_count <= 0:
+            return []
+        fb.seek(block * BLOCK_SIZE)
+        raw = fb.read(entry_size * entry_count)
+        return [raw[i * entry_size:(i + 1) * entry_size] for i in range(entry_count)]
+
+    @staticmethod
+    def _indexed_strings(raw):
+        # Channel names and units are stored as '\x00' separated strings after the last '\x00\x00'
+        # (the same way as in pyabf, including replacement of 'µ' by 'u')
+        raw = raw[raw.rfind(b'\x00\x00'):].replace(b'\xb5', b'u')
+        return [x.decode('ascii', errors='replace').strip() for x in raw.split(b'\x00')[1:]]
+
+    @property
+    def shape(self):
+        """(sweeps, channels, samples) shape of the recording"""
+        return self.raw.shape
+
+    def read(self, channels=None, t_min=None, t_max=None, sweeps=None):
+        """
+        Reads and scales part of the recording.
+        :param channels: List of channel indices in the file to read, None reads every channel
+        :param t_min: Start of the time window in every sweep (in seconds), None means start of the sweep
+        :param t_max: End of the time window in every sweep (in seconds), None means end of the sweep
+        :param sweeps: slice object of sweeps to read, None reads every sweep
+        :return: float32 array of shape (sweeps, channels, samples) in ADC units (the same values as pyabf gives)
+        """
+        if channels is None:
+            channels = range(self.channel_count)
+        if sweeps is None:
+            sweeps = slice(None)
+        window = sample_range(t_min, t_max, self.sampling_rate, self.sweep_length)
+        return scale_raw(self.raw[sweeps, :, window][:, list(channels)], [self.gains[i] for i in channels],
+                         [self.offsets[i] for i in channels])
+
+    def iter_sweeps(self, chunk_size: int, channels=None, t_min=None, t_max=None):
+        """
+        Reads recording in chunks of sweeps, so only one chunk is held in memory at a time.
+        :param chunk_size: Number of sweeps in one chunk
+        :param channels: List of channel indices in the file to read, None reads every channel
+        :param t_min: Start of the time window in every sweep (in seconds), None means start of the sweep
+        :param t_max: End of the time window in every sweep (in seconds), None means end of the sweep
+        :return: generator of float32 arrays of shape (chunk sweeps, channels, samples), see read()
+        """
+        for start in range(0, self.sweep_count, chunk_size):
+            yield self.read(channels, t_min, t_max, sweeps=slice(start, start + chunk_size))
+
+
+def scale_raw(raw, gains: list, offsets: list):
+    """
+    Scales int16 ADC values into ADC units the same way as pyabf does.
+    :param raw: array of shape (sweeps, channels, samples), for example, part of ABFMemmap.raw
+    :param gains: Gain of every channel of raw, for example, ABFMemmap.gains of the channels
+    :param offsets: Offset of every channel of raw
+    :return: float32 array of the same shape in ADC units
+    """
+    data = np.empty(raw.shape, dtype=np.float32)
+    for i, (gain, offset) in enumerate(zip(gains, offsets)):
+        data[:, i, :] = raw[:, i, :]
+        data[:, i, :] *= np.float32(gain)
+        data[:, i, :] += np.float32(offset)
+    return data
+
+
+def open_abf(filename: str):
+    """
+    Opens .abf file with ABFMemmap reader.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :return: ABFMemmap object or None if file variant is not supported and should be read with pyabf
+    """
+    try:
+        return ABFMemmap(filename)
+    except NotImplementedError:
+        return None
+
+
+def compare_with_pyabf(filename: str):
+    """
+    Checks ABFMemmap reader against pyabf.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :return: maximum absolute difference between values read by ABFMemmap and pyabf
+    """
+    import pyabf
+    abf = pyabf.ABF(filename)
+    reader = ABFMemmap(filename)
+    if (abf.adcNames, abf.adcUnits, abf.dataRate) != (reader.adc_names, reader.adc_units, reader.sampling_rate):
+        raise ValueError(f"{filename}: header of ABFMemmap does not match pyabf")
+    expected = abf.data.reshape(abf.channelCount, abf.sweepCount, abf.sweepPointCount).transpose(1, 0, 2)
+    return float(np.abs(reader.read() - expected).max())
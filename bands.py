@@ -0,0 +1,70 @@
+from collections import namedtuple
+import numpy as np
+
+# Frequency band. inclusive tells which ends of the band are included: 'both' or 'neither' (as in pandas between())
+Band = namedtuple('Band', ['name', 'f_min', 'f_max', 'inclusive'], defaults=['both'])
+
+FREQUENCY_BANDS = [Band('delta', 0, 4), Band('theta', 4, 8), Band('alpha', 8, 12), Band('beta', 12, 30),
+                   Band('low gamma', 30, 45), Band('high gamma', 55, 90)]  # Bands of psd_frequency_bands()
+ASSR_BAND = [Band('40 hz', 38, 42, 'neither')]  # 40 Hz ASSR band of psd_frequency_bands(frequency_40=True)
+
+_slices = {}  # (frequency grid, bands) -> (first bin, bin after the last) of every band
+
+
+def band_bins(freqs, bands=FREQUENCY_BANDS):
+    """
+    Finds frequency bins of every band. Bins are found once for every frequency grid and band table.
+    :param freqs: Sorted frequencies of the spectra in Hz
+    :param bands: List of Band objects (or tuples (name, f_min, f_max[, inclusive]))
+    :return: tuple (starts, stops) of arrays, bins of band i are freqs[starts[i]:stops[i]]
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    bands = tuple(Band(*band) for band in bands)
+    key = (freqs.tobytes(), bands)
+    if key not in _slices:
+        starts, stops = [], []
+        for band in bands:
+            if band.inclusive == 'both':
+                starts.append(np.searchsorted(freqs, band.f_min, side='left'))
+                stops.append(np.searchsorted(freqs, band.f_max, side='right'))
+            elif band.inclusive == 'neither':
+                starts.append(np.searchsorted(freqs, band.f_min, side='right'))
+                stops.append(np.searchsorted(freqs, band.f_max, side='left'))
+            else:
+                raise ValueError(f"Wrong inclusive '{band.inclusive}' of band {band.name}, use 'both' or 'neither'")
+        _slices[key] = (np.array(starts), np.maximum(np.array(stops), starts))
+    return _slices[key]
+
+
+def band_power(spectra, freqs, bands=FREQUENCY_BANDS):
+    """
+    Calculates mean power of every frequency band for a whole stack of spectra at once.
+    :param spectra: array of shape (..., freqs), for example (recordings, channels, freqs)
+    :param freqs: Sorted frequencies of the spectra in Hz
+    :param bands: List of Band objects, default is FREQUENCY_BANDS
+    :return: array of shape (..., bands), NaN if band has no frequency bins
+    """
+    spectra = np.asarray(spectra, dtype=float)
+    starts, stops = band_bins(freqs, bands)
+    # Sums of every band are taken with one reduceat() call: indices [start_0, stop_0, start_1, stop_1, ...] give
+    # sums of start_i:stop_i at even positions. A zero bin is added at the end, so stop can be the last frequency.
+    padded = np.concatenate([spectra, np.zeros(spectra.shape[:-1] + (1,))], axis=-1)
+    indices = np.column_stack([starts, stops]).ravel()
+    sums = np.add.reduceat(padded, indices, axis=-1)[..., ::2]
+    counts = stops - starts
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def band_table(spectra, bands=FREQUENCY_BANDS):
+    """
+    Calculates mean power of every frequency band of psd() dataframe.
+    :param spectra: dataframe where index is frequency and columns are channels (returned by psd())
+    :param bands: List of Band objects, default is FREQUENCY_BANDS
+    :return: dataframe with a row of every band, columns are channels and band_name
+    """
+    import pandas as pd
+    power = band_power(spectra.to_numpy().T, spectra.index.to_numpy(), bands)
+    table = pd.DataFrame(power.T, columns=spectra.columns)
+    table['band_name'] = [Band(*band).name for band in bands]
+    return table
@@ -0,0 +1,411 @@
+import argparse
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from bands import FREQUENCY_BANDS, Band, band_table
+from power_calculation import WINDOWS, PRECISIONS, psd_windows, import_ecog, calc_assr, calc_itpc_power, build_tapers
+from result_store import ResultStore
+from spectral import FILTER_METHODS, export_cache, load_cache, cache_info, total_cache_info
+from study_manifest import flatten_study, load_manifest, query_manifest
+from table_builder import LongTableBuilder
+from tfr import GroupTFR
+
+# Command-line entry point which runs analyses described by a job spec (.json file), for example,
+# python batch_jobs.py jobs.json --workers 8
+# Spec lists targets. Every target selects conditions of data.mice_data and names its output (spectra, band power,
+# 40 Hz ASSR parameters or group TFR), channels, windows and method. Targets which need the same calculation of the
+# same recording share it, so every recording is transformed once per method and precision. Example spec:
+# {"data": {"module": "data", "data_dir": ""}, "store": "tables_figures/store",
+#  "targets": [{"name": "fig_1_power", "output": "spectra", "calc": ["baseline"], "channels": ["Aux1"],
+#               "conditions": {"week": "week_0", "drug": ["Ketamine", "Saline"], "phase": "after_5_min"},
+#               "file": "tables_figures/fig_1_power.csv"},
+#              {"name": "assr", "output": "assr", "conditions": {"week": "week_0"}}]}
+
+OUTPUTS = ('spectra', 'bands', 'assr', 'tfr')  # Tables which a target can produce
+# Settings of every target and their defaults, spec can change defaults for every target with "defaults"
+TARGET_DEFAULTS = {'channels': ['Aux1', 'PFC'], 'windows': WINDOWS, 'calc': ['baseline'], 'method': 'multitaper',
+                   'precision': 'float64', 'filter': None, 'filter_method': 'fir', 'f_min': 0, 'f_max': 101,
+                   'bands': None, 'freqs': None, 'decim': 1, 'decimate': False, 'conditions': {}, 'file': None}
+CONDITION_KEYS = ('week', 'drug', 'phase', 'mouse')  # Keys of target conditions (levels of the study manifest)
+
+# One calculation of one recording: kind is 'spectra', 'assr' or 'tfr', params is a tuple of (name, value) pairs
+Computation = namedtuple('Computation', ['kind', 'path', 'params'])
+# One target of the spec: settings are TARGET_DEFAULTS values, tasks are (manifest row, Computation) pairs
+Target = namedtuple('Target', ['name', 'output', 'settings', 'tasks'])
+# Planned work: computations maps every unique Computation to its channels, requests is the number of computations
+# targets asked for before identical ones were merged
+JobPlan = namedtuple('JobPlan', ['targets', 'computations', 'requests'])
+# Result of one computation: status is 'done' or 'failed' (error is the traceback), cache is the
+# spectral.cache_info() of the computation (tapers reused and built by it)
+ComputationResult = namedtuple('ComputationResult', ['computation', 'status', 'result', 'error', 'seconds', 'cache'],
+                               defaults=[None])
+
+
+def load_spec(filename: str):
+    """
+    Reads job spec and checks its keys, so misspelled settings are not silently ignored.
+    :param filename: .json file of the spec
+    :return: dictionary of the spec
+    """
+    with open(filename) as f:
+        spec = json.load(f)
+    unknown = set(spec) - {'data', 'manifest', 'store', 'defaults', 'targets'}
+    if unknown:
+        raise ValueError(f"Unknown keys {sorted(unknown)} in {filename}")
+    for settings in [spec.get('defaults', {})] + spec.get('targets', []):
+        unknown = set(settings) - set(TARGET_DEFAULTS) - {'name', 'output'}
+        if unknown:
+            raise ValueError(f"Unknown target settings {sorted(unknown)} in {filename}")
+    return spec
+
+
+def spec_manifest(spec: dict):
+    """
+    :param spec: Job spec, manifest is read from "manifest" file (see study_manifest.save_manifest()) or built from
+    mice_data and mouse_names of "data" module: {"file": "data_analysis/data.py"} or {"module": "data"} (default,
+    imported from the current folder). "data_dir" is the folder of the recordings
+    :return: manifest DataFrame with week, drug, phase, mouse and path columns
+    """
+    if 'manifest' in spec:
+        return load_manifest(spec['manifest'])
+    data = spec.get('data', {})
+    if 'file' in data:
+        module_spec = importlib.util.spec_from_file_location('data', data['file'])
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        if os.getcwd() not in sys.path:
+            sys.path.insert(0, os.getcwd())
+        module = importlib.import_module(data.get('module', 'data'))
+    return flatten_study(module.mice_data, module.mouse_names, data.get('data_dir', ''))
+
+
+def _computation(output: str, path: str, settings: dict):
+    # Calculation needed by the target for one recording. Parameters which do not change the calculation are left out,
+    # so targets which differ only by them share it
+    if output in ('spectra', 'bands'):
+        filter_range = None if settings['filter'] is None else tuple(settings['filter']) + (settings['filter_method'],)
+        params = (('method', settings['method']), ('filter', filter_range), ('f_min', settings['f_min']),
+                  ('f_max', settings['f_max']), ('precision', settings['precision']),
+                  ('decimate', bool(settings['decimate'])))
+        return Computation('spectra', path, params)
+    if output == 'assr':
+        windows = tuple((name, tuple(settings['windows'][name])) for name in ('baseline', 'signal'))
+        return Computation('assr', path, (('windows', windows), ('precision', settings['precision'])))
+    freqs = None if settings['freqs'] is None else tuple(np.linspace(*settings['freqs']).tolist())
+    return Computation('tfr', path, (('freqs', freqs), ('decim', settings['decim']),
+                                     ('precision', settings['precision']), ('decimate', bool(settings['decimate']))))
+
+
+def _needed_windows(settings: dict):
+    # Time windows which spectra of the target use
+    names = set()
+    for calc in settings['calc']:
+        names.update(['signal', 'baseline'] if calc == 'ratio' else [calc])
+    missing = names - set(settings['windows'])
+    if missing:
+        raise ValueError(f"Windows {sorted(missing)} are not defined, add them to 'windows'")
+    return {name: tuple(settings['windows'][name]) for name in names}
+
+
+def plan_jobs(spec: dict, manifest):
+    """
+    Expands targets of the spec into calculations of recordings and merges identical ones. Spectra calculations of the
+    same recording, method, filter, frequency range, precision and decimation are merged into one calculation of
+    every window and channel which any target needs.
+    :param spec: Job spec (see load_spec())
+    :param manifest: Study manifest (see spec_manifest())
+    :return: JobPlan object
+    """
+    defaults = {**TARGET_DEFAULTS, **spec.get('defaults', {})}
+    targets, computations, windows, requests = [], {}, {}, 0
+    for i, target_spec in enumerate(spec.get('targets', [])):
+        settings = {**defaults, **target_spec}
+        name, output = settings.pop('name', f'target_{i}'), settings.pop('output', None)
+        if output not in OUTPUTS:
+            raise ValueError(f"Wrong output '{output}' of target '{name}', use one of {OUTPUTS}")
+        if settings['precision'] not in PRECISIONS:
+            raise ValueError(f"Wrong precision '{settings['precision']}' of target '{name}'")
+        if settings['filter_method'] not in FILTER_METHODS:
+            raise ValueError(f"Wrong filter method '{settings['filter_method']}' of target '{name}'")
+        conditions = settings['conditions']
+        conditions = conditions if isinstance(conditions, list) else [conditions]
+        unknown = {key for condition in conditions for key in condition} - set(CONDITION_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown conditions {sorted(unknown)} of target '{name}', use {CONDITION_KEYS}")
+        rows = pd.concat([query_manifest(manifest, **condition) for condition in conditions])
+        rows = rows[~rows.index.duplicated()]
+        if rows.empty:
+            raise ValueError(f"Conditions of target '{name}' select no recordings")
+
+        tasks = []
+        for row in rows.itertuples(index=False):
+            computation = _computation(output, row.path, settings)
+            channels = computations.setdefault(computation, [])
+            channels += [channel for channel in settings['channels'] if channel not in channels]
+            if computation.kind == 'spectra':
+                computation_windows = windows.setdefault(computation, {})
+                for window, times in _needed_windows(settings).items():
+                    if computation_windows.setdefault(window, times) != times:
+                        raise ValueError(f"Window '{window}' of target '{name}' differs from the same window of "
+                                         f"another target, give it a different name")
+            tasks.append((row, computation))
+            requests += 1
+        targets.append(Target(name, output, settings, tasks))
+    # Windows of merged spectra calculations are known only after every target, so they are added to params now
+    planned = {}
+    for computation, channels in computations.items():
+        if computation.kind == 'spectra':
+            channels = (channels, windows[computation])
+        planned[computation] = channels
+    return JobPlan(targets, planned, requests)
+
+
+def _compute(computation: Computation, channels):
+    # Runs one calculation and catches its exception, so one broken file does not stop the other calculations
+    start, before = time.perf_counter(), cache_info()
+    try:
+        params = dict(computation.params)
+        if computation.kind == 'spectra':
+            channels, windows = channels
+            filter_range = ({} if params['filter'] is None else
+                            dict(zip(('high_filt', 'low_filt', 'filter_method'), params['filter'])))
+            result = psd_windows(computation.path, channels=channels, windows=windows, filter_data=bool(filter_range),
+                                 f_min=params['f_min'], f_max=params['f_max'], method=params['method'],
+                                 precision=params['precision'], decimate=params['decimate'], **filter_range)
+        elif computation.kind == 'assr':
+            result = calc_assr(import_ecog(computation.path, channels=channels),
+                               windows={name: times for name, times in params['windows']},
+                               precision=params['precision'])
+        else:
+            power, itc = calc_itpc_power(import_ecog(computation.path, channels=channels),
+                                         precision=params['precision'], freqs=params['freqs'],
+                                         decim=params['decim'], decimate=params['decimate'])
+            result = {'channels': list(power.ch_names), 'freqs': power.freqs, 'times': power.times,
+                      'power': power.data, 'itc': itc.data}
+        return ComputationResult(computation, 'done', result, None, time.perf_counter() - start,
+                                 cache_info(since=before))
+    except Exception:
+        return ComputationResult(computation, 'failed', None, traceback.format_exc(), time.perf_counter() - start,
+                                 cache_info(since=before))
+
+
+class _TargetTable:
+    # Collects rows of one target from results of its calculations as soon as they are done
+
+    LABELS = {'spectra': ['week', 'drug', 'phase', 'mouse', 'calc', 'brain_area'],
+              'bands': ['week', 'drug', 'phase', 'mouse', 'calc', 'band_name', 'brain_area'],
+              'assr': ['week', 'drug', 'phase', 'mouse', 'brain_area']}
+    VALUES = {'spectra': ['freq', 'power'], 'bands': ['power'],
+              'assr': ['baseline_mean', 'response_mean', 'ratio', 'plf']}
+
+    def __init__(self, target: Target):
+        self.target = target
+        self.waiting = {}  # Computation -> manifest rows of the target which wait for it
+        for row, computation in target.tasks:
+            self.waiting.setdefault(computation, []).append(row)
+        self.builder = None if target.output == 'tfr' else LongTableBuilder(self.LABELS[target.output],
+                                                                            self.VALUES[target.output])
+        self.groups = {}  # (week, drug, phase) -> (GroupTFR, freqs, times) of 'tfr' target
+        self.failed = 0
+
+    def add(self, result: ComputationResult):
+        settings = self.target.settings
+        for row in self.waiting.get(result.computation, []):
+            if result.status != 'done':
+                self.failed += 1
+                continue
+            labels = {'week': row.week, 'drug': row.drug, 'phase': row.phase, 'mouse': row.mouse}
+            if self.target.output == 'assr':
+                table = result.result.loc[settings['channels']]
+                self.builder.append(table, brain_area=table.index.to_numpy(), **labels)
+            elif self.target.output == 'tfr':
+                picks = [result.result['channels'].index(channel) for channel in settings['channels']]
+                key = (row.week, row.drug, row.phase)
+                if key not in self.groups:
+                    self.groups[key] = (GroupTFR(), result.result['freqs'], result.result['times'])
+                self.groups[key][0].add(power=result.result['power'][picks], itc=result.result['itc'][picks])
+            else:
+                spectra = result.result
+                for calc in settings['calc']:
+                    power = (spectra['signal'] / spectra['baseline'] if calc == 'ratio' else spectra[calc])
+                    power = power[settings['channels']]
+                    if self.target.output == 'spectra':
+                        for channel in settings['channels']:
+                            self.builder.append(freq=power.index.to_numpy(), power=power[channel].to_numpy(),
+                                                calc=calc, brain_area=channel, **labels)
+                    else:
+                        bands = settings['bands'] or FREQUENCY_BANDS
+                        table = band_table(power, [Band(*band) for band in bands])
+                        table = table.melt(id_vars=['band_name'], var_name='brain_area', value_name='power')
+                        self.builder.append(table, calc=calc, **labels)
+
+    def table(self):
+        if self.builder is not None:
+            return self.builder.build()
+        tables = []
+        for (week, drug, phase), (group, freqs, times) in self.groups.items():
+            power, itc = group.mean('power'), group.mean('itc')
+            freq_grid, time_grid = np.meshgrid(freqs, times, indexing='ij')
+            for i, channel in enumerate(self.target.settings['channels']):
+                tables.append(pd.DataFrame({'week': week, 'drug': drug, 'phase': phase, 'brain_area': channel,
+                                            'freq': freq_grid.ravel(), 'time': time_grid.ravel(),
+                                            'power': power[i].ravel(), 'itc': itc[i].ravel(),
+                                            'count': group.count}))
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+
+def _progress(done: int, total: int, result: ComputationResult, started: float):
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = (total - done) / rate if rate > 0 else 0.0
+    print(f"[{done:{len(str(total))}d}/{total}] {result.computation.kind:7s} {result.status:6s} "
+          f"{result.seconds:6.2f} s  {rate:.2f} calculations/s  eta {eta:.0f} s  {result.computation.path}",
+          flush=True)
+
+
+def _build_tapers(computations: list):
+    # Builds tapers of every spectra computation in this process, so they are handed to the workers once
+    groups = {}
+    for computation, channels in computations:
+        if computation.kind == 'spectra':
+            params = dict(computation.params)
+            windows = tuple((name, tuple(times)) for name, times in channels[1].items())
+            key = (params['method'], params['f_max'], params['decimate'], windows)
+            groups.setdefault(key, []).append(computation.path)
+    for (method, f_max, decimate, windows), paths in groups.items():
+        build_tapers(paths, dict(windows), f_max=f_max, method=method, decimate=decimate)
+
+
+def run_plan(plan: JobPlan, n_workers=None, verbose=True):
+    """
+    Runs every computation of the plan in a pool of processes and collects target tables. Results are added to the
+    targets as soon as they are done, so memory holds only tables, not TFR of every recording. Tapers of spectra are
+    built before the pool starts and handed to every worker (see power_calculation.build_tapers()).
+    Note: on Windows and macOS scripts which call this function must be protected by `if __name__ == '__main__':`
+    :param plan: JobPlan object (see plan_jobs())
+    :param n_workers: Number of worker processes. Default is number of CPU cores, 1 runs computations in this process
+    :param verbose: If True, prints progress of every computation
+    :return: tuple (dictionary {target name: DataFrame}, list of ComputationResult objects, report dictionary with
+    counts, wall time, throughput and tapers reused ('taper_hits') and built ('tapers_built') by the computations and
+    seconds of building they saved ('taper_saved_s'))
+    """
+    tables = [_TargetTable(target) for target in plan.targets]
+    computations = list(plan.computations.items())
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    started = time.perf_counter()
+    results = []
+
+    def collect(result):
+        results.append(result)
+        for table in tables:
+            table.add(result)
+        if verbose:
+            _progress(len(results), len(computations), result, started)
+
+    if n_workers == 1 or len(computations) <= 1:
+        for computation, channels in computations:
+            collect(_compute(computation, channels))
+    else:
+        _build_tapers(computations)
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(computations)), initializer=load_cache,
+                                 initargs=(export_cache(),)) as executor:
+            futures = {executor.submit(_compute, computation, channels): computation
+                       for computation, channels in computations}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:  # For example, worker process was killed
+                    result = ComputationResult(futures[future], 'failed', None, traceback.format_exc(), 0.0)
+                collect(result)
+
+    wall = time.perf_counter() - started
+    cache = total_cache_info(result.cache for result in results)
+    paths = {computation.path for computation, _ in computations}
+    megabytes = sum(os.path.getsize(path) for path in paths if os.path.exists(path)) / 1024 ** 2
+    report = {'targets': len(plan.targets), 'requested': plan.requests, 'computations': len(computations),
+              'done': sum(result.status == 'done' for result in results),
+              'failed': sum(result.status == 'failed' for result in results), 'recordings': len(paths),
+              'wall_s': wall, 'computations_per_s': len(computations) / wall if wall > 0 else 0.0,
+              'mb_per_s': megabytes / wall if wall > 0 else 0.0,
+              'busy_s': sum(result.seconds for result in results), 'taper_hits': cache['hits'],
+              'tapers_built': cache['misses'], 'taper_saved_s': cache['saved_seconds']}
+    return {table.target.name: table.table() for table in tables}, results, report
+
+
+def write_outputs(plan: JobPlan, tables: dict, store=None):
+    """
+    Writes table of every target into its "file" (.csv) and into the store as a dataset named by the target.
+    :param plan: JobPlan object
+    :param tables: dictionary {target name: DataFrame} returned by run_plan()
+    :param store: ResultStore object or None
+    :return: list of written .csv files
+    """
+    files = []
+    for target in plan.targets:
+        table = tables[target.name]
+        if table.empty:
+            continue
+        if target.settings['file'] is not None:
+            folder = os.path.dirname(target.settings['file'])
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            table.to_csv(target.settings['file'], index=False)
+            files.append(target.settings['file'])
+        if store is not None:
+            store.write(table, target.name)
+    return files
+
+
+def print_plan(plan: JobPlan):
+    """
+    Prints targets, recordings of every target and number of calculations after identical ones were merged.
+    """
+    for target in plan.targets:
+        print(f"{target.name}: {target.output} of {len(target.tasks)} recordings, channels "
+              f"{target.settings['channels']}" + (f", calc {target.settings['calc']}"
+                                                  if target.output in ('spectra', 'bands') else ''))
+    kinds = pd.Series([computation.kind for computation in plan.computations]).value_counts()
+    print(f"{plan.requests} requested calculations, {len(plan.computations)} after merging identical ones "
+          f"({', '.join(f'{count} {kind}' for kind, count in kinds.items())})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs analyses described by a job spec (.json file)')
+    parser.add_argument('spec', help='.json job spec')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default is every CPU core')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan')
+    parser.add_argument('--quiet', action='store_true', help='do not print progress of every calculation')
+    args = parser.parse_args(argv)
+
+    spec = load_spec(args.spec)
+    plan = plan_jobs(spec, spec_manifest(spec))
+    print_plan(plan)
+    if args.dry_run:
+        return 0
+    tables, results, report = run_plan(plan, n_workers=args.workers, verbose=not args.quiet)
+    files = write_outputs(plan, tables, ResultStore(spec['store']) if 'store' in spec else None)
+    for result in results:
+        if result.status == 'failed':
+            print(f"Failed: {result.computation.kind} {result.computation.path}\n{result.error}", file=sys.stderr)
+    print(f"{report['done']} done, {report['failed']} failed of {report['computations']} calculations "
+          f"({report['requested']} requested) in {report['wall_s']:.1f} s: {report['computations_per_s']:.2f} "
+          f"calculations/s, {report['mb_per_s']:.1f} MB/s of .abf data, {report['busy_s']:.1f} s of work")
+    print(f"Tapers and windows: {report['taper_hits']} reused, {report['tapers_built']} built, "
+          f"{report['taper_saved_s']:.1f} s of building saved")
+    for name in files:
+        print(f"Written {name}")
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
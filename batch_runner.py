@@ -0,0 +1,131 @@
+import os
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from power_calculation import psd_frequency_bands, calc_itpc_power, import_ecog, build_tapers
+from spectral import export_cache, load_cache, cache_info
+from tfr import GroupTFR
+
+# One psd_frequency_bands() call. Parameters have the same names and meaning as in psd_frequency_bands()
+BandJob = namedtuple('BandJob', ['filename', 'mouse_name', 'experiment_phase', 'calc', 'channels',
+                                 'frequency_40', 'all_freq'], defaults=[False, False])
+# Result of one job. If job failed, result is None and error is the traceback of the exception. cache is the
+# spectral.cache_info() of the job (tapers reused and built by it), see spectral.total_cache_info()
+JobResult = namedtuple('JobResult', ['job', 'result', 'error', 'cache'], defaults=[None])
+
+
+def band_jobs(data_list: list, mice_names: list, experiment_phase: str, calc: str, channels: list,
+              frequency_40=False, all_freq=False):
+    """
+    Creates jobs for every .abf file of one experiment group, the same way as table_of_frequency_bands() pairs files
+    and mice names.
+    :param data_list: List of .abf files. For example: ['file1.abf', 'file2.abf', 'file3.abf']
+    :param mice_names: List of mice names. For example: ['M1', 'M2', 'M3']
+    :param experiment_phase: Name of experiment phase. For example: 'After KET'
+    :param calc: One of the option: 'baseline', 'signal' (response) or 'ratio'
+    :param channels: List of channels. For example: ['Aux1', 'PFC']
+    :param frequency_40: True if we want to extract frequency range (38:42) Hz
+    :param all_freq: True if we want to extract every frequency
+    :return: list of BandJob objects
+    """
+    return [BandJob(filename, mouse_name, experiment_phase, calc, list(channels), frequency_40, all_freq)
+            for filename, mouse_name in zip(data_list, mice_names)]
+
+
+def _run_job(job: BandJob):
+    # Runs one job and catches its exception, so one broken file does not stop the batch
+    before = cache_info()
+    try:
+        result = psd_frequency_bands(job.filename, channels=job.channels, mouse_name=job.mouse_name,
+                                     experiment_phase=job.experiment_phase, calc=job.calc,
+                                     frequency_40=job.frequency_40, all_freq=job.all_freq)
+        return JobResult(job, result, None, cache_info(since=before))
+    except Exception:
+        return JobResult(job, None, traceback.format_exc(), cache_info(since=before))
+
+
+def run_band_jobs(jobs, n_workers=None):
+    """
+    Runs psd_frequency_bands() jobs in a pool of processes. Tapers of the jobs are built in this process before the
+    pool starts and handed to every worker (see power_calculation.build_tapers()), so workers only reuse them.
+    Note: on Windows and macOS scripts which call this function must be protected by `if __name__ == '__main__':`
+    :param jobs: list of BandJob objects (see band_jobs())
+    :param n_workers: Number of worker processes. Default is number of CPU cores, 1 runs jobs in this process
+    :return: list of JobResult objects in the same order as jobs. Errors of failed jobs are returned in the
+    JobResult.error, other jobs are not affected. spectral.total_cache_info() of JobResult.cache of the results
+    counts tapers reused and built by the workers.
+    """
+    jobs = list(jobs)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1 or len(jobs) <= 1:
+        return [_run_job(job) for job in jobs]
+
+    build_tapers([job.filename for job in jobs])
+    results = []
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs)), initializer=load_cache,
+                             initargs=(export_cache(),)) as executor:
+        futures = [executor.submit(_run_job, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception:  # For example, worker process was killed
+                results.append(JobResult(job, None, traceback.format_exc()))
+    return results
+
+
+def concat_results(results: list):
+    """
+    :param results: list of JobResult objects returned by run_band_jobs()
+    :return: DataFrame of every successful job result concatenated in jobs order (failed jobs are skipped, see
+    failed_jobs())
+    """
+    import pandas as pd
+    return pd.concat([result.result for result in results if result.error is None])
+
+
+def failed_jobs(results: list):
+    """
+    :param results: list of JobResult objects returned by run_band_jobs()
+    :return: list of JobResult objects of failed jobs
+    """
+    return [result for result in results if result.error is not None]
+
+
+def _group_tfr_part(filenames: list, channels: list, tfr_kwargs: dict):
+    # Accumulates TFR of files one by one, so only one recording's TFR is held in memory
+    group = GroupTFR()
+    output = tfr_kwargs.get('output', 'both')
+    for filename in filenames:
+        result = calc_itpc_power(import_ecog(filename, channels=channels), **tfr_kwargs)
+        if output == 'both':
+            group.add(*result)
+        else:
+            group.add(**{output: result})
+    return group
+
+
+def run_group_tfr(filenames: list, channels: list, n_workers=None, **tfr_kwargs):
+    """
+    Calculates group mean and variance of power and itc (calc_itpc_power()) of many recordings. Files are split
+    between worker processes, every worker accumulates its part (see tfr.GroupTFR) and parts are merged.
+    Note: on Windows and macOS scripts which call this function must be protected by `if __name__ == '__main__':`
+    :param filenames: List of .abf files, for example, mice_data['week_0']['Ketamine']['after_1_h']
+    :param channels: List of channels, for example, ['Aux1']
+    :param n_workers: Number of worker processes. Default is number of CPU cores, 1 runs in this process
+    :param tfr_kwargs: Parameters of calc_itpc_power(), for example, freqs=np.linspace(20, 70, 51)
+    :return: GroupTFR object, for example, group.mean('power') is the average power of the recordings
+    """
+    filenames = list(filenames)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, len(filenames)), 1)
+    if n_workers == 1:
+        return _group_tfr_part(filenames, channels, tfr_kwargs)
+
+    parts = [filenames[i::n_workers] for i in range(n_workers)]
+    group = GroupTFR()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for part in executor.map(_group_tfr_part, parts, [channels] * n_workers, [tfr_kwargs] * n_workers):
+            group.merge(part)
+    return group
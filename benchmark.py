@@ -0,0 +1,325 @@
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pyabf
+import mne
+import power_calculation as pc
+from bands import ASSR_BAND, FREQUENCY_BANDS
+from ecog_cache import recording_cache
+from result_cache import result_cache
+from synthetic_abf import SWEEP_LENGTH, write_synthetic_abf
+
+# Benchmark of every analysis stage on synthetic recordings (see synthetic_abf.py). Every optimized path is compared
+# with the reference path, which is the implementation the optimizations replaced, so speedup and deviation of results
+# are reported together. Run, for example, python benchmark.py --sizes 20 100 400 --output benchmark.csv
+
+SIZES = [20, 100, 400]  # Numbers of sweeps of benchmarked recordings
+N_FILES = 4  # Number of recordings of psd_calc() and table_of_frequency_bands() stages
+CHANNELS = ['Aux1', 'PFC']
+STAGES = ['import_ecog', 'psd_welch', 'psd_multitaper', 'psd_filtered', 'psd_calc', 'psd_frequency_bands',
+          'calc_itpc_power', 'table_of_frequency_bands']
+# Import time budget (in seconds) of modules imported by worker processes and scripts which read cached results.
+# Heavy dependencies (HEAVY_MODULES) are imported on first use. power_calculation and batch_runner import pandas on
+# first use too, so they import little more than numpy, study_pipeline and result_store import pandas for their tables.
+IMPORT_BUDGET = {'power_calculation': 0.6, 'batch_runner': 0.6, 'study_pipeline': 0.6, 'result_store': 0.5}
+HEAVY_MODULES = ['mne', 'pyabf', 'scipy', 'matplotlib', 'seaborn']
+
+
+# Reference implementations (the code before optimizations, results are the same up to floating point error)
+
+def _reference_import_ecog(filename: str):
+    abf = pyabf.ABF(filename)
+    info = mne.create_info(ch_names=pc.CHANNEL_NAMES, sfreq=abf.dataRate, ch_types=pc.CHANNEL_TYPES)
+    events = [[x, 0, x + 1] for x in range(abf.sweepCount)]
+    data = np.empty([np.size(abf.sweepList), 3, np.size(abf.sweepX)])
+    for isweep in abf.sweepList:
+        for channel in range(3):
+            abf.setSweep(isweep, channel=channel)
+            data[isweep, channel, :] = abf.sweepY
+    return mne.EpochsArray(data * 1e-6, info, events, 0)
+
+
+def _reference_psd(file_name: str, channels: list, f_min=0.1, f_max=100, t_min=1.2, t_max=1.9, method='multitaper',
+                   filter_data=False):
+    file = _reference_import_ecog(file_name)
+    if filter_data:
+        file = file.copy().filter(0.5, 100)
+    if method == 'welch':
+        spectrum = file.compute_psd(method='welch', fmin=f_min, fmax=f_max, tmin=t_min, tmax=t_max, picks=channels,
+                                    n_fft=1000)
+    else:
+        spectrum = file.compute_psd(method='multitaper', fmin=f_min, fmax=f_max, tmin=t_min, tmax=t_max,
+                                    picks=channels, bandwidth=2)
+    psd_mean = spectrum.to_data_frame().groupby(['freq']).mean(numeric_only=True).drop('epoch', axis=1)
+    for x in channels:
+        psd_mean[x] = (np.sqrt(psd_mean[x]) * 1e6) ** 2
+    return psd_mean
+
+
+def _reference_calc_power(file_name: str, channels: list, calc: str, **kwargs):
+    if calc == 'ratio':
+        return (_reference_psd(file_name, channels, t_min=1.2, t_max=1.9, **kwargs) /
+                _reference_psd(file_name, channels, t_min=0.2, t_max=0.9, **kwargs))
+    return _reference_psd(file_name, channels, t_min=pc.WINDOWS[calc][0], t_max=pc.WINDOWS[calc][1], **kwargs)
+
+
+def _reference_psd_calc(files_names: list, channels: list, calc='baseline'):
+    df = _reference_calc_power(files_names[0], channels, calc)
+    for file_name in files_names[1:]:
+        df += _reference_calc_power(file_name, channels, calc)
+    return df / len(files_names)
+
+
+def _reference_psd_frequency_bands(filename: str, channels: list, mouse_name: str, experiment_phase='default_phase',
+                                   calc='baseline', frequency_40=False):
+    psd_file = _reference_calc_power(filename, channels, calc, f_min=0, f_max=101)
+    rows = []
+    for band in (ASSR_BAND if frequency_40 else FREQUENCY_BANDS):
+        row = psd_file[psd_file.index.to_series().between(band.f_min, band.f_max, inclusive=band.inclusive)].mean()
+        row['band_name'] = band.name
+        rows.append(row)
+    new_df = pd.DataFrame(rows)
+    new_df['calc'] = calc
+    new_df['mouse'] = mouse_name
+    new_df['experiment_phase'] = experiment_phase
+    return new_df.melt(id_vars=['mouse', 'experiment_phase', 'band_name', 'calc'], var_name='brain_area',
+                       value_name='Ratio' if calc == 'ratio' else 'Power')
+
+
+def _reference_calc_itpc_power(data):
+    return mne.time_frequency.tfr_morlet(data, freqs=pc.ITPC_FREQS, n_cycles=pc.ITPC_N_CYCLES, use_fft=True,
+                                         return_itc=True, n_jobs=1)
+
+
+def _reference_table_of_frequency_bands(data_list: list, channels: list, mice_names: list, experiment_phase: str,
+                                        calc: str, freq_40: bool):
+    table = _reference_psd_frequency_bands(data_list[0], channels, mice_names[0], experiment_phase, calc, freq_40)
+    for num in range(1, len(data_list)):
+        table = pd.concat([table, _reference_psd_frequency_bands(data_list[num], channels, mice_names[num],
+                                                                 experiment_phase, calc, freq_40)])
+    return table
+
+
+def _values(result):
+    # Numbers of the result of any stage as one float array
+    if isinstance(result, tuple):
+        return np.concatenate([_values(item) for item in result])
+    if isinstance(result, mne.BaseEpochs):
+        return result.get_data().ravel()
+    if isinstance(result, pd.DataFrame):
+        return result.select_dtypes('number').to_numpy(dtype=float).ravel()
+    return np.asarray(result.data, dtype=float).ravel()
+
+
+def max_deviation(result, reference):
+    """
+    :param result: Result of optimized path (EpochsArray, DataFrame, AverageTFR or tuple of them)
+    :param reference: Result of reference path
+    :return: maximum relative deviation of result values from reference values
+    """
+    values, reference_values = _values(result), _values(reference)
+    if values.shape != reference_values.shape:
+        return np.inf
+    scale = np.abs(reference_values).max()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Values close to zero (for example, STI channel between clicks) are compared with the largest value
+        deviation = np.abs(values - reference_values) / np.maximum(np.abs(reference_values), 1e-6 * scale)
+    return float(np.nanmax(deviation)) if deviation.size else 0.0
+
+
+def measure(function, repeat=3, setup=None):
+    """
+    Measures run of the function. Wall and CPU time are the best of repeated runs, peak memory is measured in one more
+    run with tracemalloc (which slows the run down, so its time is not used).
+    :param function: Function without parameters
+    :param repeat: Number of timed runs
+    :param setup: Function without parameters which is called (untimed) before every run, for example, to clear caches
+    :return: tuple (result, wall time in s, CPU time in s, peak memory in MB)
+    """
+    wall, cpu = np.inf, np.inf
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = function()
+        wall = min(wall, time.perf_counter() - wall_start)
+        cpu = min(cpu, time.process_time() - cpu_start)
+    if setup is not None:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return result, wall, cpu, peak
+
+
+def stage_variants(stage: str, files: list, mice: list):
+    """
+    :param stage: Name of the stage, one of STAGES
+    :param files: Recordings of the benchmark, the first one is used by single file stages
+    :param mice: Names of mice of the recordings
+    :return: list of tuples (variant, function), the first variant is the reference
+    """
+    file = files[0]
+    uncached = dict(use_cache=False)
+    if stage == 'import_ecog':
+        return [('reference', lambda: _reference_import_ecog(file)),
+                ('optimized', lambda: pc.import_ecog(file, **uncached)),
+                ('cached', lambda: pc.import_ecog(file))]
+    if stage in ('psd_welch', 'psd_multitaper'):
+        method = stage[len('psd_'):]
+        variants = [('reference', lambda: _reference_psd(file, CHANNELS, method=method)),
+                    ('optimized', lambda: pc.psd(file, CHANNELS, method=method, **uncached)),
+                    ('cached', lambda: pc.psd(file, CHANNELS, method=method)),
+                    ('float32', lambda: pc.psd(file, CHANNELS, method=method, precision='float32', **uncached))]
+        if method == 'multitaper':
+            variants.append(('chunked', lambda: pc.psd(file, CHANNELS, method=method, chunk_size=10, **uncached)))
+        else:
+            # Decimated Welch spectra have the same frequencies, multitaper ones do not (see decimation_deviation())
+            variants.append(('decimated', lambda: pc.psd(file, CHANNELS, method=method, decimate=True, **uncached)))
+        return variants
+    if stage == 'psd_filtered':
+        # The iir variant is a different filter, its deviation from the FIR reference is not a numerical error
+        filtered = dict(filter_data=True, use_cache=False)
+        return [('reference', lambda: _reference_psd(file, CHANNELS, filter_data=True)),
+                ('optimized', lambda: pc.psd(file, CHANNELS, **filtered)),
+                ('float32', lambda: pc.psd(file, CHANNELS, precision='float32', **filtered)),
+                ('chunked', lambda: pc.psd(file, CHANNELS, chunk_size=10, **filtered)),
+                ('iir', lambda: pc.psd(file, CHANNELS, filter_method='iir', **filtered))]
+    if stage == 'psd_calc':
+        return [('reference', lambda: _reference_psd_calc(files, CHANNELS, calc='ratio')),
+                ('optimized', lambda: pc.psd_calc(files, CHANNELS, calc='ratio', **uncached)),
+                ('cached', lambda: pc.psd_calc(files, CHANNELS, calc='ratio'))]
+    if stage == 'psd_frequency_bands':
+        return [('reference', lambda: _reference_psd_frequency_bands(file, CHANNELS, mice[0], calc='ratio')),
+                ('optimized', lambda: pc.psd_frequency_bands(file, CHANNELS, mice[0], calc='ratio', **uncached)),
+                ('cached', lambda: pc.psd_frequency_bands(file, CHANNELS, mice[0], calc='ratio'))]
+    if stage == 'calc_itpc_power':
+        epochs = pc.import_ecog(file, channels=CHANNELS)
+        return [('reference', lambda: _reference_calc_itpc_power(epochs)),
+                ('optimized', lambda: pc.calc_itpc_power(epochs)),
+                ('float32', lambda: pc.calc_itpc_power(epochs, precision='float32'))]
+    if stage == 'table_of_frequency_bands':
+        return [('reference', lambda: _reference_table_of_frequency_bands(files, CHANNELS, mice, 'phase', 'baseline',
+                                                                          False)),
+                ('optimized', lambda: pc.table_of_frequency_bands(files, CHANNELS, mice, 'phase', 'baseline',
+                                                                  False))]
+    raise ValueError(f"Unknown stage '{stage}', use one of {STAGES}")
+
+
+def import_times(budget=IMPORT_BUDGET, repeat=3):
+    """
+    Measures import time of every module in a new interpreter, the same way as a spawned worker process imports it.
+    :param budget: Dictionary {module: budget in seconds}
+    :param repeat: Number of measurements of every module, the best one is reported
+    :return: DataFrame with columns module, seconds, budget, within_budget and heavy_modules (heavy dependencies
+    which were imported with the module)
+    """
+    code = ("import json, sys, time; start = time.perf_counter(); import {module}; "
+            "print(json.dumps([time.perf_counter() - start, [name for name in {heavy} if name in sys.modules]]))")
+    rows = []
+    for module, seconds in budget.items():
+        times = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', code.format(module=module, heavy=HEAVY_MODULES)],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                    check=True).stdout
+            elapsed, heavy = json.loads(output)
+            times.append(elapsed)
+        rows.append({'module': module, 'seconds': min(times), 'budget': seconds, 'within_budget': min(times) <= seconds,
+                     'heavy_modules': ', '.join(heavy)})
+    return pd.DataFrame(rows)
+
+
+def _clear_caches():
+    recording_cache.clear(disk=True)
+    result_cache.clear(disk=True)
+
+
+def run_benchmark(sizes=SIZES, stages=STAGES, n_files=N_FILES, sweep_length=SWEEP_LENGTH, repeat=3, folder=None):
+    """
+    Writes synthetic recordings of every size and measures every variant of every stage. Caches of recordings and
+    results are moved into a temporary folder and cleared before every run, so 'cached' variants are measured with
+    warm caches and other variants never reuse results of earlier runs.
+    :param sizes: Numbers of sweeps of the recordings
+    :param stages: Stages to measure, default is every stage (STAGES)
+    :param n_files: Number of recordings of multi-file stages
+    :param sweep_length: Number of samples of every sweep
+    :param repeat: Number of timed runs of every variant
+    :param folder: Folder of synthetic recordings, default is a temporary folder
+    :return: DataFrame with one row per stage, size and variant. Columns wall_s and cpu_s (best run time), peak_mb
+    (peak traced memory), sweeps_per_s and mb_per_s (throughput of analysed sweeps and .abf data), speedup (reference
+    time / variant time) and max_deviation (maximum relative deviation from the reference result)
+    """
+    with tempfile.TemporaryDirectory() as temporary:
+        folder = temporary if folder is None else folder
+        cache_dirs = recording_cache.cache_dir, result_cache.cache_dir
+        recording_cache.cache_dir = os.path.join(temporary, 'cache')
+        result_cache.cache_dir = os.path.join(temporary, 'cache', 'results')
+        rows = []
+        try:
+            for n_sweeps in sizes:
+                files = [write_synthetic_abf(os.path.join(folder, f'synthetic_{n_sweeps}_{i}.abf'), n_sweeps,
+                                             sweep_length, seed=i) for i in range(n_files)]
+                mice = [f'M{i + 1}' for i in range(n_files)]
+                for stage in stages:
+                    used = files if stage in ('psd_calc', 'table_of_frequency_bands') else files[:1]
+                    megabytes = sum(os.path.getsize(file) for file in used) / 1024 ** 2
+                    reference = None
+                    for variant, function in stage_variants(stage, files, mice):
+                        _clear_caches()
+                        if variant == 'cached':
+                            function()  # Warms up the caches
+                        result, wall, cpu, peak = measure(function, repeat,
+                                                          setup=None if variant == 'cached' else _clear_caches)
+                        if reference is None:
+                            reference = (result, wall)
+                        rows.append({'stage': stage, 'sweeps': n_sweeps, 'files': len(used), 'variant': variant,
+                                     'wall_s': wall, 'cpu_s': cpu, 'peak_mb': peak,
+                                     'sweeps_per_s': n_sweeps * len(used) / wall, 'mb_per_s': megabytes / wall,
+                                     'speedup': reference[1] / wall,
+                                     'max_deviation': max_deviation(result, reference[0])})
+                        print(' '.join(f'{key}={value:.4g}' if isinstance(value, float) else f'{key}={value}'
+                                       for key, value in rows[-1].items()), flush=True)
+        finally:
+            recording_cache.clear()
+            result_cache.clear()
+            recording_cache.cache_dir, result_cache.cache_dir = cache_dirs
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of analysis stages on synthetic .abf recordings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of sweeps of the recordings')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to measure')
+    parser.add_argument('--files', type=int, default=N_FILES, help='number of recordings of multi-file stages')
+    parser.add_argument('--sweep-length', type=int, default=SWEEP_LENGTH, help='samples of every sweep')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs of every variant')
+    parser.add_argument('--precision', action='store_true',
+                        help='also print float32 deviation of every result (see precision_deviation())')
+    parser.add_argument('--imports', action='store_true', help='also check import times against IMPORT_BUDGET')
+    parser.add_argument('--output', help='.csv file of the results')
+    args = parser.parse_args()
+
+    if args.imports:
+        print(import_times().to_string(index=False, float_format='{:.3f}'.format))
+
+    results = run_benchmark(args.sizes, args.stages, args.files, args.sweep_length, args.repeat)
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(results.to_string(index=False, float_format='{:.4g}'.format))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.precision:
+        with tempfile.TemporaryDirectory() as folder:
+            file = write_synthetic_abf(os.path.join(folder, 'precision.abf'), min(args.sizes), args.sweep_length)
+            print(pc.precision_deviation(file, CHANNELS))
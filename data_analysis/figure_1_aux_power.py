@@ -1,35 +1,29 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
 import matplotlib.patches as mpatches
-from power_calculation import psd_frequency_bands
-from data import mice_data, mouse_names
+from result_store import ResultStore
+from study_pipeline import read_spectra
 
 CHANNEL = 'Aux1'
 WEEK = 'week_0'
 CALC = 'baseline'
 
-ketamine_effect = mice_data[WEEK]["Ketamine"]["after_5_min"]
-saline_effect = mice_data[WEEK]["Saline"]["after_5_min"]
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
+EXPORT_CSV = False  # True also writes the tables into .csv files for sharing
 
 # AUX1 DATA
 
-frequency_ket_aux = [psd_frequency_bands(ketamine_effect[x], calc=CALC, channels=[CHANNEL], all_freq=True,
-                                         mouse_name=mouse_names[x], experiment_phase='After KET') for x in
-                     range(len(ketamine_effect))]
-frequency_ket_df = pd.concat(frequency_ket_aux)
-
-frequency_sal_aux = [psd_frequency_bands(saline_effect[x], calc=CALC, channels=[CHANNEL], all_freq=True,
-                                         mouse_name=mouse_names[x], experiment_phase='After SAL') for x in
-                     range(len(saline_effect))]
-frequency_sal_df = pd.concat(frequency_sal_aux)
+frequency_ket_df = read_spectra(store, CALC, WEEK, 'Ketamine', 'after_5_min', CHANNEL, experiment_phase='After KET')
+frequency_sal_df = read_spectra(store, CALC, WEEK, 'Saline', 'after_5_min', CHANNEL, experiment_phase='After SAL')
 
 concat_dfs = pd.concat([frequency_ket_df, frequency_sal_df])
 concat_dfs[CHANNEL] = np.log10(concat_dfs[CHANNEL])
 
-concat_dfs.to_csv(f"tables_figures/fig_1_{CHANNEL}_{WEEK}_{CALC}_power.csv")
+if EXPORT_CSV:
+    concat_dfs.to_csv(f"tables_figures/fig_1_{CHANNEL}_{WEEK}_{CALC}_power.csv")
 
+import seaborn as sns  # Imported only to draw the figure, tables above are read and exported without it
 sns.set(rc={"figure.figsize": (17, 7)})
 
 sns.set_theme(context="poster", style='white', palette=None, font_scale=0.8)
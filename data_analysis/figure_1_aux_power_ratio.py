@@ -1,33 +1,28 @@
 import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
 import matplotlib.patches as mpatches
-from power_calculation import psd_frequency_bands
-from data import mice_data, mouse_names
+from ratio import condition_ratio
+from result_store import ResultStore
+from study_pipeline import read_spectra
 
 CHANNEL = 'Aux1'
 WEEK = 'week_0'
 CALC = 'baseline'
 
-ketamine_effect_week_0 = mice_data[WEEK]["Ketamine"]["after_5_min"]
-saline_effect_week_0 = mice_data[WEEK]["Saline"]["after_5_min"]
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
+EXPORT_CSV = False  # True also writes the tables into .csv files for sharing
 
 # AUX DATA
 
-frequency_ket_aux = [psd_frequency_bands(ketamine_effect_week_0[x], calc=CALC, channels=[CHANNEL], all_freq=True,
-                                         mouse_name=mouse_names[x], experiment_phase='After KET') for x in
-                     range(len(ketamine_effect_week_0))]
-frequency_ket_df = pd.concat(frequency_ket_aux)
+frequency_ket_df = read_spectra(store, CALC, WEEK, 'Ketamine', 'after_5_min', CHANNEL, experiment_phase='After KET')
+frequency_sal_df = read_spectra(store, CALC, WEEK, 'Saline', 'after_5_min', CHANNEL, experiment_phase='After SAL')
 
-frequency_sal_aux = [psd_frequency_bands(saline_effect_week_0[x], calc=CALC, channels=[CHANNEL], all_freq=True,
-                                         mouse_name=mouse_names[x], experiment_phase='After SAL') for x in
-                     range(len(saline_effect_week_0))]
-frequency_sal_df = pd.concat(frequency_sal_aux)
+# Calculate ratio, rows of the same mouse and frequency are divided
+frequency_ket_df = condition_ratio(frequency_ket_df, frequency_sal_df, values=[CHANNEL], keys=['mouse', 'freq'])
 
-frequency_ket_df[CHANNEL] = frequency_ket_df[CHANNEL] / frequency_sal_df[CHANNEL]  # Calculate ratio
-
-frequency_ket_df.to_csv(f"tables_figures/fig_1_{CHANNEL}_{WEEK}_{CALC}_power_ratio.csv")
+if EXPORT_CSV:
+    frequency_ket_df.to_csv(f"tables_figures/fig_1_{CHANNEL}_{WEEK}_{CALC}_power_ratio.csv")
 
+import seaborn as sns  # Imported only to draw the figure, tables above are read and exported without it
 sns.set(rc={"figure.figsize": (17, 7)})
 
 sns.set_theme(context="poster", style='white', palette=None, font_scale=0.8)
@@ -1,59 +1,28 @@
 import pandas as pd
-from power_calculation import table_of_frequency_bands, filter_table
-from data import mice_data, mouse_names
+from power_calculation import filter_table
+from result_store import ResultStore
+from study_pipeline import read_bands
 
 CALC = 'baseline'
 WEEK = 'week_0'
 
-# KETAMINE DATA
-
-ketamine_effect_week_0_after = mice_data[WEEK]["Ketamine"]["after_5_min"]
-ketamine_effect_week_0_after_1_h = mice_data[WEEK]["Ketamine"]["after_1_h"]
-ketamine_effect_week_0_after_4_h = mice_data[WEEK]["Ketamine"]["after_4_h"]
-ketamine_effect_week_0_after_24_h = mice_data[WEEK]["Ketamine"]["after_24_h"]
-
-# SALINE DATA
-
-saline_effect_week_0_after = mice_data[WEEK]["Saline"]["after_5_min"]
-saline_effect_week_0_after_1_h = mice_data[WEEK]["Saline"]["after_1_h"]
-saline_effect_week_0_after_4_h = mice_data[WEEK]["Saline"]["after_4_h"]
-saline_effect_week_0_after_24_h = mice_data[WEEK]["Saline"]["after_24_h"]
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
+EXPORT_CSV = False  # True also writes the tables into .csv files for sharing
 
 # KETAMINE EFFECT ON FREQUENCY BANDS
 
-table_ketamine_after = table_of_frequency_bands(ketamine_effect_week_0_after, channels=['Aux1', 'PFC'],
-                                                mice_names=mouse_names, experiment_phase="after_5_min_ket",
-                                                calc=CALC, freq_40=False)
-
-table_ketamine_after_1_h = table_of_frequency_bands(ketamine_effect_week_0_after_1_h, channels=['Aux1', 'PFC'],
-                                                    mice_names=mouse_names, experiment_phase="after_1_h_ket",
-                                                    calc=CALC, freq_40=False)
-
-table_ketamine_after_4_h = table_of_frequency_bands(ketamine_effect_week_0_after_4_h, channels=['Aux1', 'PFC'],
-                                                    mice_names=mouse_names, experiment_phase="after_4_h_ket",
-                                                    calc=CALC, freq_40=False)
-
-table_ketamine_after_24_h = table_of_frequency_bands(ketamine_effect_week_0_after_24_h, channels=['Aux1', 'PFC'],
-                                                     mice_names=mouse_names, experiment_phase="after_24_h_ket",
-                                                     calc=CALC, freq_40=False)
+table_ketamine_after = read_bands(store, CALC, WEEK, 'Ketamine', 'after_5_min', experiment_phase="after_5_min_ket")
+table_ketamine_after_1_h = read_bands(store, CALC, WEEK, 'Ketamine', 'after_1_h', experiment_phase="after_1_h_ket")
+table_ketamine_after_4_h = read_bands(store, CALC, WEEK, 'Ketamine', 'after_4_h', experiment_phase="after_4_h_ket")
+table_ketamine_after_24_h = read_bands(store, CALC, WEEK, 'Ketamine', 'after_24_h',
+                                       experiment_phase="after_24_h_ket")
 
 # SALINE EFFECT ON FREQUENCY BANDS
 
-table_saline_after = table_of_frequency_bands(saline_effect_week_0_after, channels=['Aux1', 'PFC'],
-                                              mice_names=mouse_names, experiment_phase="after_5_min_sal",
-                                              calc=CALC, freq_40=False)
-
-table_saline_after_1_h = table_of_frequency_bands(saline_effect_week_0_after_1_h, channels=['Aux1', 'PFC'],
-                                                  mice_names=mouse_names, experiment_phase="after_1_h_sal",
-                                                  calc=CALC, freq_40=False)
-
-table_saline_after_4_h = table_of_frequency_bands(saline_effect_week_0_after_4_h, channels=['Aux1', 'PFC'],
-                                                  mice_names=mouse_names, experiment_phase="after_4_h_sal",
-                                                  calc=CALC, freq_40=False)
-
-table_saline_after_24_h = table_of_frequency_bands(saline_effect_week_0_after_24_h, channels=['Aux1', 'PFC'],
-                                                   mice_names=mouse_names, experiment_phase="after_24_h_sal",
-                                                   calc=CALC, freq_40=False)
+table_saline_after = read_bands(store, CALC, WEEK, 'Saline', 'after_5_min', experiment_phase="after_5_min_sal")
+table_saline_after_1_h = read_bands(store, CALC, WEEK, 'Saline', 'after_1_h', experiment_phase="after_1_h_sal")
+table_saline_after_4_h = read_bands(store, CALC, WEEK, 'Saline', 'after_4_h', experiment_phase="after_4_h_sal")
+table_saline_after_24_h = read_bands(store, CALC, WEEK, 'Saline', 'after_24_h', experiment_phase="after_24_h_sal")
 
 # CREATING FILES WHERE EFFECT IS ON PARTICULAR FREQUENCY BAND
 
@@ -77,7 +46,8 @@ ket_after_1_h = pd.concat([sal_after_1_h, ket_after_1_h])
 ket_after_4_h = pd.concat([sal_after_4_h, ket_after_4_h])
 ket_after_24_h = pd.concat([sal_after_24_h, ket_after_24_h])
 
-ket_after.to_csv(f"tables_figures/fig_2_{BAND}_after_5_min_{AREA}_{WEEK}_{CALC}_power.csv")
-ket_after_1_h.to_csv(f"tables_figures/fig_2_{BAND}_after_1_h_{AREA}_{WEEK}_{CALC}_power.csv")
-ket_after_4_h.to_csv(f"tables_figures/fig_2_{BAND}_after_4_h_{AREA}_{WEEK}_{CALC}_power.csv")
-ket_after_24_h.to_csv(f"tables_figures/fig_2_{BAND}_after_24_h_{AREA}_{WEEK}_{CALC}_power.csv")
+if EXPORT_CSV:
+    ket_after.to_csv(f"tables_figures/fig_2_{BAND}_after_5_min_{AREA}_{WEEK}_{CALC}_power.csv")
+    ket_after_1_h.to_csv(f"tables_figures/fig_2_{BAND}_after_1_h_{AREA}_{WEEK}_{CALC}_power.csv")
+    ket_after_4_h.to_csv(f"tables_figures/fig_2_{BAND}_after_4_h_{AREA}_{WEEK}_{CALC}_power.csv")
+    ket_after_24_h.to_csv(f"tables_figures/fig_2_{BAND}_after_24_h_{AREA}_{WEEK}_{CALC}_power.csv")
@@ -1,90 +1,55 @@
 import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
 import matplotlib.patches as mpatches
-from power_calculation import psd_frequency_bands
-from data import mice_data, mouse_names
+from ratio import condition_ratio
+from result_store import ResultStore
+from study_pipeline import read_spectra
 
 CHANNEL = 'Aux1'
 
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
+EXPORT_CSV = False  # True also writes the tables into .csv files for sharing
+
 # KETAMINE TIME EFFECT
 
-ketamine_effect_week_0_after = mice_data["week_0"]["Ketamine"]["after_5_min"]
-ketamine_effect_week_0_after_1_h = mice_data["week_0"]["Ketamine"]["after_1_h"]
-ketamine_effect_week_0_after_4_h = mice_data["week_0"]["Ketamine"]["after_4_h"]
-ketamine_effect_week_0_after_24_h = mice_data["week_0"]["Ketamine"]["after_24_h"]
-
-frequency_ket_after = [
-    psd_frequency_bands(ketamine_effect_week_0_after[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 5 min KET ') for x in
-    range(len(ketamine_effect_week_0_after))]
-frequency_ket_after = pd.concat(frequency_ket_after)
-
-frequency_ket_after_1_h = [
-    psd_frequency_bands(ketamine_effect_week_0_after_1_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 1 h KET ') for x in
-    range(len(ketamine_effect_week_0_after_1_h))]
-frequency_ket_after_1_h = pd.concat(frequency_ket_after_1_h)
-
-frequency_ket_after_4_h = [
-    psd_frequency_bands(ketamine_effect_week_0_after_4_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 4 h KET ') for x in
-    range(len(ketamine_effect_week_0_after_4_h))]
-frequency_ket_after_4_h = pd.concat(frequency_ket_after_4_h)
-
-frequency_ket_after_24_h = [
-    psd_frequency_bands(ketamine_effect_week_0_after_24_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 24 h KET ') for x in
-    range(len(ketamine_effect_week_0_after_24_h))]
-frequency_ket_after_24_h = pd.concat(frequency_ket_after_24_h)
+frequency_ket_after = read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_5_min', CHANNEL,
+                                   experiment_phase='After 5 min KET ')
+frequency_ket_after_1_h = read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_1_h', CHANNEL,
+                                       experiment_phase='After 1 h KET ')
+frequency_ket_after_4_h = read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_4_h', CHANNEL,
+                                       experiment_phase='After 4 h KET ')
+frequency_ket_after_24_h = read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_24_h', CHANNEL,
+                                        experiment_phase='After 24 h KET ')
 
 # SALINE TIME EFFECT
 
-saline_effect_week_0_after = mice_data["week_0"]["Saline"]["after_5_min"]
-saline_effect_week_0_after_1_h = mice_data["week_0"]["Saline"]["after_1_h"]
-saline_effect_week_0_after_4_h = mice_data["week_0"]["Saline"]["after_4_h"]
-saline_effect_week_0_after_24_h = mice_data["week_0"]["Saline"]["after_24_h"]
-
-frequency_sal_after = [
-    psd_frequency_bands(saline_effect_week_0_after[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 5 min SAL') for x in
-    range(len(saline_effect_week_0_after))]
-
-frequency_sal_after = pd.concat(frequency_sal_after)
-
-frequency_sal_after_1_h = [
-    psd_frequency_bands(saline_effect_week_0_after_1_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 1 h SAL') for x in
-    range(len(saline_effect_week_0_after_1_h))]
-
-frequency_sal_after_1_h = pd.concat(frequency_sal_after_1_h)
-
-frequency_sal_after_4_h = [
-    psd_frequency_bands(saline_effect_week_0_after_4_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 4 h SAL') for x in
-    range(len(saline_effect_week_0_after_4_h))]
-
-frequency_sal_after_4_h = pd.concat(frequency_sal_after_4_h)
-
-frequency_sal_after_24_h = [
-    psd_frequency_bands(saline_effect_week_0_after_24_h[x], calc='baseline', channels=[CHANNEL], all_freq=True,
-                        mouse_name=mouse_names[x], experiment_phase='After 24 h SAL') for x in
-    range(len(saline_effect_week_0_after_24_h))]
-
-frequency_sal_after_24_h = pd.concat(frequency_sal_after_24_h)
+frequency_sal_after = read_spectra(store, 'baseline', 'week_0', 'Saline', 'after_5_min', CHANNEL,
+                                   experiment_phase='After 5 min SAL')
+frequency_sal_after_1_h = read_spectra(store, 'baseline', 'week_0', 'Saline', 'after_1_h', CHANNEL,
+                                       experiment_phase='After 1 h SAL')
+frequency_sal_after_4_h = read_spectra(store, 'baseline', 'week_0', 'Saline', 'after_4_h', CHANNEL,
+                                       experiment_phase='After 4 h SAL')
+frequency_sal_after_24_h = read_spectra(store, 'baseline', 'week_0', 'Saline', 'after_24_h', CHANNEL,
+                                        experiment_phase='After 24 h SAL')
 
 # Ratio calculations
 
-frequency_ket_after[CHANNEL] = frequency_ket_after[CHANNEL] / frequency_sal_after[CHANNEL]
-frequency_ket_after_1_h[CHANNEL] = frequency_ket_after_1_h[CHANNEL] / frequency_sal_after_1_h[CHANNEL]
-frequency_ket_after_4_h[CHANNEL] = frequency_ket_after_4_h[CHANNEL] / frequency_sal_after_4_h[CHANNEL]
-frequency_ket_after_24_h[CHANNEL] = frequency_ket_after_24_h[CHANNEL] / frequency_sal_after_24_h[CHANNEL]
-
-frequency_ket_after.to_csv(f'tables_figures/{CHANNEL}_ratio_5_min_after.csv')
-frequency_ket_after_1_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_1_h.csv')
-frequency_ket_after_4_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_4_h.csv')
-frequency_ket_after_24_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_24_h.csv')
-
+# Rows of the same mouse and frequency are divided
+frequency_ket_after = condition_ratio(frequency_ket_after, frequency_sal_after, values=[CHANNEL],
+                                      keys=['mouse', 'freq'])
+frequency_ket_after_1_h = condition_ratio(frequency_ket_after_1_h, frequency_sal_after_1_h, values=[CHANNEL],
+                                          keys=['mouse', 'freq'])
+frequency_ket_after_4_h = condition_ratio(frequency_ket_after_4_h, frequency_sal_after_4_h, values=[CHANNEL],
+                                          keys=['mouse', 'freq'])
+frequency_ket_after_24_h = condition_ratio(frequency_ket_after_24_h, frequency_sal_after_24_h, values=[CHANNEL],
+                                           keys=['mouse', 'freq'])
+
+if EXPORT_CSV:
+    frequency_ket_after.to_csv(f'tables_figures/{CHANNEL}_ratio_5_min_after.csv')
+    frequency_ket_after_1_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_1_h.csv')
+    frequency_ket_after_4_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_4_h.csv')
+    frequency_ket_after_24_h.to_csv(f'tables_figures/{CHANNEL}_ratio_after_24_h.csv')
+
+import seaborn as sns  # Imported only to draw the figure, tables above are read and exported without it
 sns.set(rc={"figure.figsize": (20, 9)})
 sns.set_theme(context="poster", style='white', palette=None, font_scale=0.8)
 sns.set_theme(context="poster", style='ticks', palette=None, font_scale=0.8)
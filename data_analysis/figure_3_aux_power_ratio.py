@@ -1,55 +1,41 @@
 import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
 import matplotlib.patches as mpatches
-from power_calculation import psd_frequency_bands
-from data import mice_data, mouse_names
+from ratio import condition_ratio
+from result_store import ResultStore
+from study_pipeline import read_spectra
 
 CHANNEL = 'Aux1'
 
-ketamine_effect_week_0_after = mice_data["week_0"]["Ketamine"]["after_5_min"]
-ketamine_effect_week_2_after = mice_data["week_2"]["Ketamine"]["after_5_min"]
-
-saline_effect_week_0_after = mice_data["week_0"]["Saline"]["after_5_min"]
-saline_effect_week_2_after = mice_data["week_2"]["Saline"]["after_5_min"]
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
+EXPORT_CSV = False  # True also writes the tables into .csv files for sharing
 
 # Aux1 DATA Ketamine
 
-table_ketamine_week_0 = [psd_frequency_bands(ketamine_effect_week_0_after[x], calc='baseline', channels=[CHANNEL],
-                                             all_freq=True, mouse_name=mouse_names[x],
-                                             experiment_phase='After KET (Acute)') for x in
-                         range(len(ketamine_effect_week_0_after))]
-table_ketamine_week_0 = pd.concat(table_ketamine_week_0)
-
-table_ketamine_week_2 = [psd_frequency_bands(ketamine_effect_week_2_after[x], calc='baseline', channels=[CHANNEL],
-                                             all_freq=True, mouse_name=mouse_names[x],
-                                             experiment_phase='After KET (Chronic)') for x in
-                         range(len(ketamine_effect_week_2_after))]
-table_ketamine_week_2 = pd.concat(table_ketamine_week_2)
+table_ketamine_week_0 = read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_5_min', CHANNEL,
+                                     experiment_phase='After KET (Acute)')
+table_ketamine_week_2 = read_spectra(store, 'baseline', 'week_2', 'Ketamine', 'after_5_min', CHANNEL,
+                                     experiment_phase='After KET (Chronic)')
 
 # Aux1 DATA Saline
 
-table_saline_week_0 = [psd_frequency_bands(saline_effect_week_0_after[x], calc='baseline', channels=[CHANNEL],
-                                           all_freq=True, mouse_name=mouse_names[x],
-                                           experiment_phase='After SAL (Week 0)') for x in
-                       range(len(saline_effect_week_0_after))]
-table_saline_week_0 = pd.concat(table_saline_week_0)
-
-table_saline_week_2 = [psd_frequency_bands(saline_effect_week_2_after[x], calc='baseline', channels=[CHANNEL],
-                                           all_freq=True, mouse_name=mouse_names[x],
-                                           experiment_phase='After SAL (Week 2)') for x in
-                       range(len(saline_effect_week_2_after))]
-table_saline_week_2 = pd.concat(table_saline_week_2)
+table_saline_week_0 = read_spectra(store, 'baseline', 'week_0', 'Saline', 'after_5_min', CHANNEL,
+                                   experiment_phase='After SAL (Week 0)')
+table_saline_week_2 = read_spectra(store, 'baseline', 'week_2', 'Saline', 'after_5_min', CHANNEL,
+                                   experiment_phase='After SAL (Week 2)')
 
-# CALCULATE RATIO
-table_ketamine_week_0[CHANNEL] = table_ketamine_week_0[CHANNEL] / table_saline_week_0[CHANNEL]
-table_ketamine_week_2[CHANNEL] = table_ketamine_week_2[CHANNEL] / table_saline_week_2[CHANNEL]
+# CALCULATE RATIO (rows of the same mouse and frequency are divided)
+table_ketamine_week_0 = condition_ratio(table_ketamine_week_0, table_saline_week_0, values=[CHANNEL],
+                                        keys=['mouse', 'freq'])
+table_ketamine_week_2 = condition_ratio(table_ketamine_week_2, table_saline_week_2, values=[CHANNEL],
+                                        keys=['mouse', 'freq'])
 
-table_ketamine_week_0.to_csv(f"tables_figures/fig_3_{CHANNEL}_acute_ket_effect.csv")
-table_ketamine_week_2.to_csv(f"tables_figures/fig_3_{CHANNEL}_chronic_ket_effect.csv")
+if EXPORT_CSV:
+    table_ketamine_week_0.to_csv(f"tables_figures/fig_3_{CHANNEL}_acute_ket_effect.csv")
+    table_ketamine_week_2.to_csv(f"tables_figures/fig_3_{CHANNEL}_chronic_ket_effect.csv")
 
 # FIGURE AESTHETICS
 
+import seaborn as sns  # Imported only to draw the figure, tables above are read and exported without it
 sns.set(rc={"figure.figsize": (17, 7)})
 sns.set_theme(context="poster", style='white', font_scale=1.4)
 sns.set_theme(context="poster", style='ticks', font_scale=1.4)
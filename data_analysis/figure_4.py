@@ -1,37 +1,24 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from power_calculation import calc_itpc_power, import_ecog
-from data import mice_data
+from power_calculation import WINDOWS
+from result_store import ResultStore
+from study_pipeline import read_tfr
 
 CHANNEL = 'Aux1'
 WEEK = 'week_0'
 INJECT = "Ketamine"
 
-ecog_record = mice_data[WEEK][INJECT]["after_1_h"]
+store = ResultStore('tables_figures/store')  # Results of the study calculated once by run_study.py
 
-power_aux, itc_aux = calc_itpc_power(import_ecog(ecog_record[0]).pick_channels([CHANNEL]))
+# Group mean power and itc of the recordings (run_study.py calculates them for TFR_FREQS, 20-70 Hz)
+freq, time, average_pow, average_itc, count = read_tfr(store, WEEK, INJECT, "after_1_h", CHANNEL)
 
-for num in range(1, len(ecog_record)):
-    power_num_aux, itc_num_aux = calc_itpc_power(import_ecog(ecog_record[num]).pick_channels([CHANNEL]))
-    power_aux += power_num_aux
-
-average_aux = power_aux / 17
-
-# for num in range(1, len(ecog_record)):
-#     power_num_aux, itc_num_aux = calc_itpc_power(import_ecog(ecog_record[num]).pick_channels([CHANNEL]))
-#     itc_aux += itc_num_aux
-#
-# average_aux = itc_aux / 17
-
-
-
-average_pow = average_aux.data
-average_pow = np.log10(average_pow[0][0:51]) * 10
-baseline = average_pow[:, 400:1800].mean(axis=1)
+average_pow = np.log10(average_pow) * 10
+# Baseline is the mean power of the baseline window (0.2-0.9 s) of every frequency
+baseline_start, baseline_stop = WINDOWS['baseline']
+baseline = average_pow[:, (time >= baseline_start) & (time < baseline_stop)].mean(axis=1)
 average_pow = average_pow.transpose()
 normal_pow = np.array([signal - baseline for signal in average_pow]).transpose()
-time = np.linspace(0, 3, 6000)
-freq = np.linspace(20, 70, 51)
 
 plt.rcParams["figure.figsize"] = [7.00, 3.50]
 plt.style.use('seaborn-v0_8-paper')
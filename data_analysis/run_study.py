@@ -0,0 +1,31 @@
+import numpy as np
+from result_store import ResultStore
+from study_manifest import study_manifest
+from study_pipeline import run_study
+from spectral import total_cache_info
+from data import mice_data, mouse_names
+
+# Calculates spectra, band power and ASSR of every recording and channel of the study and group TFR of every week,
+# drug and phase once. Figure scripts read the results from the store. Results which are already stored from the same
+# .abf files and parameters are skipped, so an interrupted run continues where it stopped and changed recordings are
+# calculated again.
+
+CHANNELS = ['Aux1', 'PFC']
+TFR_FREQS = np.linspace(20, 70, 51)  # Frequencies of group TFR (figure 4)
+N_WORKERS = None  # Number of worker processes, None uses every CPU core
+OVERWRITE = False
+
+if __name__ == '__main__':
+    manifest = study_manifest(mice_data, mouse_names, filename='tables_figures/manifest.pkl')
+    store = ResultStore('tables_figures/store')
+    results = run_study(manifest, store, channels=CHANNELS, tfr_freqs=TFR_FREQS, n_workers=N_WORKERS,
+                        overwrite=OVERWRITE)
+    for status in ('done', 'skipped', 'failed'):
+        print(f"{status}: {sum(result.status == status for result in results)}")
+    cache = total_cache_info(result.cache for result in results)
+    print(f"tapers and windows: {cache['hits']} reused, {cache['misses']} built, "
+          f"{cache['saved_seconds']:.1f} s of building saved")
+    for result in results:
+        if result.status == 'failed':
+            print(result.task.path)
+            print(result.error)
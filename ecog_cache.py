@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+CACHE_DIR = os.environ.get('ECOG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ecog_analysis'))
+# Folder where recordings are stored as .npy files. Can be changed with ECOG_CACHE_DIR environment variable
+MEMORY_LIMIT = 2 * 1024 ** 3  # Maximum size (in bytes) of recordings kept in memory, default 2 GiB
+DISK_LIMIT = 4 * 1024 ** 3  # Maximum size (in bytes) of recordings stored on disk, default 4 GiB
+
+
+def recording_key(filename: str, layout: tuple):
+    """
+    Creates the key which identifies cached recording. Key changes when .abf file is replaced or modified
+    (size or modification time changes) or when channel layout of the experiment changes, so old entries go stale.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :param layout: tuple which describes channel layout, for example, (('STI', 'Aux1', 'PFC'), ('stim', 'ecog', 'ecog'))
+    :return: tuple (key, digest), where key is json string and digest is its sha1 hash used as a file name
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = json.dumps([path, stat.st_size, stat.st_mtime_ns, layout])
+    return key, hashlib.sha1(key.encode()).hexdigest()
+
+
+class RecordingCache:
+    """
+    Two level cache of recordings. First level is in-process LRU (least recently used) cache limited by
+    memory size, second level is on-disk store of arrays which are opened as memory-mapped files, so
+    repeated loads of the same .abf file (also from other processes) do not parse it again. The on-disk store is
+    limited by size, least recently used recordings are deleted first, and entries of the older versions of a
+    modified .abf file are deleted when its new version is stored.
+    Cached arrays are read-only, so copy them before modifying in place.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MEMORY_LIMIT, use_disk=True, max_disk_bytes=DISK_LIMIT):
+        """
+        :param cache_dir: Folder of the on-disk store
+        :param max_bytes: Maximum size of arrays kept in memory (in bytes)
+        :param use_disk: If False, only in-process cache is used
+        :param max_disk_bytes: Maximum size of the on-disk store (in bytes)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.use_disk = use_disk
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()  # digest -> (data, info)
+        self._bytes = 0
+        self.hits = 0  # Recording was found in memory
+        self.disk_hits = 0  # Recording was found in on-disk store
+        self.misses = 0  # Recording had to be loaded from .abf file
+        self.evictions = 0  # Stored recordings deleted because they were stale or the store was above size limit
+
+    def get(self, filename: str, layout: tuple, loader):
+        """
+        Returns recording from the cache. If it is not cached, calls loader and stores its result.
+        :param filename: name of the .abf file
+        :param layout: channel layout used in the key (see recording_key())
+        :param loader: function which takes filename and returns tuple (data array, info), info is json serializable
+        description of the data, for example, its sampling rate
+        :return: tuple (data array, info)
+        """
+        key, digest = recording_key(filename, layout)
+
+        if digest in self._entries:
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return self._entries[digest]
+
+        entry = self._read_disk(key, digest)
+        if entry is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            data, info = loader(filename)
+            data.flags.writeable = False
+            entry = (data, info)
+            self._write_disk(key, digest, entry)
+
+        self._remember(digest, entry)
+        return entry
+
+    def _remember(self, digest, entry):
+        # Adds entry to in-memory cache and drops least recently used entries above memory limit
+        self._entries[digest] = entry
+        self._bytes += entry[0].nbytes
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, (data, _) = self._entries.popitem(last=False)
+            self._bytes -= data.nbytes
+
+    def _paths(self, digest):
+        return os.path.join(self.cache_dir, digest + '.npy'), os.path.join(self.cache_dir, digest + '.json')
+
+    def _read_disk(self, key, digest):
+        if not self.use_disk:
+            return None
+        data_path, meta_path = self._paths(digest)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta['key'] != key:  # Hash collision or broken entry
+                return None
+            data = np.load(data_path, mmap_mode='r')
+            os.utime(data_path)  # Modification time marks the last use of the recording
+        except (OSError, ValueError, KeyError):
+            return None
+        return data, meta['info']
+
+    def _write_disk(self, key, digest, entry):
+        if not self.use_disk:
+            return
+        data_path, meta_path = self._paths(digest)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Files are written under temporary names and renamed, so other processes never see half-written entries
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(data_path + tmp_suffix, 'wb') as f:
+            np.save(f, entry[0])
+        path = json.loads(key)[0]
+        with open(meta_path + tmp_suffix, 'w') as f:
+            json.dump({'key': key, 'path': path, 'info': entry[1]}, f)
+        os.replace(data_path + tmp_suffix, data_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+        self._evict(digest, path)
+
+    def _stored(self):
+        # Returns list of (last use time, size, digest) of stored recordings
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:  # Deleted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name[:-len('.npy')]))
+        return entries
+
+    def _stored_path(self, digest):
+        # Returns path of the .abf file of stored recording, None if it is not known
+        try:
+            with open(self._paths(digest)[1]) as f:
+                return json.load(f).get('path')
+        except (OSError, ValueError):
+            return None
+
+    def _delete(self, digest):
+        # Deletes stored recording, returns False if it was already deleted (for example, by another process)
+        try:
+            for path in self._paths(digest):
+                os.remove(path)
+        except OSError:
+            return False
+        self.evictions += 1
+        return True
+
+    def _evict(self, digest, path):
+        # Deletes stale versions of the just stored recording (same .abf file, other key), then least recently used
+        # recordings until the store fits into max_disk_bytes. The just stored recording is always kept
+        entries = sorted(entry for entry in self._stored() if entry[2] != digest)
+        kept = []
+        for entry in entries:
+            if not (self._stored_path(entry[2]) == path and self._delete(entry[2])):
+                kept.append(entry)
+        size = sum(entry[1] for entry in kept) + os.path.getsize(self._paths(digest)[0])
+        for _, entry_size, stored in kept:
+            if size <= self.max_disk_bytes:
+                break
+            if self._delete(stored):
+                size -= entry_size
+
+    def info(self):
+        """
+        :return: dictionary with cache statistics: hits (memory), disk_hits, misses, evictions (on disk), number of
+        entries and size of entries in memory (bytes) and size of the on-disk store (bytes)
+        """
+        stored = self._stored() if self.use_disk and os.path.isdir(self.cache_dir) else []
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'memory_bytes': self._bytes,
+                'disk_bytes': sum(entry[1] for entry in stored)}
+
+    def clear(self, disk=False):
+        """
+        Removes all entries from memory and resets counters.
+        :param disk: If True, also deletes on-disk store
+        """
+        self._entries.clear()
+        self._bytes = 0
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        if disk and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(('.npy', '.json')):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+recording_cache = RecordingCache()  # Cache used by power_calculation.import_ecog()
+
+
+def cache_info():
+    """
+    :return: statistics of the recording cache used by import_ecog(), see RecordingCache.info()
+    """
+    return recording_cache.info()
+
+
+def clear_cache(disk=False):
+    """
+    Clears the recording cache used by import_ecog().
+    :param disk: If True, also deletes on-disk store
+    """
+    recording_cache.clear(disk=disk)
@@ -1,54 +1,535 @@
+import functools
+import itertools
 import sys
 import numpy as np
-import pandas as pd
-import pyabf
-import mne
+from abf_reader import open_abf, first_sample, sample_range, scale_raw
+from ecog_cache import recording_cache
+from result_cache import result_cache
+from spectral import (psd_mean, band_filter, decimation_factor, downsample, antialias_kernel, multitaper_tapers,
+                      welch_window, MULTITAPER_BANDWIDTH, WELCH_N_FFT, FILTER_METHODS, IIR_ORDER, DECIMATION_MARGIN,
+                      DECIMATION_ATTENUATION)
+from tfr import morlet_power_itc, assr_power_plf, average_tfr
+from bands import ASSR_BAND, FREQUENCY_BANDS, band_table
+from table_builder import LongTableBuilder, remove_unused_categories
+from profiling import stage
 
-mne.set_log_level('error')
 CHANNEL_NAMES = ['STI', 'Aux1', 'PFC']  # Name channels used in the experiment, note that order is important
 CHANNEL_TYPES = ['stim', 'ecog', 'ecog']  # Name type of the channels used in the experiment
+# Channels of the .abf file are labeled by position: file channel i is CHANNEL_NAMES[i], as import_ecog() always did,
+# so files must have exactly these channels. ECoG channels must be recorded in uV (they are converted into V by
+# multiplying by 1e-6), so a file with other units or with the stimulus channel in place of an ECoG channel is
+# rejected. ADC names of the study recordings have not been checked against a real file header, so finding channels
+# by name is opt-in: set CHANNEL_ADC_NAMES to the adcNames of the recordings (for example ['IN 0', 'IN 1', 'IN 2'],
+# which synthetic_abf.py writes), then channels may be in any order and other channels of the file are ignored.
+CHANNEL_ADC_NAMES = None  # ADC names in the .abf header of the channels in CHANNEL_NAMES, None means by position
+CHANNEL_UNITS = [None, 'uV', 'uV']  # ADC units of the channels in CHANNEL_NAMES, None means units are not checked
+WINDOWS = {'baseline': (0.2, 0.9), 'signal': (1.2, 1.9)}  # Epoch time windows (in seconds) of baseline and signal
+IIR_PAD = 2.0  # Periods of the lowest filter cutoff frequency filtered with IIR filter before and after windows
+PRECISIONS = {'float64': np.float64, 'float32': np.float32}  # Available precision of analysis arrays
+ITPC_FREQS = np.linspace(20, 90, 71)  # Frequencies of interest of calc_itpc_power() in Hz
+ITPC_N_CYCLES = np.logspace(*np.log10([7, 30]), 71)  # Number of cycles in the wavelet of every ITPC_FREQS frequency
+ASSR_FREQS = np.linspace(39, 41, 3)  # Frequencies (in Hz) of 40 Hz auditory steady-state response (ASSR)
+
+
+@functools.lru_cache(maxsize=None)
+def _mne():
+    """
+    Imports mne on first use. mne takes most of the import time of this module, so scripts which only read cached
+    results and worker processes start without it (pyabf, scipy and pandas are imported on first use too).
+    :return: mne module, log level is set to 'error'
+    """
+    import mne
+    mne.set_log_level('error')
+    return mne
 
 
-def import_ecog(filename: str):
-    global CHANNEL_NAMES
+def _channel_order(adc_names: list, adc_units: list, filename: str, channels: list):
     """
-    It takes .abf file and converts it into EpochsArray, which is needed for further analyses with mne package
+    Finds channels in the .abf file and checks the layout of the file. By default channels are taken by position
+    (file channel i is CHANNEL_NAMES[i]) and the file must have len(CHANNEL_NAMES) channels. If CHANNEL_ADC_NAMES is
+    set, channels are found by ADC names in the header. Units of the channels are checked against CHANNEL_UNITS.
+    :param adc_names: ADC names from the .abf header
+    :param adc_units: ADC units from the .abf header
+    :param filename: name of the .abf file, used in error messages
+    :param channels: Names of the channels from CHANNEL_NAMES, for example, ['Aux1', 'PFC']
+    :return: list of .abf channel indices in the same order as channels
+    :raises ValueError: if layout of the file does not match CHANNEL_NAMES
+    """
+    if CHANNEL_ADC_NAMES is None and len(adc_names) != len(CHANNEL_NAMES):
+        raise ValueError(f"{filename}: file has {len(adc_names)} channels {adc_names}, expected "
+                         f"{len(CHANNEL_NAMES)} channels {CHANNEL_NAMES} (set CHANNEL_ADC_NAMES to find channels "
+                         f"by name)")
+    order = []
+    for name in channels:
+        position = CHANNEL_NAMES.index(name)
+        if CHANNEL_ADC_NAMES is None:
+            index = position
+        else:
+            adc_name = CHANNEL_ADC_NAMES[position]
+            if adc_names.count(adc_name) != 1:
+                raise ValueError(f"{filename}: expected one ADC channel '{adc_name}' for {name}, "
+                                 f"file has {adc_names}")
+            index = adc_names.index(adc_name)
+        unit = CHANNEL_UNITS[position] if CHANNEL_UNITS is not None else None
+        if unit is not None and adc_units[index] != unit:
+            raise ValueError(f"{filename}: ADC channel {index} '{adc_names[index]}' ({name}) is recorded in "
+                             f"{adc_units[index]}, expected {unit}")
+        order.append(index)
+    return order
+
+
+def _decode_abf(filename: str, channels=None, t_min=None, t_max=None, precision='float64'):
+    """
+    Reads .abf file and returns its sweeps data as an array, which is used to create EpochsArray object. Episodic
+    ABF2 files are read with memory-mapped reader (see abf_reader.py), which loads only requested channels and time
+    window, other files are read with pyabf.
     :param filename: name of the .abf file, for example, '2022_05_12.abf'
-    :return: returns EpochsArray object (for more information check `mne` package 
-    documentation about EpochsArray object)
+    :param channels: Names of the channels to read, for example, ['Aux1', 'PFC']. Default is CHANNEL_NAMES
+    :param t_min: Start of the time window in every sweep (in seconds), None means start of the sweep
+    :param t_max: End of the time window in every sweep (in seconds), None means end of the sweep
+    :param precision: 'float64' or 'float32', type of the returned array (see PRECISIONS)
+    :return: tuple (data, sampling_rate), data is an array of shape (sweeps, channels, samples) in V, channels are
+    in the same order as channels parameter
+    """
+    if channels is None:
+        channels = CHANNEL_NAMES
+    reader = open_abf(filename)
+
+    with stage('decode_abf', file=filename, reader='pyabf' if reader is None else 'memmap', channels=list(channels),
+               t_min=t_min, t_max=t_max, precision=precision):
+        if reader is not None:
+            sampling_rate = reader.sampling_rate
+            order = _channel_order(reader.adc_names, reader.adc_units, filename, channels)
+            window = reader.read(order, t_min, t_max)
+        else:
+            abf, sweeps = _read_pyabf(filename)
+            sampling_rate = abf.dataRate  # Checks the sample rate used in the experiment of .abf file
+            order = _channel_order(abf.adcNames, abf.adcUnits, filename, channels)
+            samples = sample_range(t_min, t_max, sampling_rate, abf.sweepPointCount)
+            window = sweeps[order, :, samples].transpose(1, 0, 2)
+
+        return _to_volts(window, PRECISIONS[precision]), sampling_rate
+
+
+def _read_pyabf(filename: str):
+    """
+    Reads whole .abf file with pyabf.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :return: tuple (ABF object, float32 array of shape (channels, sweeps, samples) in ADC units)
     """
+    import pyabf
     abf = pyabf.ABF(filename)  # reads .abf file
-    n_channels = abf.channelCount  # find number of channels used in the .abf file
-    sampling_rate = abf.dataRate  # Checks the sample rate used in the experiment of .abf file
-    channel_names = CHANNEL_NAMES
-    # First stimulus and then channels order in abf file.
-    channel_types = CHANNEL_TYPES
-    info = mne.create_info(ch_names=channel_names, sfreq=sampling_rate, ch_types=channel_types)
-    # Creates information part in the EpochsArray object
-    events = [[x, 0, x + 1] for x in range(abf.sweepCount)]  # Calculate epochs/sweeps in the experiment
-    tmin = 0
-    data = np.empty([np.size(abf.sweepList), 3, np.size(abf.sweepX)])  # Creates empty array where sweeps data
-    # will be added
-    for isweep in abf.sweepList:  # for loop adds sweeps data into empty data array.
-        # Channels order should be the same as in the .abf file
-        # Aux1 channel
-        abf.setSweep(isweep, channel=0)
-        data[isweep, 0, :] = abf.sweepY
-        # PFC channel
-        abf.setSweep(isweep, channel=1)
-        data[isweep, 1, :] = abf.sweepY
-        # stim channel
-        abf.setSweep(isweep, channel=2)
-        data[isweep, 2, :] = abf.sweepY
-
-    abf_epochs = mne.EpochsArray(data * 1e-6, info, events, tmin)  # Create EpochsArray object
+    if abf.data.shape[1] != abf.sweepCount * abf.sweepPointCount:
+        raise ValueError(f"{filename}: sweeps have different lengths, only fixed-length sweeps are supported")
+    # abf.data holds every channel as one row of consecutive sweeps, so one reshape splits it into sweeps
+    return abf, abf.data.reshape(abf.channelCount, abf.sweepCount, abf.sweepPointCount)
+
+
+def _raw_recording(filename: str):
+    """
+    Reads every channel of CHANNEL_NAMES of the recording without scaling, this is what the recording cache keeps.
+    Episodic ABF2 files give int16 ADC values (4 times smaller than float64 volts), other files give float32 values
+    read by pyabf.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :return: tuple (data, info), data is an array of shape (sweeps, channels, samples) in the order of CHANNEL_NAMES
+    and info is a dictionary with 'sampling_rate', 'gains' and 'offsets' of the channels (see abf_reader.scale_raw())
+    """
+    reader = open_abf(filename)
+    with stage('decode_abf', file=filename, reader='pyabf' if reader is None else 'memmap', raw=True):
+        if reader is not None:
+            order = _channel_order(reader.adc_names, reader.adc_units, filename, CHANNEL_NAMES)
+            data = reader.raw[:, order, :]  # Indexing with a list copies the channels into memory
+            sampling_rate = reader.sampling_rate
+            gains, offsets = [reader.gains[i] for i in order], [reader.offsets[i] for i in order]
+        else:
+            abf, sweeps = _read_pyabf(filename)
+            order = _channel_order(abf.adcNames, abf.adcUnits, filename, CHANNEL_NAMES)
+            data = np.ascontiguousarray(sweeps[order].transpose(1, 0, 2))
+            sampling_rate = abf.dataRate
+            gains, offsets = [1.0] * len(order), [0.0] * len(order)  # pyabf values are already scaled
+    return data, {'sampling_rate': sampling_rate, 'gains': gains, 'offsets': offsets}
+
+
+def _to_volts(window, dtype=np.float64):
+    """
+    :param window: newly read array of .abf values in uV (float32)
+    :param dtype: np.float64 or np.float32
+    :return: window converted into V. float32 window is scaled in place, otherwise it is copied into dtype array
+    """
+    if window.dtype == dtype:
+        data = window
+    else:
+        data = np.empty(window.shape, dtype=dtype)  # Creates empty array of sweeps data
+        data[:] = window
+    data *= 1e-6
     # We multiply data by 1e-6 to get V, because our data is recorded in uV but EpochsArray thinks that it is
     # recorded in V, so we get very low values later when it automatically tries to convert it into mV
+    return data
+
+
+def stream_ecog(filename: str, chunk_size: int, channels=None, t_min=None, t_max=None, precision='float64'):
+    """
+    Reads .abf file in chunks of sweeps, so memory used by analysis is limited by chunk size instead of length of
+    the recording. Episodic ABF2 files are read chunk by chunk from memory-mapped file, other files are read with
+    pyabf as a whole (pyabf can not read part of the file) and only split into chunks.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :param chunk_size: Number of sweeps (epochs) in one chunk
+    :param channels: Names of the channels to read, for example, ['Aux1', 'PFC']. Default is CHANNEL_NAMES
+    :param t_min: Start of the time window in every sweep (in seconds), None means start of the sweep
+    :param t_max: End of the time window in every sweep (in seconds), None means end of the sweep
+    :param precision: 'float64' or 'float32', type of the chunk arrays (see PRECISIONS)
+    :return: tuple (chunks, sampling_rate), chunks is a generator of arrays of shape (sweeps, channels, samples) in V
+    """
+    if channels is None:
+        channels = CHANNEL_NAMES
+    reader = open_abf(filename)
+    if reader is None:
+        data, sampling_rate = _decode_abf(filename, channels, t_min, t_max, precision)
+        return (data[start:start + chunk_size] for start in range(0, data.shape[0], chunk_size)), sampling_rate
+
+    order = _channel_order(reader.adc_names, reader.adc_units, filename, channels)
+    chunks = (_to_volts(chunk, PRECISIONS[precision]) for chunk in reader.iter_sweeps(chunk_size, order, t_min, t_max))
+    return chunks, reader.sampling_rate
+
+
+def _load_array(filename: str, use_cache=True, channels=None, t_min=None, t_max=None, precision='float64'):
+    """
+    Loads recording as an array. Time windows and channel subsets of episodic ABF2 files are read from the
+    memory-mapped file (see abf_reader.py), so only the requested part is loaded and it is not cached. Whole
+    recordings and files which are read with pyabf (it always reads the whole file) are taken from the recording
+    cache (or decoded if use_cache is False), which keeps the whole raw recording (every channel of CHANNEL_NAMES, see
+    _raw_recording()), so every part of the same file is sliced from one entry and only the part is converted into
+    the requested precision. Parameters are the same as in import_ecog() and _decode_abf().
+    :return: tuple (data, sampling_rate), see _decode_abf(). data is a new (writable) array
+    """
+    if channels is None:
+        channels = CHANNEL_NAMES
+    whole = t_min is None and t_max is None and list(channels) == CHANNEL_NAMES
+    if not use_cache or (not whole and open_abf(filename) is not None):
+        return _decode_abf(filename, channels, t_min, t_max, precision)
+    layout = (CHANNEL_NAMES, CHANNEL_TYPES, CHANNEL_ADC_NAMES, CHANNEL_UNITS, 'raw')
+    with stage('recording_cache', file=filename):  # decode_abf stage inside is recorded only on cache miss
+        recording, info = recording_cache.get(filename, layout, _raw_recording)
+    samples = sample_range(t_min, t_max, info['sampling_rate'], recording.shape[-1])
+    picks = [CHANNEL_NAMES.index(name) for name in channels]
+    # Indexing with a list of channels copies only the requested part (also from memory-mapped on-disk entries),
+    # which is scaled the same way as _decode_abf() scales it
+    window = scale_raw(recording[:, picks, samples], [info['gains'][i] for i in picks],
+                       [info['offsets'][i] for i in picks])
+    return _to_volts(window, PRECISIONS[precision]), info['sampling_rate']
+
+
+def import_ecog(filename: str, use_cache=True, channels=None, t_min=None, t_max=None):
+    """
+    It takes .abf file and converts it into EpochsArray, which is needed for further analyses with mne package
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :param use_cache: If True (default), whole recording is taken from the recording cache (see ecog_cache.py), so
+    repeated imports of the same file do not decode it again. Raw recordings (int16 ADC values of ABF2 files) are
+    also stored in ecog_cache.CACHE_DIR (limited to ecog_cache.DISK_LIMIT bytes). Channel subsets and time windows
+    of ABF2 files are read directly from the memory-mapped file instead. Returned EpochsArray has its own copy of the
+    data, so it can be modified in place.
+    :param channels: Names of the channels to import, for example, ['Aux1']. Default (None) imports CHANNEL_NAMES
+    :param t_min: If given, only part of every epoch from t_min (in seconds) is imported, epoch times are kept
+    :param t_max: If given, only part of every epoch until t_max (in seconds) is imported
+    :return: returns EpochsArray object (for more information check `mne` package
+    documentation about EpochsArray object)
+    """
+    if channels is None:
+        channels = CHANNEL_NAMES
+    data, sampling_rate = _load_array(filename, use_cache, channels, t_min, t_max)
+    return _epochs_array(data, sampling_rate, channels, t_min)
+
+
+def _epochs_array(data, sampling_rate, channels: list, t_min=None):
+    """
+    :param data: array of shape (sweeps, channels, samples) in V
+    :param sampling_rate: Sampling rate in Hz
+    :param channels: Names of the channels in data
+    :param t_min: Time of the first sample in the epoch (in seconds), None means start of the sweep
+    :return: EpochsArray object of the data
+    """
+    mne = _mne()
+    channel_types = [CHANNEL_TYPES[CHANNEL_NAMES.index(name)] for name in channels]
+    info = mne.create_info(ch_names=list(channels), sfreq=sampling_rate, ch_types=channel_types)
+    # Creates information part in the EpochsArray object
+    events = [[x, 0, x + 1] for x in range(data.shape[0])]  # Calculate epochs/sweeps in the experiment
+    tmin = first_sample(t_min, sampling_rate) / sampling_rate  # Time of the first imported sample
+    with stage('epochs_array', sweeps=data.shape[0], channels=list(channels), samples=data.shape[-1]):
+        abf_epochs = mne.EpochsArray(data, info, events, tmin)  # Create EpochsArray object
     return abf_epochs
 
 
+def psd_frame(power, freqs, channels: list):
+    """
+    Converts mean power spectrum array into dataframe which is returned by psd() function.
+    :param power: array of shape (channels, freqs) in uV^2
+    :param freqs: frequencies of the power spectrum
+    :param channels: Names of the channels, for example ['Aux1', 'PFC']
+    :return: dataframe where index is frequency ('freq') and columns are named by channels (power in uV^2)
+    """
+    import pandas as pd
+    with stage('psd_frame', freqs=len(freqs), channels=list(channels)):
+        return pd.DataFrame(power.T, columns=list(channels), index=pd.Index(freqs, name='freq'))
+
+
+def _window_samples(windows: dict, sampling_rate, first: int, n_samples: int):
+    """
+    :param windows: Dictionary of named time windows {name: (t_min, t_max)} in seconds
+    :param sampling_rate: Sampling rate in Hz
+    :param first: Index of the first loaded sample in the epoch
+    :param n_samples: Number of loaded samples in every epoch
+    :return: list of slice objects of window samples in the loaded data
+    """
+    samples = []
+    for t_min, t_max in windows.values():
+        window = sample_range(t_min, t_max, sampling_rate, first + n_samples)
+        samples.append(slice(window.start - first, window.stop - first))
+    return samples
+
+
+def _filter_epochs(data, sampling_rate, channels: list, high_filt, low_filt, filter_method, file_name: str):
+    """
+    Filters ECoG channels of the data, stimulus channels are kept as they are (the same as mne .filter() does).
+    :param data: array of shape (sweeps, channels, samples), it is not modified
+    :param sampling_rate: Sampling rate in Hz
+    :param channels: Names of the channels in data
+    :param high_filt: High-pass cutoff frequency in Hz
+    :param low_filt: Low-pass cutoff frequency in Hz
+    :param filter_method: 'fir' (the same as mne .filter()) or 'iir', see spectral.band_filter()
+    :param file_name: name of the .abf file, used as a tag of the profiled stage
+    :return: filtered array with the same precision as data
+    """
+    picks = [i for i, name in enumerate(channels) if CHANNEL_TYPES[CHANNEL_NAMES.index(name)] != 'stim']
+    with stage('filter', file=file_name, high_filt=high_filt, low_filt=low_filt, method=filter_method):
+        if len(picks) == len(channels):
+            return band_filter(data, sampling_rate, high_filt, low_filt, filter_method)
+        filtered = data.copy()
+        filtered[:, picks] = band_filter(data[:, picks], sampling_rate, high_filt, low_filt, filter_method)
+        return filtered
+
+
+def _decimate_epochs(data, sampling_rate, factor: int, file_name: str):
+    """
+    Decimates data with anti-aliasing filter (see spectral.downsample()).
+    :param data: array of shape (sweeps, channels, samples) which starts at the first sample of the sweep
+    :param sampling_rate: Sampling rate in Hz
+    :param factor: Decimation factor, see spectral.decimation_factor()
+    :param file_name: name of the .abf file, used as a tag of the profiled stage
+    :return: decimated array with the same precision as data, its sampling rate is sampling_rate / factor
+    """
+    with stage('decimate', file=file_name, factor=factor, samples=data.shape[-1]):
+        return downsample(data, sampling_rate, factor)
+
+
+def _full_rate_units(results: list, method: str, factor: int):
+    """
+    Multitaper power with mne 'length' normalization is power density multiplied by the sampling rate, so power of
+    decimated data is multiplied by the decimation factor to be the same as power at the sampling rate of the file.
+    Welch power is power density, which does not depend on the sampling rate.
+    :param results: list of tuples (power, freqs) returned by spectral.psd_mean()
+    :param method: 'multitaper' or 'welch'
+    :param factor: Decimation factor
+    :return: list of tuples (power, freqs)
+    """
+    if method != 'multitaper' or factor == 1:
+        return results
+    return [(power * factor, freqs) for power, freqs in results]
+
+
+def _decimation(sampling_rate, f_max, decimate: bool, method: str):
+    """
+    :param sampling_rate: Sampling rate of the file in Hz
+    :param f_max: Highest frequency of the spectra in Hz
+    :param decimate: the same as in psd_windows()
+    :param method: 'multitaper' or 'welch'. Welch factors divide WELCH_N_FFT, so frequency bins stay the same
+    :return: tuple (factor, n_fft), decimation factor (1 without decimation) and length of Welch FFT of decimated data
+    """
+    if not decimate:
+        return 1, WELCH_N_FFT
+    factor = decimation_factor(sampling_rate, f_max, divides=WELCH_N_FFT if method == 'welch' else None)
+    return factor, WELCH_N_FFT // factor
+
+
+def _window_spectra(file_name: str, channels: list, windows: dict, filter_data, high_filt, low_filt, f_min, f_max,
+                    method, chunk_size=None, precision='float64', filter_method='fir', decimate=False):
+    """
+    Calculates mean power spectra of every time window, see psd_windows().
+    :return: list of tuples (power of shape (channels, freqs) in uV^2, freqs) in the same order as windows
+    """
+    # Only part of epoch which covers every window is loaded. FIR filter is longer than the epoch, so filtering of
+    # short time window would distort its edges and whole epochs are filtered. Transients of IIR filter decay within
+    # a few periods of its cutoff frequency, so IIR_PAD periods of data around the windows are loaded as well.
+    # Decimated samples are counted from the first sample of the sweep, so whole epochs are decimated too
+    t_start = min(t_min for t_min, _ in windows.values())
+    t_stop = max(t_max for _, t_max in windows.values())
+    if decimate or (filter_data and filter_method == 'fir'):
+        t_start = t_stop = None
+    elif filter_data:
+        pad = IIR_PAD / (high_filt if high_filt else low_filt)
+        t_start, t_stop = max(t_start - pad, 0), t_stop + pad
+
+    if chunk_size is not None:
+        # Streaming mode: epochs are read, filtered and transformed chunk by chunk, power is summed over chunks
+        # (see spectral.psd_mean()). Epochs are filtered one by one, so filtering of chunks gives the same data.
+        chunks, sampling_rate = stream_ecog(file_name, chunk_size, channels, t_min=t_start, t_max=t_stop,
+                                            precision=precision)
+        if filter_data:
+            chunks = (_filter_epochs(chunk, sampling_rate, channels, high_filt, low_filt, filter_method, file_name)
+                      for chunk in chunks)
+        factor, n_fft = _decimation(sampling_rate, f_max, decimate, method)
+        if factor > 1:
+            chunks = (_decimate_epochs(chunk, sampling_rate, factor, file_name) for chunk in chunks)
+        sampling_rate, first = sampling_rate / factor, first_sample(t_start, sampling_rate)
+        # Chunks are read (and filtered) while they are transformed, so this stage includes reading of the file
+        with stage('spectra', file=file_name, method=method, windows=len(windows), chunk_size=chunk_size,
+                   precision=precision):
+            chunk = next(chunks)
+            samples = _window_samples(windows, sampling_rate, first, chunk.shape[-1])
+            results = psd_mean(itertools.chain([chunk], chunks), sampling_rate, samples, f_min=f_min, f_max=f_max,
+                               method=method, n_fft=n_fft)
+        return _full_rate_units(results, method, factor)
+
+    data, sampling_rate = _load_array(file_name, channels=channels, t_min=t_start, t_max=t_stop, precision=precision)
+    first = first_sample(t_start, sampling_rate)  # Index of the first loaded sample in the epoch
+    if filter_data:
+        # If filter_data is True, electrophysiology data is filtered with the high and low bandpasses into new array
+        # (loaded data is kept as it is), filter designs are cached (see spectral.band_filter()).
+        # More information about filtering https://mne.tools/stable/generated/mne.filter.filter_data.html
+        data = _filter_epochs(data, sampling_rate, channels, high_filt, low_filt, filter_method, file_name)
+    factor, n_fft = _decimation(sampling_rate, f_max, decimate, method)
+    if factor > 1:
+        # Spectra above f_max are not needed, so transforms of decimated data are factor times shorter
+        data, sampling_rate = _decimate_epochs(data, sampling_rate, factor, file_name), sampling_rate / factor
+
+    # Perform spectral analysis on sensor data, all windows are calculated together (see spectral.py).
+    #  'welch' uses n_fft=1000 - The length of FFT used, must be >= n_per_seg (default: 256). Decimated data uses
+    #  n_fft=1000/factor, so frequencies (and length of segments in seconds) stay the same.
+    #  https://mne.tools/stable/generated/mne.time_frequency.psd_array_welch.html#mne.time_frequency.psd_array_welch
+    #  'multitaper' uses bandwidth=2 - Bandwidth of the multi-taper window function in Hz.
+    #  For a given frequency, frequencies at ± half-bandwidth are smoothed together.
+    # https://mne.tools/stable/generated/mne.time_frequency.psd_array_multitaper.html#mne.time_frequency.psd_array_multitaper
+    samples = _window_samples(windows, sampling_rate, first, data.shape[-1])
+    # psd computes Power spectrum density (PSD) for every epoch, so if we have 100 epochs, after psd
+    # it will output 100 PSDs. psd_mean() returns mean power of every frequency over epochs in uV^2.
+    with stage('spectra', file=file_name, method=method, windows=len(windows), sweeps=data.shape[0],
+               precision=precision):
+        results = psd_mean(data, sampling_rate, samples, f_min=f_min, f_max=f_max, method=method, n_fft=n_fft)
+    return _full_rate_units(results, method, factor)
+
+
+def psd_windows(file_name: str, channels: list, windows=None, filter_data=False, high_filt=0.5, low_filt=100,
+                f_min=0.1, f_max=100, method='multitaper', use_cache=True, chunk_size=None, precision='float64',
+                filter_method='fir', decimate=False):
+    """
+    This function takes one file with ecog recordings and calculates power spectral density (psd) for several epoch
+    time windows at once. The file is imported (and filtered) only once for all windows. Parameters are the same as
+    in psd() function.
+    :param file_name: Name of the .abf file, for example '2022_05_12.abf'
+    :param channels: Name of the channel to calculate the power, for example ['Aux1'].
+    :param windows: Dictionary of named time windows {name: (t_min, t_max)} in seconds. Default is WINDOWS
+    (baseline 0.2-0.9 s and signal 1.2-1.9 s).
+    :param use_cache: If True (default), spectra are taken from the result cache (see result_cache.py) when the same
+    file was already analysed with the same parameters.
+    :param chunk_size: If given, epochs are streamed from the file in chunks of chunk_size sweeps and power is summed
+    chunk by chunk, so memory use does not grow with the length of the recording (see stream_ecog()). Results are the
+    same as without chunks. Default (None) loads every epoch at once.
+    :param precision: 'float64' (default) or 'float32'. With 'float32' recording is loaded and transformed in single
+    precision, which halves memory use, power is still averaged in double precision (see precision_deviation())
+    :param filter_method: 'fir' (default) filters whole epochs with the same FIR filter as mne .filter() does, 'iir'
+    filters windows and IIR_PAD periods of high_filt around them with Butterworth filter (see spectral.band_filter())
+    :param decimate: If True, epochs are low-pass filtered and decimated by the largest factor which keeps f_max below
+    sampling_rate / DECIMATION_MARGIN (8 for 2000 Hz recordings and f_max=100) before spectra are calculated, so
+    transforms are that many times shorter. Welch factors divide WELCH_N_FFT, so Welch spectra keep their
+    frequencies. Window lengths are rounded to decimated samples, so frequencies of multitaper spectra differ
+    slightly, see decimation_deviation() for accuracy. Default is False
+    :return: dictionary {name: dataframe}, dataframes are the same as psd() returns for every window.
+    """
+    if windows is None:
+        windows = WINDOWS
+    if filter_data and filter_method not in FILTER_METHODS:
+        raise ValueError(f"Wrong filter method '{filter_method}', use one of {FILTER_METHODS}")
+
+    if method not in ('welch', 'multitaper'):
+        print("Wrong method!")  # If wrong method is select (for example, type error)
+        # it will print 'Wrong method!' output
+        sys.exit()
+
+    def compute():
+        results = _window_spectra(file_name, channels, windows, filter_data, high_filt, low_filt, f_min, f_max,
+                                  method, chunk_size, precision, filter_method, decimate)
+        arrays = {}
+        for i, (power, freqs) in enumerate(results):
+            arrays[f'power_{i}'], arrays[f'freqs_{i}'] = power, freqs
+        return arrays
+
+    if use_cache:
+        # Every parameter which changes the spectra is a part of the key
+        filter_params = [high_filt, low_filt] + (['iir', IIR_ORDER, IIR_PAD] if filter_method == 'iir' else [])
+        params = {'channels': list(channels), 'windows': [[t_min, t_max] for t_min, t_max in windows.values()],
+                  'filter': filter_params if filter_data else None, 'f_min': f_min, 'f_max': f_max,
+                  'method': method, 'bandwidth': MULTITAPER_BANDWIDTH, 'n_fft': WELCH_N_FFT, 'precision': precision,
+                  'layout': [CHANNEL_NAMES, CHANNEL_TYPES, CHANNEL_ADC_NAMES, CHANNEL_UNITS]}
+        if decimate:  # Key of spectra without decimation stays the same
+            params['decimation'] = [DECIMATION_MARGIN, DECIMATION_ATTENUATION, 'welch_n_fft_divisor']
+        with stage('result_cache', file=file_name, method=method):  # Stages inside are recorded only on cache miss
+            arrays = result_cache.get(file_name, params, compute)
+    else:
+        arrays = compute()
+
+    # Data frames where 1st column is frequency index and other columns specifies power of brain area in uV^2
+    # The column of power is named by brain area
+    spectra = {name: psd_frame(arrays[f'power_{i}'], arrays[f'freqs_{i}'], channels)
+               for i, name in enumerate(windows)}
+    return spectra
+
+
+def _sweep_layout(filename: str):
+    """
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :return: tuple (sampling_rate, samples per sweep) read from the header of the file
+    """
+    reader = open_abf(filename)
+    if reader is not None:
+        return reader.sampling_rate, reader.sweep_length
+    import pyabf
+    abf = pyabf.ABF(filename, loadData=False)
+    return abf.dataRate, abf.sweepPointCount
+
+
+def build_tapers(filenames, windows=None, f_max=100, method='multitaper', decimate=False):
+    """
+    Builds tapers (multitaper) or windows (welch) of every time window at the sampling rates of the files, and
+    anti-aliasing filters if data is decimated, into the cache of spectral.py. Pools of worker processes call it before
+    they start and hand the cache to every worker (see spectral.export_cache()), so workers do not build them again.
+    Files which can not be read are skipped, psd_windows() of the file reports the error.
+    :param filenames: List of .abf files which will be analysed
+    :param windows: Dictionary of named time windows {name: (t_min, t_max)} in seconds. Default is WINDOWS
+    :param f_max: Highest frequency of the spectra in Hz, the same as in psd_windows()
+    :param method: 'multitaper' or 'welch'
+    :param decimate: the same as in psd_windows()
+    """
+    if windows is None:
+        windows = WINDOWS
+    layouts = set()
+    for filename in set(filenames):
+        try:
+            layouts.add(_sweep_layout(filename))
+        except Exception:  # For example, missing or broken file
+            continue
+    for sampling_rate, n_samples in layouts:
+        factor, n_fft = _decimation(sampling_rate, f_max, decimate, method)
+        if factor > 1:
+            antialias_kernel(sampling_rate, factor)
+        for samples in _window_samples(windows, sampling_rate / factor, 0, -(-n_samples // factor)):
+            if method == 'multitaper':
+                multitaper_tapers(samples.stop - samples.start, sampling_rate / factor, MULTITAPER_BANDWIDTH)
+            else:
+                welch_window(samples.stop - samples.start, n_fft)
+
+
 def psd(file_name: str, channels: list, filter_data=False, high_filt=0.5, low_filt=100,
-        f_min=0.1, f_max=100, t_min=1.2, t_max=1.9, method='multitaper'):
+        f_min=0.1, f_max=100, t_min=1.2, t_max=1.9, method='multitaper', use_cache=True, chunk_size=None,
+        precision='float64', filter_method='fir', decimate=False):
     """
     This function takes one file with ecog recordings and calculate power spectral density (psd) for a given epoch time
     (t_min, t_max) and frequency interval (f_min, f_max) choosing from 'multitaper' or 'welch' method. It can filter
@@ -66,60 +547,46 @@ def psd(file_name: str, channels: list, filter_data=False, high_filt=0.5, low_fi
     :param channels: Name of the channel to calculate the power (Default ['Aux1']).
     :param method: Method used to calcualte the power spectrum density plot. 2 possible variants - 'multitaper' and
     'welch'.
+    :param use_cache: If True (default), result is taken from the result cache if it was already calculated
+    :param chunk_size: If given, epochs are processed in chunks of chunk_size sweeps to limit memory use (see
+    psd_windows())
+    :param precision: 'float64' (default) or 'float32' precision of the analysis (see psd_windows())
+    :param filter_method: 'fir' (default, the same filter as mne .filter()) or 'iir' (see psd_windows())
+    :param decimate: If True, data is decimated to the lowest sampling rate which keeps f_max (see psd_windows())
     :return: dataframe object with average power of given channel and file (ecog recording). Columns are named by
     given channels where index values are frequencies of interest.
     """
-    file = import_ecog(file_name)  # imports .abf file as EpochsArray object
-
-    if filter_data:
-        file = file.copy().filter(high_filt, low_filt)  # If filter_data is True this function will take
-        # electrophysiology data and filters it with the high and low bandpasses
-    # More information about filtering https://mne.tools/stable/generated/mne.filter.filter_data.html
-
-    else:
-        pass  # If filter_data is False it will skip filtering function
-
-    if method == 'welch':  # Perform spectral analysis on sensor data
-        power_spectral_density = file.compute_psd(method='welch', fmin=f_min, fmax=f_max,
-                                                  tmin=t_min, tmax=t_max, picks=channels, n_fft=1000)
-        #  n_fft - The length of FFT used, must be >= n_per_seg (default: 256).
-        #  The segments will be zero-padded if n_fft > n_per_seg
-        #  psd returns the spectral representation of each epoch.
-        #  https://mne.tools/stable/generated/mne.time_frequency.psd_array_welch.html#mne.time_frequency.psd_array_welch
-
-    elif method == 'multitaper':
-        power_spectral_density = file.compute_psd(method='multitaper', fmin=f_min, fmax=f_max,
-                                                  tmin=t_min, tmax=t_max, picks=channels, bandwidth=2)
-        #  bandwidth - Half-bandwidth of the multi-taper window function in Hz.
-        #  For a given frequency, frequencies at ± half-bandwidth are smoothed together.
-        # https://mne.tools/stable/generated/mne.time_frequency.psd_array_multitaper.html#mne.time_frequency.psd_array_multitaper
+    return psd_windows(file_name, channels, windows={'psd': (t_min, t_max)}, filter_data=filter_data,
+                       high_filt=high_filt, low_filt=low_filt, f_min=f_min, f_max=f_max, method=method,
+                       use_cache=use_cache, chunk_size=chunk_size, precision=precision,
+                       filter_method=filter_method, decimate=decimate)['psd']
 
 
+def _calc_windows(calc: str):
+    """
+    :param calc: 'baseline', 'signal' or 'ratio'
+    :return: dictionary of time windows (subset of WINDOWS) needed for calc, or None if calc is wrong
+    """
+    if calc == 'ratio':
+        return WINDOWS
+    if calc in WINDOWS:
+        return {calc: WINDOWS[calc]}
+    return None
 
-    else:
-        print("Wrong method!")  # If wrong method is select (for example, type error)
-        # it will print 'Wrong method!' output
-        sys.exit()
 
-    # psd computes Power spectrum density (PSD) for every epoch, so if we have 100 epochs, after psd
-    # it will output 100 PSDs.
-    # 1 PSD consist of frequency column and power column, where each row represents frequency and power of particular
-    # frequency.
-
-    psd_df = power_spectral_density.to_data_frame()  # transforming psd output to data frame for further analysis
-    psd_mean = psd_df.groupby(['freq']).mean(
-        numeric_only=True)  # Group power values by frequency and calculate mean for each frequency
-    psd_mean.drop('epoch', axis=1, inplace=True)  # Drop epoch column which is not necessary for further analysis
-
-    # This `for` cycle converts Power of the channel from V (amplitude) to uV^2 - which is Power
-    for x in channels:
-        psd_mean[x] = (np.sqrt(psd_mean[x]) * 1e6) ** 2
-    # Return data frame where 1st column is frequency index and other columns specifies power of brain area in uV^2
-    # The column of power is named by brain area
-    return psd_mean
+def _calc_power(spectra: dict, calc: str):
+    """
+    :param spectra: dictionary of window spectra returned by psd_windows()
+    :param calc: 'baseline', 'signal' or 'ratio'
+    :return: power of given window or ratio of signal and baseline power
+    """
+    if calc == 'ratio':
+        return spectra['signal'] / spectra['baseline']  # Divides power of signal by baseline
+    return spectra[calc]
 
 
-def psd_calc(files_names: list, channels: list, calc='baseline', filt=False):
+def psd_calc(files_names: list, channels: list, calc='baseline', filt=False, use_cache=True, chunk_size=None,
+             precision='float64'):
     """
     Depending on `calc` type, function calculates mean baseline, signal (response), ratio power of particular
     file_names (ecog recordings) group
@@ -131,52 +598,33 @@ def psd_calc(files_names: list, channels: list, calc='baseline', filt=False):
     seconds.
     "ratio" takes "signal" and "baseline" power results and divides signal/baseline.
     :param filt: If filt parameter is True, then it uses filter which is described in 'psd' function
+    :param use_cache: If True (default), spectra of files are taken from the result cache if they were already
+    calculated
+    :param chunk_size: If given, epochs are processed in chunks of chunk_size sweeps to limit memory use (see
+    psd_windows())
+    :param precision: 'float64' (default) or 'float32' precision of the analysis (see psd_windows())
     :return: Returns data frame where medium baseline, response or ratio calculated from given .abf file list
     """
-    if calc == 'baseline':
-
-        df = psd(files_names[0], t_min=0.2, t_max=0.9, filter_data=filt,
-                 channels=channels)  # Calls psd() function and takes first filename to create dataframe
-
-        for x in range(1, len(files_names)):  # Iterates through every filename and put it in the psd()
-            # function where it calculates baseline power
-            # for a given mouse and add the result to the created dataframee
-            df += psd(files_names[x], t_min=0.2, t_max=0.9, filter_data=filt, channels=channels)
-
-    elif calc == 'signal':
-
-        df = psd(files_names[0], t_min=1.2, t_max=1.9, filter_data=filt,
-                 channels=channels)  # Calls psd() function and takes first filename to create dataframe
-        for x in range(1, len(files_names)):  # Iterates through every filename and put it in the psd()
-            # function where it calculates response power
-            # for a given mouse and add the result to the created dataframee
-            df += psd(files_names[x], t_min=1.2, t_max=1.9, filter_data=filt, channels=channels)
-
-    elif calc == 'ratio':
-
-        df_baseline = psd(files_names[0], t_min=0.2, t_max=0.9, filter_data=filt, channels=channels)
-        df_signal = psd(files_names[0], t_min=1.2, t_max=1.9, filter_data=filt, channels=channels)
-        df = df_signal / df_baseline  # Divides power of signal by baseline and use this df for iteration
-
-        for x in range(1, len(files_names)):  # Iterates through every filename and put it in the psd()
-            # function where it calculates ratio power
-            # for a given mouse and add the result to the created dataframee
-            df_baseline = psd(files_names[x], t_min=0.2, t_max=0.9, filter_data=filt, channels=channels)
-            df_signal = psd(files_names[x], t_min=1.2, t_max=1.9, filter_data=filt, channels=channels)
-            df_ratio = df_signal / df_baseline
-            df += df_ratio
-
-    else:  # If wrong 'calc' type were given it will print given string and returns 0
+    windows = _calc_windows(calc)
+    if windows is None:  # If wrong 'calc' type were given it will print given string and returns 0
         print("Wrong calc parameter!")
         return 0
 
+    df = None
+    for file_name in files_names:  # Iterates through every filename, calculates power of every needed window
+        # with one psd_windows() call and adds the result to the dataframe
+        spectra = psd_windows(file_name, channels=channels, windows=windows, filter_data=filt, use_cache=use_cache,
+                              chunk_size=chunk_size, precision=precision)
+        df = _calc_power(spectra, calc) if df is None else df + _calc_power(spectra, calc)
+
     df_final = df / len(files_names)  # Calculated mean power
 
     return df_final
 
 
 def psd_frequency_bands(filename: str, channels: list, mouse_name: str, experiment_phase='default_phase',
-                        calc='baseline', frequency_40=False, all_freq=False):
+                        calc='baseline', frequency_40=False, all_freq=False, use_cache=True, chunk_size=None,
+                        precision='float64', bands=None):
     """
     This function calculates power for every ecog record (filename). Power of 40 Hz frequency band, baseline and
     response (signal) can be calculated.
@@ -191,6 +639,12 @@ def psd_frequency_bands(filename: str, channels: list, mouse_name: str, experime
     :param frequency_40: If True, it extracts mean power of frequency range between (38-42) Hz
     default value is False
     :param all_freq: If True, it extracts every frequency we get from psd function.
+    :param use_cache: If True (default), spectra are taken from the result cache if they were already calculated
+    :param chunk_size: If given, epochs are processed in chunks of chunk_size sweeps to limit memory use (see
+    psd_windows())
+    :param precision: 'float64' (default) or 'float32' precision of the analysis (see psd_windows())
+    :param bands: List of frequency bands (bands.Band objects), for example [Band('gamma', 30, 90)]. Default (None)
+    is ASSR_BAND if frequency_40 is True, otherwise FREQUENCY_BANDS
     :return: DataFrame object. Columns - freq (index), channel_name (represent power), calc (calc method used), mouse
     (name of the mouse), experiment_phase.
     """
@@ -198,47 +652,26 @@ def psd_frequency_bands(filename: str, channels: list, mouse_name: str, experime
     # Depending on calc string value applied, if 'baseline', 'signal' (response) or 'ratio' were chosen then
     # it will calculate power spectral density subject to calc. If typo occur it will print 'Wrong 'calc' type'
     # and function returns None.
-    if calc == 'baseline':
-        psd_file = psd(filename, channels=channels, f_min=0, f_max=101, t_min=0.2, t_max=0.9)
-
-    elif calc == 'signal':
-        psd_file = psd(filename, channels=channels, f_min=0, f_max=101, t_min=1.2, t_max=1.9)
-
-    elif calc == 'ratio':
-        psd_file_baseline = psd(filename, channels=channels, f_min=0, f_max=101, t_min=0.2, t_max=0.9)
-        psd_file_signal = psd(filename, channels=channels, f_min=0, f_max=101, t_min=1.2, t_max=1.9)
-        psd_file = psd_file_signal / psd_file_baseline
-
-    else:
+    windows = _calc_windows(calc)
+    if windows is None:
         print("Wrong 'calc' type!")
         return None
-
-    # This part of function determine which frequency range of psd we need. If we give frequency_40=True, this part then
-    # takes mean of frequency range between 38 and 42 and put it into dataframe.
-    if frequency_40:
-        freq = psd_file[(psd_file.index > 38) & (psd_file.index < 42)].mean()
-        freq['band_name'] = '40 hz'
-        new_df = pd.DataFrame([freq])
-    # If all_freq True then it takes all frequencies and put it into df without any splicing.
-    elif all_freq:
-        new_df = pd.DataFrame(psd_file)
-    # If all_freq and frequency_40 are False then function splits frequencies into delta, theta, alpha, beta, low_gamma,
-    # high_gamma frequencies and calculates mean power for every frequency band.
+    # For 'ratio' baseline and signal spectra are calculated with one psd_windows() call
+    spectra = psd_windows(filename, channels=channels, windows=windows, f_min=0, f_max=101, use_cache=use_cache,
+                          chunk_size=chunk_size, precision=precision)
+    psd_file = _calc_power(spectra, calc)
+
+    # This part of function determine which frequency range of psd we need. If we give frequency_40=True, it takes
+    # mean of frequency range between 38 and 42 Hz (ASSR_BAND). If all_freq True then it takes all frequencies and
+    # put it into df without any splicing. Otherwise mean power of every band of the band table (default
+    # FREQUENCY_BANDS: delta, theta, alpha, beta, low_gamma, high_gamma) is calculated at once (see bands.py).
+    if all_freq:
+        new_df = psd_file.copy(deep=False)
     else:
-        delta = psd_file[(psd_file.index >= 0) & (psd_file.index <= 4)].mean()
-        delta['band_name'] = 'delta'
-        theta = psd_file[(psd_file.index >= 4) & (psd_file.index <= 8)].mean()
-        theta['band_name'] = 'theta'
-        alpha = psd_file[(psd_file.index >= 8) & (psd_file.index <= 12)].mean()
-        alpha['band_name'] = 'alpha'
-        beta = psd_file[(psd_file.index >= 12) & (psd_file.index <= 30)].mean()
-        beta['band_name'] = 'beta'
-        low_gamma = psd_file[(psd_file.index >= 30) & (psd_file.index <= 45)].mean()
-        low_gamma['band_name'] = 'low gamma'
-        high_gamma = psd_file[(psd_file.index >= 55) & (psd_file.index <= 90)].mean()
-        high_gamma['band_name'] = 'high gamma'
-
-        new_df = pd.DataFrame([delta, theta, alpha, beta, low_gamma, high_gamma])
+        if bands is None:
+            bands = ASSR_BAND if frequency_40 else FREQUENCY_BANDS
+        with stage('band_table', file=filename, calc=calc, bands=len(bands)):
+            new_df = band_table(psd_file, bands)
 
     # To improve our DataFrame we append columns with calculation name, mouse name and experiment phase.
     new_df['calc'] = calc
@@ -268,22 +701,149 @@ def psd_frequency_bands(filename: str, channels: list, mouse_name: str, experime
         return new_df
 
 
-def calc_itpc_power(data: str):
+def calc_itpc_power(data: str, precision='float64', freqs=None, decim=1, output='both', n_jobs=1, decimate=False):
     """
     This function calculates power and inter trial coherence (itc, also named phase-locking factor (plf) and return
-    a tuple of it.
+    a tuple of it. Transform is the same as mne tfr_morlet() (see tfr.morlet_power_itc()).
     :param data: abf. file e.g. 'experiment_one.abf'
+    :param precision: 'float64' (default) or 'float32'. 'float32' halves memory of the transform and returned arrays.
+    :param freqs: Frequencies of interest in Hz, default (None) is ITPC_FREQS (20-90 Hz). Number of cycles of every
+    frequency is taken from ITPC_N_CYCLES, so results of every frequency are the same as in the default calculation,
+    for example, freqs=np.linspace(20, 70, 51) gives first 51 rows of default power.
+    :param decim: Only every decim-th time point is kept in the results, for example, decim=4 keeps every 4th sample
+    :param output: 'both' (default) returns (power, itc), 'power' returns only power and 'itc' returns only itc, so
+    unneeded result is not calculated
+    :param n_jobs: Number of threads which calculate channels and frequencies in parallel, -1 uses every CPU core
+    :param decimate: If True, epochs are low-pass filtered and decimated by the largest factor which keeps every
+    frequency of the wavelets (see spectral.decimation_factor(), 8 for 2000 Hz recordings and default freqs) before
+    the transform, so wavelet convolutions are that many times shorter. Results have every factor-th time point
+    (decim is applied on top of it). Default is False
     :return: tuple object with list of matrices. One list of power and other of itc. Length of every list represent
     epoch time steps.
     """
-    freqs = np.linspace(20, 90, 71)  # Frequencies of interest in Hz
-    n_cycles = np.logspace(*np.log10([7, 30]), 71)  # Number of cycles in the wavelet, either
-    # a fixed number or one per frequency.
+    if freqs is None:
+        freqs = ITPC_FREQS
+    freqs = np.asarray(freqs, dtype=float)
+    # Number of cycles of every frequency is interpolated from default ones (the same values at default frequencies)
+    n_cycles = np.interp(freqs, ITPC_FREQS, ITPC_N_CYCLES)
     # For more information about parameters look at:
     # https://mne.tools/stable/generated/mne.time_frequency.tfr_morlet.html
-    power, itc = mne.time_frequency.tfr_morlet(data, freqs=freqs, n_cycles=n_cycles, use_fft=True,
-                                               return_itc=True, n_jobs=1)
-    return power, itc
+    mne = _mne()
+    picks = mne.pick_types(data.info, ecog=True, eeg=True, seeg=True, dbs=True)  # Data channels as in tfr_morlet
+    info = mne.pick_info(data.info, picks)
+    epochs, sampling_rate, factor = data.get_data(picks=picks), info['sfreq'], 1
+    if decimate:
+        # Spectrum of Morlet wavelet is Gaussian with standard deviation freq / n_cycles, 3 of them are kept
+        factor = decimation_factor(sampling_rate, np.max(freqs * (1 + 3 / n_cycles)))
+        with stage('decimate', factor=factor, samples=epochs.shape[-1]):
+            epochs = downsample(epochs, sampling_rate, factor)
+    with stage('morlet', sweeps=len(data), channels=len(picks), freqs=len(freqs), precision=precision, decim=decim,
+               output=output, n_jobs=n_jobs, decimation=factor):
+        power_data, itc_data = morlet_power_itc(epochs, sampling_rate / factor, freqs, n_cycles,
+                                                dtype=PRECISIONS[precision], decim=decim, output=output,
+                                                n_jobs=n_jobs)
+    if power_data is not None and factor > 1:
+        power_data *= factor  # Wavelets have unit norm, so power is proportional to the sampling rate of the data
+    times = data.times[::factor][::decim]
+    results = [average_tfr(info, result, times, freqs, len(data)) for result in (power_data, itc_data)
+               if result is not None]
+    return tuple(results) if output == 'both' else results[0]
+
+
+def calc_assr(data, freqs=None, windows=None, precision='float64'):
+    """
+    Calculates 40 Hz auditory steady-state response (ASSR) parameters of every channel: mean power of ASSR_FREQS in
+    baseline and response (signal) time windows, their ratio and phase locking factor (plf) in response window.
+    Values are close to means of calc_itpc_power() power and itc over these frequencies and windows (relative
+    deviation below about 1e-3), but only frequencies around the stimulation frequency and every few time points are
+    calculated (see tfr.assr_power_plf()).
+    :param data: EpochsArray object, for example, import_ecog('2022_05_12.abf')
+    :param freqs: Frequencies of interest in Hz, default (None) is ASSR_FREQS (39-41 Hz)
+    :param windows: Dictionary with 'baseline' and 'signal' time windows (in seconds), default is WINDOWS
+    :param precision: 'float64' (default) or 'float32'
+    :return: DataFrame indexed by channel (brain_area) with columns baseline_mean, response_mean, ratio and plf
+    """
+    if freqs is None:
+        freqs = ASSR_FREQS
+    if windows is None:
+        windows = WINDOWS
+    freqs = np.asarray(freqs, dtype=float)
+    n_cycles = np.interp(freqs, ITPC_FREQS, ITPC_N_CYCLES)  # The same wavelets as in calc_itpc_power()
+    picks = _mne().pick_types(data.info, ecog=True, eeg=True, seeg=True, dbs=True)  # Data channels as in tfr_morlet
+    sampling_rate = data.info['sfreq']
+    samples = _window_samples({name: windows[name] for name in ('baseline', 'signal')}, sampling_rate,
+                              first_sample(data.tmin, sampling_rate), len(data.times))
+    with stage('assr', sweeps=len(data), channels=len(picks), freqs=len(freqs), precision=precision):
+        power, plf = assr_power_plf(data.get_data(picks=picks), sampling_rate, freqs, n_cycles, samples,
+                                    dtype=PRECISIONS[precision])
+    import pandas as pd
+    table = pd.DataFrame({'baseline_mean': power[0], 'response_mean': power[1], 'ratio': power[1] / power[0],
+                          'plf': plf[1]}, index=pd.Index([data.ch_names[i] for i in picks], name='brain_area'))
+    return table
+
+
+def precision_deviation(file_name: str, channels: list, precision='float32'):
+    """
+    Compares results calculated with given precision with float64 results of the same file.
+    :param file_name: Name of the .abf file, for example '2022_05_12.abf'
+    :param channels: Channels of interest, for example ['Aux1', 'PFC']
+    :param precision: Precision to check, see PRECISIONS
+    :return: dictionary of maximum relative deviation of multitaper and welch psd, frequency band ratio and tfr power
+    and maximum absolute deviation of itc
+    """
+    def relative(a, b):
+        return float(np.nanmax(np.abs(np.asarray(a, dtype=float) / np.asarray(b, dtype=float) - 1)))
+
+    deviation = {}
+    for method in ('multitaper', 'welch'):
+        spectra = [psd_windows(file_name, channels, method=method, use_cache=False, precision=p)
+                   for p in ('float64', precision)]
+        deviation[f'psd_{method}'] = max(relative(spectra[1][name], spectra[0][name]) for name in WINDOWS)
+    bands = [psd_frequency_bands(file_name, channels, 'mouse', calc='ratio', use_cache=False, precision=p)
+             for p in ('float64', precision)]
+    deviation['band_ratio'] = relative(bands[1]['Ratio'], bands[0]['Ratio'])
+    epochs = import_ecog(file_name, channels=channels)
+    (power, itc), (power_p, itc_p) = calc_itpc_power(epochs), calc_itpc_power(epochs, precision=precision)
+    deviation['tfr_power'] = relative(power_p.data, power.data)
+    deviation['itc'] = float(np.abs(itc_p.data - itc.data).max())
+    return deviation
+
+
+def decimation_deviation(file_name: str, channels: list, f_max=100):
+    """
+    Compares results calculated from decimated data (decimate=True) with results at full sampling rate of the same
+    file. Welch spectra have the same frequencies (f_min-f_max of psd()) and are compared frequency by frequency.
+    Window lengths of decimated data are rounded to decimated samples, so frequencies of multitaper spectra differ
+    slightly and only power of FREQUENCY_BANDS is compared. Tfr is compared at time points of decimated tfr where
+    the longest wavelet (5 standard deviations of its envelope on both sides) fits into the epoch.
+    :param file_name: Name of the .abf file, for example '2022_05_12.abf'
+    :param channels: Channels of interest, for example ['Aux1', 'PFC']
+    :param f_max: Highest frequency of spectra in Hz
+    :return: dictionary of maximum relative deviation of welch psd, band power of multitaper and welch spectra and
+    tfr power, maximum absolute deviation of itc and decimation factors of multitaper and welch spectra and tfr
+    """
+    def relative(a, b):
+        return float(np.nanmax(np.abs(np.asarray(a, dtype=float) / np.asarray(b, dtype=float) - 1)))
+
+    deviation = {}
+    for method in ('multitaper', 'welch'):
+        full, decimated = [psd_windows(file_name, channels, f_max=f_max, method=method, use_cache=False, decimate=d)
+                           for d in (False, True)]
+        if method == 'welch':
+            deviation['psd_welch'] = max(relative(decimated[name], full[name]) for name in WINDOWS)
+        deviation[f'bands_{method}'] = max(relative(band_table(decimated[name])[channels],
+                                                    band_table(full[name])[channels]) for name in WINDOWS)
+    epochs = import_ecog(file_name, channels=channels)
+    (power, itc), (power_d, itc_d) = calc_itpc_power(epochs), calc_itpc_power(epochs, decimate=True)
+    factor = round((power_d.times[1] - power_d.times[0]) * epochs.info['sfreq'])
+    margin = 5 * np.max(ITPC_N_CYCLES / (2 * np.pi * ITPC_FREQS))  # Half length of the longest wavelet in seconds
+    inside = (power_d.times >= power_d.times[0] + margin) & (power_d.times <= power_d.times[-1] - margin)
+    deviation['tfr_power'] = relative(power_d.data[..., inside], power.data[..., ::factor][..., inside])
+    deviation['itc'] = float(np.abs(itc_d.data[..., inside] - itc.data[..., ::factor][..., inside]).max())
+    deviation['psd_factor'] = _decimation(epochs.info['sfreq'], f_max, True, 'multitaper')[0]
+    deviation['welch_factor'] = _decimation(epochs.info['sfreq'], f_max, True, 'welch')[0]
+    deviation['tfr_factor'] = factor
+    return deviation
 
 
 # Further functions are used for data analysis purposes.
@@ -295,20 +855,26 @@ def table_of_frequency_bands(data_list: list, channels: list, mice_names: list,
     of many experiments of a particular day.
     :param data_list: List of .abf files. For example: ['file1.abf', 'file2.abf', 'file3.abf']
     :param channels: List of channels. For example: ['Aux1', 'PFC'], if one channel ['Aux1']
-    :param mice_names: List of mice names. For example: ['M1', 'M2', 'M3']
+    :param mice_names: List of mice names. For example: ['M1', 'M2', 'M3'], one name of every file
     :param experiment_phase: Name of experiment phase. For example: 'Daytime'
     :param calc: One of the option: 'baseline', 'signal' (response) or 'ratio'
     :param freq_40: True if we want to extract frequency range (38:42) Hz
-    :return: DataFrame object.
+    :return: DataFrame object. Columns mouse, experiment_phase, band_name, calc and brain_area are categorical.
     """
-    table = psd_frequency_bands(data_list[0], channels=channels, mouse_name=mice_names[0],
-                                experiment_phase=experiment_phase, calc=calc, frequency_40=freq_40)
-    for num in range(1, len(data_list)):
-        psd_data = psd_frequency_bands(data_list[num], channels=channels, mouse_name=mice_names[num],
+    if len(data_list) != len(mice_names):
+        raise ValueError(f"There are {len(data_list)} files, but {len(mice_names)} mice names")
+    # Results of every file are collected into columnar arrays and the table is created once (see table_builder.py)
+    value_name = 'Ratio' if calc == 'ratio' else 'Power'
+    builder = LongTableBuilder(['mouse', 'experiment_phase', 'band_name', 'calc', 'brain_area'], [value_name],
+                               capacity=len(data_list) * len(channels) * len(FREQUENCY_BANDS))
+    for filename, mouse_name in zip(data_list, mice_names):
+        psd_data = psd_frequency_bands(filename, channels=channels, mouse_name=mouse_name,
                                        experiment_phase=experiment_phase, calc=calc, frequency_40=freq_40)
-        table = pd.concat([table, psd_data])
+        if psd_data is None:  # Wrong calc parameter
+            return None
+        builder.append(psd_data)
 
-    return table
+    return builder.build()
 
 
 def filter_table(table, band: str, brain_area: str):
@@ -321,4 +887,4 @@ def filter_table(table, band: str, brain_area: str):
     :return: DataFrame of frequency band power and brain area.
     """
     filtered_table = table[(table['band_name'] == band) & (table['brain_area'] == brain_area)]
-    return filtered_table
+    return remove_unused_categories(filtered_table)
@@ -0,0 +1,226 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource  # High-water mark of RSS of the process, not available on Windows
+except ImportError:
+    resource = None
+
+# Set environment variable ECOG_PROFILE=1 to record stages from the start (ECOG_PROFILE=memory also traces allocations)
+PROFILE = os.environ.get('ECOG_PROFILE', '').lower()
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024  # Bytes in one unit of ru_maxrss (kilobytes on Linux)
+
+_DISABLED = nullcontext()  # Returned by stage() when profiler is disabled, so disabled stages cost one attribute check
+
+
+def _process_peak_rss():
+    # Peak resident set size of the process since it started (its high-water mark, not the peak of one stage) in
+    # bytes, None if it is not available
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT if resource is not None else None
+
+
+class _Stage:
+    # One running stage, created by StageProfiler.stage()
+
+    def __init__(self, profiler, name: str, tags: dict):
+        self.profiler = profiler
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        profiler = self.profiler
+        stack = profiler._stack()
+        self.parent = stack[-1] if stack else None
+        self.child_wall = 0.0
+        self.peak = 0
+        if profiler.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, peak)  # Peak of the parent before it is reset for the child
+            tracemalloc.reset_peak()
+            self.memory = current
+        else:
+            self.memory = None
+        stack.append(self)
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        profiler = self.profiler
+        profiler._stack().pop()
+        allocated = peak = None
+        if self.memory is not None and tracemalloc.is_tracing():
+            current, traced_peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, traced_peak)
+            allocated, peak = current - self.memory, self.peak - self.memory
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+        if self.parent is not None:
+            self.parent.child_wall += wall
+        profiler.records.append({'stage': self.name, 'parent': self.parent.name if self.parent is not None else None,
+                                 'start': self.start - profiler.origin, 'wall': wall,
+                                 'self_wall': wall - self.child_wall, 'cpu': cpu, 'allocated': allocated,
+                                 'peak_allocated': peak, 'process_peak_rss': _process_peak_rss(),
+                                 'error': exc_type.__name__ if exc_type is not None else None, 'pid': os.getpid(),
+                                 'thread': threading.get_ident(), 'tags': self.tags})
+        return False
+
+
+class StageProfiler:
+    """
+    Opt-in recorder of analysis stages (decoding of .abf files, EpochsArray construction, filtering, spectra, TFR and
+    tables, see power_calculation.py). Every call of a stage records wall time, CPU time, bytes allocated and peak
+    allocation of the stage (only if memory tracing is on, it slows Python allocations down), the high-water mark of
+    RSS of the process when the stage ended (the peak since the process started, so it includes earlier stages and
+    never decreases) and tags, such as file and parameters. When the profiler is disabled, stages record nothing and
+    cost one attribute check. Stages of worker processes (batch_runner.py, study_pipeline.py) are recorded in the
+    workers, use n_workers=1 to profile the whole run in one process.
+    """
+
+    def __init__(self, enabled=False, memory=False):
+        """
+        :param enabled: If True, stages are recorded
+        :param memory: If True, allocations are traced with tracemalloc
+        """
+        self.enabled = False
+        self.memory = False
+        self.records = []
+        self.origin = time.perf_counter()  # Start times of records are relative to this time
+        self._local = threading.local()
+        self._started_tracing = False
+        if enabled:
+            self.enable(memory)
+
+    def _stack(self):
+        # Running stages of this thread
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def enable(self, memory=False):
+        """
+        Starts recording of stages.
+        :param memory: If True, allocations are traced with tracemalloc
+        """
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stops recording of stages, recorded stages are kept.
+        """
+        self.enabled = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self.memory = False
+
+    def clear(self):
+        """
+        Removes recorded stages.
+        """
+        self.records = []
+        self.origin = time.perf_counter()
+
+    def stage(self, name: str, **tags):
+        """
+        Context manager which records one call of a stage. For example,
+        with profiler.stage('decode_abf', file=filename): ...
+        :param name: Name of the stage
+        :param tags: Values which identify the call, for example, file name and parameters
+        :return: context manager
+        """
+        if not self.enabled:
+            return _DISABLED
+        return _Stage(self, name, tags)
+
+    def to_frame(self):
+        """
+        :return: DataFrame with one row per recorded call, tags are columns with 'tag_' prefix. Times are in seconds
+        and memory in bytes
+        """
+        import pandas as pd
+        rows = [{**{key: value for key, value in record.items() if key != 'tags'},
+                 **{f'tag_{key}': value for key, value in record['tags'].items()}} for record in self.records]
+        return pd.DataFrame(rows)
+
+    def summary(self):
+        """
+        :return: DataFrame indexed by stage with number of calls, total and mean wall time, total self time (without
+        nested stages) and its share of all recorded time, total CPU time, allocated bytes, maximum peak allocation
+        and the process RSS high-water mark when the last call ended (not a peak of the stage itself, use
+        peak_allocated with memory tracing for that). Sorted by self time, so stages which dominate are first
+        """
+        import pandas as pd
+        table = self.to_frame()
+        if table.empty:
+            return pd.DataFrame()
+        summary = table.groupby('stage').agg(calls=('wall', 'size'), wall=('wall', 'sum'),
+                                             wall_mean=('wall', 'mean'), self_wall=('self_wall', 'sum'),
+                                             cpu=('cpu', 'sum'), allocated=('allocated', 'sum'),
+                                             peak_allocated=('peak_allocated', 'max'),
+                                             process_peak_rss=('process_peak_rss', 'max'))
+        summary['self_share'] = summary['self_wall'] / summary['self_wall'].sum()
+        return summary.sort_values('self_wall', ascending=False)
+
+    def export_trace(self, filename: str):
+        """
+        Writes recorded stages into .json file in Chrome trace event format, which can be opened in chrome://tracing
+        or https://ui.perfetto.dev as a timeline of nested stages. Measurements and tags are in event arguments.
+        :param filename: name of the .json file
+        """
+        events = []
+        for record in self.records:
+            arguments = {key: record[key]
+                         for key in ('cpu', 'allocated', 'peak_allocated', 'process_peak_rss', 'error')}
+            arguments.update(record['tags'])
+            events.append({'name': record['stage'], 'ph': 'X', 'ts': record['start'] * 1e6,
+                           'dur': record['wall'] * 1e6, 'pid': record['pid'], 'tid': record['thread'],
+                           'args': arguments})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+profiler = StageProfiler(enabled=PROFILE not in ('', '0', 'false'), memory=PROFILE == 'memory')
+
+
+def stage(name: str, **tags):
+    """
+    Records one call of a stage with the module profiler, see StageProfiler.stage().
+    """
+    return profiler.stage(name, **tags)
+
+
+@contextmanager
+def profiling(memory=False, clear=True):
+    """
+    Records stages of the code inside the block. For example,
+    with profiling() as recorded:
+        psd_calc(files, ['Aux1', 'PFC'])
+    print(recorded.summary())
+    recorded.export_trace('trace.json')
+    :param memory: If True, allocations are traced with tracemalloc
+    :param clear: If True (default), stages recorded before are removed
+    :return: the module profiler (StageProfiler)
+    """
+    if clear:
+        profiler.clear()
+    enabled, traced = profiler.enabled, profiler.memory  # State of the profiler before the block is restored
+    profiler.enable(memory=memory or traced)
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if enabled:
+            profiler.enable(traced)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+from batch_runner import BandJob, run_band_jobs, failed_jobs
+from study_manifest import INDEX_COLUMNS, query_manifest
+
+# Columns (or index levels) which identify a value of psd_frequency_bands() tables. Ratio pairs rows which have the
+# same values of every key found in both tables
+RATIO_KEYS = ['week', 'drug', 'phase', 'mouse', 'calc', 'brain_area', 'band_name', 'freq']
+MISSING = ('nan', 'drop', 'raise')  # What condition_ratio() does with rows which have no pair
+
+
+def _key_values(frame, key: str):
+    # Key can be a column or a level of the index (for example, 'freq' of psd_frequency_bands(all_freq=True))
+    if key in frame.columns:
+        return frame[key].to_numpy()
+    return frame.index.get_level_values(key).to_numpy()
+
+
+def _has_key(frame, key: str):
+    return key in frame.columns or key in frame.index.names
+
+
+def condition_ratio(numerator, denominator, values: list, keys=None, missing='nan'):
+    """
+    Divides values of one condition by values of another condition (for example, Ketamine by Saline). Rows are paired
+    by keys, not by position or index, so tables of many mice with repeating frequencies are divided correctly in any
+    row order. Every row is divided at once.
+    :param numerator: Table of the numerator condition, for example, psd_frequency_bands() results of Ketamine mice
+    :param denominator: Table of the denominator condition in the same format
+    :param values: Columns which are divided, for example ['Aux1'] (all_freq=True tables) or ['Power']
+    :param keys: Columns or index levels which pair rows, for example ['mouse', 'freq']. Default is every key of
+    RATIO_KEYS found in both tables
+    :param missing: Numerator rows without a pair in the denominator: 'nan' (default) keeps them with NaN ratio,
+    'drop' removes them, 'raise' raises ValueError
+    :return: copy of numerator table where values are replaced by ratios
+    """
+    if missing not in MISSING:
+        raise ValueError(f"Wrong missing '{missing}', use one of {MISSING}")
+    if keys is None:
+        keys = [key for key in RATIO_KEYS if _has_key(numerator, key) and _has_key(denominator, key)]
+    if not keys:
+        raise ValueError("Tables have no common keys to pair rows")
+    numerator_keys = pd.MultiIndex.from_arrays([_key_values(numerator, key) for key in keys], names=keys)
+    denominator_keys = pd.MultiIndex.from_arrays([_key_values(denominator, key) for key in keys], names=keys)
+    if denominator_keys.has_duplicates:
+        duplicates = denominator_keys[denominator_keys.duplicated()].unique()[:5].tolist()
+        raise ValueError(f"Denominator has more than one row of the same keys {keys}, for example {duplicates}")
+
+    positions = denominator_keys.get_indexer(numerator_keys)
+    found = positions >= 0
+    if missing == 'raise' and not found.all():
+        unpaired = numerator_keys[~found][:5].tolist()
+        raise ValueError(f"{(~found).sum()} numerator rows have no pair in denominator, for example {unpaired}")
+
+    numerator_values = numerator[values].to_numpy(dtype=float)
+    denominator_values = np.full_like(numerator_values, np.nan)
+    denominator_values[found] = denominator[values].to_numpy(dtype=float)[positions[found]]
+    result = numerator.copy()
+    result[values] = numerator_values / denominator_values
+    if missing == 'drop':
+        result = result[found]
+    return result
+
+
+def _condition_table(manifest, condition: dict, channels: list, calc: str, all_freq: bool, experiment_phase: str,
+                     n_workers):
+    # Calculates psd_frequency_bands() of every manifest row of the condition and adds manifest keys as columns
+    rows = query_manifest(manifest, **condition)
+    jobs = [BandJob(row.path, row.mouse, experiment_phase, calc, list(channels), False, all_freq)
+            for row in rows.itertuples(index=False)]
+    results = run_band_jobs(jobs, n_workers=n_workers)
+    failed = failed_jobs(results)
+    if failed:
+        raise RuntimeError(f"{len(failed)} recordings of {condition} failed, first error:\n{failed[0].error}")
+    tables = [result.result.assign(**{column: getattr(row, column) for column in INDEX_COLUMNS})
+              for row, result in zip(rows.itertuples(index=False), results)]
+    return pd.concat(tables)
+
+
+def study_ratio(manifest, numerator: dict, denominator: dict, channels: list, calc='baseline', all_freq=False,
+                experiment_phase=None, missing='nan', n_workers=1):
+    """
+    Calculates ratio of power of two conditions of the study manifest, for example, Ketamine / Saline of the same
+    mouse, week and phase: study_ratio(manifest, {'drug': 'Ketamine'}, {'drug': 'Saline'}, ['Aux1']). Conditions can
+    differ in any manifest level, for example, {'week': 'week_2', 'drug': 'Ketamine'} / {'week': 'week_0',
+    'drug': 'Ketamine'}. Rows are paired by manifest levels which are not given in the conditions and by
+    brain_area, band_name or freq.
+    :param manifest: DataFrame returned by study_manifest.study_manifest()
+    :param numerator: Dictionary of manifest levels (week, drug, phase, mouse) of the numerator condition
+    :param denominator: Dictionary of manifest levels of the denominator condition
+    :param channels: List of channels, for example ['Aux1']
+    :param calc: 'baseline', 'signal' or 'ratio' (see psd_frequency_bands())
+    :param all_freq: If True, ratio of every frequency is calculated, otherwise ratio of every frequency band
+    :param experiment_phase: Name written to experiment_phase column, default is values of numerator joined by ' '
+    :param missing: 'nan', 'drop' or 'raise', see condition_ratio()
+    :param n_workers: Number of worker processes (see batch_runner.run_band_jobs())
+    :return: numerator table (psd_frequency_bands() format with week, drug and phase columns) with ratios
+    """
+    if experiment_phase is None:
+        experiment_phase = ' '.join(str(value) for value in numerator.values())
+    tables = [_condition_table(manifest, condition, channels, calc, all_freq, experiment_phase, n_workers)
+              for condition in (numerator, denominator)]
+    levels = set(numerator) | set(denominator)
+    keys = [key for key in RATIO_KEYS if key not in levels and _has_key(tables[0], key)]
+    values = list(channels) if all_freq else ['Ratio' if calc == 'ratio' else 'Power']
+    return condition_ratio(*tables, values=values, keys=keys, missing=missing)
@@ -0,0 +1,175 @@
+import functools
+import hashlib
+import importlib
+import json
+import os
+from importlib import metadata
+import numpy as np
+from ecog_cache import CACHE_DIR
+
+RESULT_DIR = os.path.join(CACHE_DIR, 'results')  # Folder where calculated spectra are stored as .npz files
+DISK_LIMIT = 1024 ** 3  # Maximum size (in bytes) of stored results, default 1 GiB
+RESULT_VERSION = 1  # Increase when calculation of spectra changes, so results of older code go stale
+
+
+def _version(name: str):
+    # Version of installed package, read from its metadata, so the package (for example, mne) is not imported
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:  # Package is not installed as a distribution, for example, it is on sys.path
+        return importlib.import_module(name).__version__
+
+
+@functools.lru_cache(maxsize=None)
+def library_versions():
+    """
+    :return: dictionary of versions of the libraries which affect calculated spectra
+    """
+    return {'numpy': np.__version__, 'scipy': _version('scipy'), 'mne': _version('mne'),
+            'pyabf': _version('pyabf'), 'result_version': RESULT_VERSION}
+
+
+def result_key(filename: str, params: dict):
+    """
+    Creates the key which identifies calculated result: identity of .abf file (path, size and modification time),
+    every analysis parameter and versions of libraries.
+    :param filename: name of the .abf file, for example, '2022_05_12.abf'
+    :param params: dictionary of analysis parameters (must be json serializable)
+    :return: tuple (key, digest), where key is json string and digest is its sha1 hash used as a file name
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = json.dumps([path, stat.st_size, stat.st_mtime_ns, params, library_versions()], sort_keys=True)
+    return key, hashlib.sha1(key.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of calculated spectra. Every result is a set of named arrays stored in one uncompressed .npz file,
+    which is named by the hash of its key (see result_key()). The store is limited by size, least recently used
+    results are deleted first.
+    """
+
+    def __init__(self, cache_dir=RESULT_DIR, max_bytes=DISK_LIMIT, enabled=True):
+        """
+        :param cache_dir: Folder of the store
+        :param max_bytes: Maximum size of the store (in bytes)
+        :param enabled: If False, results are always calculated and never stored
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0  # Result was found in the store
+        self.misses = 0  # Result had to be calculated
+        self.evictions = 0  # Results deleted because the store was above size limit
+
+    def get(self, filename: str, params: dict, compute):
+        """
+        Returns stored result or calls compute and stores its result.
+        :param filename: name of the .abf file
+        :param params: dictionary of analysis parameters used in the key (see result_key())
+        :param compute: function without parameters which returns dictionary {name: array}
+        :return: dictionary {name: array}
+        """
+        if not self.enabled:
+            return compute()
+        key, digest = result_key(filename, params)
+        arrays = self._read(key, digest)
+        if arrays is not None:
+            self.hits += 1
+            return arrays
+        self.misses += 1
+        arrays = compute()
+        self._write(key, digest, arrays)
+        return arrays
+
+    def _path(self, digest):
+        return os.path.join(self.cache_dir, digest + '.npz')
+
+    def _read(self, key, digest):
+        path = self._path(digest)
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                if str(stored['__key__']) != key:  # Hash collision or broken entry
+                    return None
+                arrays = {name: stored[name] for name in stored.files if name != '__key__'}
+            os.utime(path)  # Modification time marks the last use of the result
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays
+
+    def _write(self, key, digest, arrays):
+        path = self._path(digest)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # File is written under temporary name and renamed, so other processes never see half-written entries
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, __key__=np.array(key), **arrays)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _entries(self):
+        # Returns list of (last use time, size, path) of stored results
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # Deleted by another process
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        # Deletes least recently used results until the store fits into max_bytes
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries[:-1]:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+
+    def info(self):
+        """
+        :return: dictionary with cache statistics: hits, misses, evictions, number of stored results and their size
+        (bytes)
+        """
+        entries = self._entries() if os.path.isdir(self.cache_dir) else []
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(entries),
+                'disk_bytes': sum(entry[1] for entry in entries)}
+
+    def clear(self, disk=False):
+        """
+        Resets counters.
+        :param disk: If True, also deletes stored results
+        """
+        self.hits = self.misses = self.evictions = 0
+        if disk and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+result_cache = ResultCache()  # Cache used by power_calculation.psd_windows()
+
+
+def cache_info():
+    """
+    :return: statistics of the result cache used by psd(), psd_calc() and psd_frequency_bands(), see
+    ResultCache.info()
+    """
+    return result_cache.info()
+
+
+def clear_cache(disk=False):
+    """
+    Clears the result cache used by psd(), psd_calc() and psd_frequency_bands().
+    :param disk: If True, also deletes stored results
+    """
+    result_cache.clear(disk=disk)
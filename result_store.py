@@ -0,0 +1,218 @@
+import json
+import operator
+import os
+from urllib.parse import quote, unquote
+import numpy as np
+import pandas as pd
+
+PARTITION_COLUMNS = ['week', 'drug', 'phase', 'channel']  # Folder levels of every dataset of the store
+PARTITION_ALIASES = {'channel': 'brain_area'}  # Column which holds partition values in psd_frequency_bands() tables
+FILTER_OPERATORS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+                    '>=': operator.ge, 'in': lambda values, items: np.isin(values, list(items)),
+                    'not in': lambda values, items: ~np.isin(values, list(items))}
+_META = '__meta__'  # Name of the array with column names and types in every part file
+
+
+def _matches(values, filters):
+    # Boolean mask of values which pass every filter (column, op, value) in filters
+    mask = np.ones(len(next(iter(values.values()))), dtype=bool)
+    for column, op, value in filters:
+        mask &= np.asarray(FILTER_OPERATORS[op](values[column], value), dtype=bool)
+    return mask
+
+
+class ResultStore:
+    """
+    Store of result tables (spectra, band tables, ASSR parameters) in a binary columnar format. Every dataset is
+    partitioned into folders by week, drug, phase and channel (for example,
+    spectra/week=week_0/drug=Ketamine/phase=after_5_min/channel=Aux1/baseline.npz) and every part is a compressed .npz
+    file with one array per column. Text columns are stored as category codes. Reading selects partition folders by
+    their names and loads only the columns which are needed for filters and the result, so a figure can load just
+    the slice it plots. Tables can be exported to .csv for sharing.
+    """
+
+    def __init__(self, root: str, partition_columns=PARTITION_COLUMNS):
+        """
+        :param root: Folder of the store, for example, 'tables_figures/store'
+        :param partition_columns: Folder levels of every dataset
+        """
+        self.root = root
+        self.partition_columns = list(partition_columns)
+
+    def write(self, table, dataset: str, part='data', source=None, **partition):
+        """
+        Stores table in the dataset. Partition values which are not given are taken from the table columns of the
+        same name (or 'brain_area' column for 'channel'), so one table can be split into many partitions. Part of the
+        same name in the partition is replaced, so repeated runs of a script do not duplicate rows.
+        For example, store.write(table, 'spectra', part='baseline', week='week_0', drug='Ketamine',
+        phase='after_5_min', channel='Aux1').
+        :param table: DataFrame, index is stored too if it is named (for example, 'freq' of psd() tables)
+        :param dataset: Name of the dataset, for example, 'spectra' or 'bands'
+        :param part: Name of the part file in every partition, for example, calc name 'baseline'
+        :param source: Text which identifies inputs of the table (for example, hash of .abf file identity and
+        analysis parameters), it is stored with every part and checked by has_part()
+        :param partition: Values of partition columns, for example, week='week_0'
+        :return: list of written files
+        """
+        split = []
+        for column in self.partition_columns:
+            if column in partition:
+                continue
+            label = column if column in table.columns else PARTITION_ALIASES.get(column)
+            if label not in table.columns:
+                raise ValueError(f"Partition value '{column}' is not given and table has no '{column}' column")
+            split.append((column, label))
+        if not split:
+            return [self._write_part(table, dataset, part, partition, source)]
+        groups = table.groupby([label for _, label in split], observed=True, sort=False)
+        files = []
+        for values, group in groups:
+            values = values if isinstance(values, tuple) else (values,)
+            group_partition = {**partition, **{column: value for (column, _), value in zip(split, values)}}
+            files.append(self._write_part(group.drop(columns=[column for column, _ in split
+                                                              if column in group.columns]),
+                                          dataset, part, group_partition, source))
+        return files
+
+    def _partition_dir(self, dataset: str, partition: dict):
+        folders = [f"{column}={quote(str(partition[column]), safe='')}" for column in self.partition_columns]
+        return os.path.join(self.root, dataset, *folders)
+
+    def _write_part(self, table, dataset: str, part: str, partition: dict, source=None):
+        index_names = [name for name in table.index.names if name is not None]
+        if index_names:
+            table = table.reset_index()
+        arrays, kinds = {}, {}
+        for column in table.columns:
+            values = table[column]
+            if pd.api.types.is_numeric_dtype(values.dtype) or pd.api.types.is_bool_dtype(values.dtype):
+                arrays[column] = values.to_numpy(dtype=float if values.hasnans else None)
+                kinds[column] = 'values'
+            else:
+                codes, categories = pd.factorize(values)
+                arrays[f'{column}.codes'] = codes.astype(np.int32)
+                arrays[f'{column}.categories'] = np.asarray(categories, dtype=str)
+                kinds[column] = 'labels'
+        meta = {'columns': [str(column) for column in table.columns], 'kinds': kinds, 'index': index_names,
+                'rows': len(table), 'source': source}
+        arrays[_META] = np.array(json.dumps(meta))
+
+        folder = self._partition_dir(dataset, partition)
+        os.makedirs(folder, exist_ok=True)
+        filename = os.path.join(folder, f"{quote(part, safe='')}.npz")
+        temporary = f'{filename}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(temporary, **arrays)
+        os.replace(temporary, filename)  # Readers never see partly written part
+        return filename
+
+    def has_part(self, dataset: str, part: str, source=None, **partition):
+        """
+        :param dataset: Name of the dataset
+        :param part: Name of the part file
+        :param source: If given, the part counts only if it was written with the same source (see write()), so parts
+        of changed inputs are calculated again
+        :param partition: Values of every partition column
+        :return: True if the part is stored in the partition
+        """
+        filename = os.path.join(self._partition_dir(dataset, partition), f"{quote(part, safe='')}.npz")
+        if source is None:
+            return os.path.exists(filename)
+        try:
+            with np.load(filename) as arrays:  # Only the metadata array is decompressed
+                return json.loads(arrays[_META].item()).get('source') == source
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def partitions(self, dataset: str, filters=(), **partition):
+        """
+        Finds partitions of the dataset by folder names only, no file is opened.
+        :param dataset: Name of the dataset
+        :param filters: Filters (see read()), filters of partition columns are applied
+        :param partition: Partition values, every value can be one value or a list of values
+        :return: list of tuples (folder, dictionary of partition values)
+        """
+        filters = [(column, op, value) for column, op, value in filters if column in self.partition_columns]
+        filters += [(column, 'in', [value] if isinstance(value, str) or np.ndim(value) == 0 else value)
+                    for column, value in partition.items()]
+        found = [(os.path.join(self.root, dataset), {})]
+        for column in self.partition_columns:
+            level = []
+            for folder, values in found:
+                if not os.path.isdir(folder):
+                    continue
+                for name in sorted(os.listdir(folder)):
+                    key, _, value = name.partition('=')
+                    if key == column:
+                        level.append((os.path.join(folder, name), {**values, column: unquote(value)}))
+            found = level
+        return [(folder, values) for folder, values in found
+                if all(_matches({column: np.array([values[column]])}, [(column, op, value)])[0]
+                       for column, op, value in filters)]
+
+    def read(self, dataset: str, columns=None, filters=(), **partition):
+        """
+        Reads rows of the dataset. Only partitions which pass partition values and filters are opened and only
+        columns which are needed are loaded.
+        For example, store.read('spectra', columns=['Aux1', 'mouse'], filters=[('freq', '<=', 90)], week='week_0',
+        drug=['Ketamine', 'Saline'], phase='after_5_min', channel='Aux1').
+        :param dataset: Name of the dataset, for example, 'spectra'
+        :param columns: List of columns of the result, default is every column. Partition columns are always added
+        :param filters: List of tuples (column, operator, value) which every row must pass. Operators are '==',
+        '!=', '<', '<=', '>', '>=', 'in' and 'not in'
+        :param partition: Partition values, every value can be one value or a list of values
+        :return: DataFrame, text columns are categorical and stored index is restored
+        """
+        filters = list(filters)
+        row_filters = [item for item in filters if item[0] not in self.partition_columns]
+        tables = []
+        for folder, values in self.partitions(dataset, filters, **partition):
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                    table = self._read_part(os.path.join(folder, name), columns, row_filters)
+                    if table is not None:
+                        for column, value in values.items():
+                            if column not in table.columns:
+                                table[column] = pd.Categorical.from_codes(np.zeros(len(table), dtype=np.int32),
+                                                                          categories=[value])
+                        tables.append(table)
+        if not tables:
+            return pd.DataFrame(columns=columns)
+        result = pd.concat(tables)
+        # Label columns of parts with different categories are concatenated as text, they are made categorical again
+        labels = [column for column in result.columns if not pd.api.types.is_numeric_dtype(result[column].dtype)
+                  and not isinstance(result[column].dtype, pd.CategoricalDtype)]
+        return result.astype({column: 'category' for column in labels}) if labels else result
+
+    @staticmethod
+    def _read_part(filename: str, columns, row_filters):
+        with np.load(filename) as arrays:  # Arrays of .npz file are decompressed only when they are accessed
+            meta = json.loads(arrays[_META].item())
+
+            def load(column, rows=slice(None)):
+                if meta['kinds'][column] == 'values':
+                    return arrays[column][rows]
+                return pd.Categorical.from_codes(arrays[f'{column}.codes'][rows],
+                                                 categories=arrays[f'{column}.categories'])
+
+            rows = slice(None)
+            if row_filters:
+                missing = [column for column, _, _ in row_filters if column not in meta['kinds']]
+                if missing:
+                    raise ValueError(f"Filter columns {missing} are not in {filename}")
+                mask = _matches({column: np.asarray(load(column)) for column, _, _ in row_filters}, row_filters)
+                if not mask.any():
+                    return None
+                rows = np.flatnonzero(mask)
+            selected = meta['columns'] if columns is None else [column for column in meta['columns']
+                                                                 if column in columns or column in meta['index']]
+            table = pd.DataFrame({column: load(column, rows) for column in selected})
+        if meta['index']:
+            table = table.set_index(meta['index'])
+        return table
+
+    def export_csv(self, dataset: str, filename: str, columns=None, filters=(), **partition):
+        """
+        Writes selected rows of the dataset into .csv file for sharing (parameters are the same as of read()).
+        :param filename: name of .csv file
+        """
+        self.read(dataset, columns=columns, filters=filters, **partition).to_csv(filename)
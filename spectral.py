@@ -0,0 +1,407 @@
+import time
+import numpy as np
+
+MULTITAPER_BANDWIDTH = 2  # Bandwidth of the multitaper window function in Hz
+WELCH_N_FFT = 1000  # Length of FFT used in Welch method
+FILTER_METHODS = ('fir', 'iir')  # Zero-phase FIR (the same as mne .filter()) or Butterworth IIR filter
+IIR_ORDER = 4  # Order of Butterworth filters, the same as mne default of IIR filters
+FILTER_BLOCK = 16  # Rows (epoch channels) filtered together, limits memory of FFT buffers
+DECIMATION_MARGIN = 2.5  # Sampling rate after decimation is at least this many times the highest analysed frequency
+DECIMATION_ATTENUATION = 80  # Stopband attenuation of the anti-aliasing filter in dB
+
+# (n_samples, sfreq, bandwidth, n_fft) or filter parameters -> (tapers, window or filter; eigenvalues or None;
+# seconds spent to build it)
+_cache = {}
+_stats = {'hits': 0, 'misses': 0, 'saved_seconds': 0.0}
+
+
+def _cached(key, build):
+    """
+    Returns cached tapers/window for the key or builds them with build() function and remembers the build time,
+    which is counted as saved time on every later hit.
+    """
+    if key in _cache:
+        _stats['hits'] += 1
+        _stats['saved_seconds'] += _cache[key][2]
+        return _cache[key][:2]
+    _stats['misses'] += 1
+    start = time.perf_counter()
+    tapers, eigenvalues = build()
+    _cache[key] = (tapers, eigenvalues, time.perf_counter() - start)
+    return tapers, eigenvalues
+
+
+def multitaper_tapers(n_samples: int, sfreq: float, bandwidth=MULTITAPER_BANDWIDTH):
+    """
+    Returns DPSS tapers used by multitaper method, the same as mne.time_frequency.psd_array_multitaper uses
+    (low_bias=True). Tapers are cached for every (n_samples, sfreq, bandwidth).
+    :param n_samples: Number of samples in the analysed time window
+    :param sfreq: Sampling rate in Hz
+    :param bandwidth: Bandwidth of the multitaper window function in Hz
+    :return: tuple (tapers of shape (n_tapers, n_samples), eigenvalues of shape (n_tapers,))
+    """
+    def build():
+        from mne.time_frequency import dpss_windows  # mne is imported only when tapers are built
+        half_nbw = float(bandwidth) * n_samples / (2.0 * sfreq)  # Standardized half-bandwidth
+        if half_nbw < 0.5:
+            raise ValueError(f"bandwidth value {bandwidth} is too small, use a value of at least {sfreq / n_samples}")
+        return dpss_windows(n_samples, half_nbw, int(2 * half_nbw), sym=False, low_bias=True)
+
+    return _cached((n_samples, sfreq, bandwidth, None), build)
+
+
+def welch_window(n_samples: int, n_fft=WELCH_N_FFT):
+    """
+    Returns Hamming window of Welch method segments, the same as mne.time_frequency.psd_array_welch uses.
+    Windows are cached for every (n_samples, n_fft).
+    :param n_samples: Number of samples in the analysed time window
+    :param n_fft: Length of FFT, segments are n_fft samples long (or shorter if time window is shorter)
+    :return: window array of shape (n_per_seg,)
+    """
+    from scipy.signal import get_window
+    n_per_seg = min(n_fft, n_samples)
+    return _cached((n_samples, None, None, n_fft), lambda: (get_window('hamming', n_per_seg), None))[0]
+
+
+def fir_kernel(sfreq: float, l_freq, h_freq, filter_length='auto'):
+    """
+    Returns zero-phase FIR filter, the same as mne .filter() designs with default parameters (firwin design, Hamming
+    window, 'auto' length and transition bands). Kernels are cached for every (sfreq, l_freq, h_freq, filter_length).
+    :param sfreq: Sampling rate in Hz
+    :param l_freq: High-pass cutoff frequency in Hz, None means low-pass filter
+    :param h_freq: Low-pass cutoff frequency in Hz, None means high-pass filter
+    :param filter_length: Length of the filter, 'auto' or the same values as in mne .filter()
+    :return: kernel array of shape (n_taps,)
+    """
+    def build():
+        from mne.filter import create_filter  # mne is imported only when the filter is designed
+        return create_filter(None, sfreq, l_freq, h_freq, filter_length=filter_length, verbose='error'), None
+
+    return _cached(('fir', sfreq, l_freq, h_freq, filter_length), build)[0]
+
+
+def iir_sos(sfreq: float, l_freq, h_freq, order=IIR_ORDER):
+    """
+    Returns Butterworth filter in second-order sections, which are stable for low cutoff frequencies (0.5 Hz at
+    several kHz sampling rate), unlike transfer function coefficients. Filters are cached for every
+    (sfreq, l_freq, h_freq, order).
+    :param sfreq: Sampling rate in Hz
+    :param l_freq: High-pass cutoff frequency in Hz, None means low-pass filter
+    :param h_freq: Low-pass cutoff frequency in Hz, None means high-pass filter
+    :param order: Order of the filter (applied forward and backward, so the effective order is doubled)
+    :return: array of shape (n_sections, 6)
+    """
+    def build():
+        from scipy.signal import butter
+        if l_freq is None:
+            return butter(order, h_freq, btype='lowpass', output='sos', fs=sfreq), None
+        if h_freq is None:
+            return butter(order, l_freq, btype='highpass', output='sos', fs=sfreq), None
+        return butter(order, [l_freq, h_freq], btype='bandpass', output='sos', fs=sfreq), None
+
+    return _cached(('iir', sfreq, l_freq, h_freq, order), build)[0]
+
+
+def fir_filter(data, sfreq: float, l_freq, h_freq, filter_length='auto', out=None):
+    """
+    Filters every epoch and channel with zero-phase FIR filter (see fir_kernel()). Results are the same as mne
+    .filter() gives (edges are padded with edge values, pad='edge'), but rows are filtered in blocks of FILTER_BLOCK
+    with one FFT call and the spectrum of the kernel is cached, so nothing is redesigned or copied for every file.
+    :param data: array of shape (..., samples), for example (epochs, channels, samples). float32 data is filtered in
+    single precision
+    :param sfreq: Sampling rate in Hz
+    :param l_freq: High-pass cutoff frequency in Hz, None means low-pass filter
+    :param h_freq: Low-pass cutoff frequency in Hz, None means high-pass filter
+    :param filter_length: Length of the filter (see fir_kernel())
+    :param out: Array of the same shape for the result, it can be data itself to filter in place. Default is new array
+    :return: filtered array with the same precision as data
+    """
+    from scipy.fft import rfft, irfft, next_fast_len
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    kernel = fir_kernel(sfreq, l_freq, h_freq, filter_length)
+    n_taps, n_samples = len(kernel), data.shape[-1]
+    n_edge = max(min(n_taps, n_samples) - 1, 0)  # Padding of every edge, the same as in mne
+    shift = (n_taps - 1) // 2 + n_edge  # Delay of the zero-phase kernel and padding
+    # Circular convolution wraps only samples which are dropped with the padding, so shorter FFT than the length of
+    # linear convolution is enough
+    n_fft = next_fast_len(shift + n_samples, real=True)
+    spectrum = _cached(('fir_fft', sfreq, l_freq, h_freq, filter_length, n_fft, np.dtype(dtype).str),
+                       lambda: (rfft(kernel.astype(dtype), n_fft), None))[0]
+    out = np.empty(data.shape, dtype) if out is None else out
+    rows, out_rows = data.reshape(-1, n_samples), out.reshape(-1, n_samples)
+    for start in range(0, rows.shape[0], FILTER_BLOCK):
+        block = np.pad(rows[start:start + FILTER_BLOCK].astype(dtype, copy=False), ((0, 0), (n_edge, n_edge)),
+                       mode='edge')
+        out_rows[start:start + FILTER_BLOCK] = irfft(rfft(block, n_fft) * spectrum, n_fft)[:, shift:shift + n_samples]
+    return out
+
+
+def iir_filter(data, sfreq: float, l_freq, h_freq, order=IIR_ORDER, pad_length=None, out=None):
+    """
+    Filters every epoch and channel forward and backward (zero phase) with Butterworth filter (see iir_sos()). Edges
+    are extended by odd reflection of pad_length samples before filtering, so the filter starts and ends without a
+    step. IIR filters are much shorter than FIR filters of low cutoff frequencies, so only analysed time windows
+    with some data around them (see power_calculation.IIR_PAD) have to be filtered. Filtering is done in double
+    precision, poles near the unit circle are not precise enough in float32.
+    :param data: array of shape (..., samples), for example (epochs, channels, samples)
+    :param sfreq: Sampling rate in Hz
+    :param l_freq: High-pass cutoff frequency in Hz, None means low-pass filter
+    :param h_freq: Low-pass cutoff frequency in Hz, None means high-pass filter
+    :param order: Order of the filter
+    :param pad_length: Number of samples of padding of every edge, default (None) is the length of data minus one
+    :param out: Array of the same shape for the result, it can be data itself to filter in place. Default is new array
+    :return: filtered array with the same precision as data
+    """
+    from scipy.signal import sosfiltfilt
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    sos = iir_sos(sfreq, l_freq, h_freq, order)
+    n_samples = data.shape[-1]
+    pad_length = n_samples - 1 if pad_length is None else min(pad_length, n_samples - 1)
+    out = np.empty(data.shape, dtype) if out is None else out
+    rows, out_rows = data.reshape(-1, n_samples), out.reshape(-1, n_samples)
+    for start in range(0, rows.shape[0], FILTER_BLOCK):
+        out_rows[start:start + FILTER_BLOCK] = sosfiltfilt(sos, rows[start:start + FILTER_BLOCK], axis=-1,
+                                                           padtype='odd', padlen=pad_length)
+    return out
+
+
+def band_filter(data, sfreq: float, l_freq, h_freq, method='fir', out=None, **kwargs):
+    """
+    Filters data with FIR (fir_filter(), the same as mne .filter()) or IIR (iir_filter()) filter.
+    :param data: array of shape (..., samples), for example (epochs, channels, samples)
+    :param sfreq: Sampling rate in Hz
+    :param l_freq: High-pass cutoff frequency in Hz, None means low-pass filter
+    :param h_freq: Low-pass cutoff frequency in Hz, None means high-pass filter
+    :param method: 'fir' or 'iir'
+    :param out: Array of the same shape for the result, it can be data itself to filter in place. Default is new array
+    :param kwargs: Other parameters of fir_filter() or iir_filter()
+    :return: filtered array with the same precision as data
+    """
+    if method == 'fir':
+        return fir_filter(data, sfreq, l_freq, h_freq, out=out, **kwargs)
+    if method == 'iir':
+        return iir_filter(data, sfreq, l_freq, h_freq, out=out, **kwargs)
+    raise ValueError(f"Wrong filter method '{method}', use one of {FILTER_METHODS}")
+
+
+def decimation_factor(sfreq: float, f_max, margin=DECIMATION_MARGIN, divides=None):
+    """
+    :param sfreq: Sampling rate in Hz
+    :param f_max: Highest frequency of the analysis in Hz
+    :param margin: Sampling rate after decimation is at least margin * f_max (must be more than 2, so the
+    anti-aliasing filter has a transition band between f_max and frequencies which alias into 0-f_max)
+    :param divides: If given, the factor must divide it, for example WELCH_N_FFT, so Welch FFT of decimated data is
+    WELCH_N_FFT // factor long and its frequencies are the same as at the full sampling rate
+    :return: the largest integer factor which keeps f_max safe, 1 if data can not be decimated
+    """
+    if f_max is None or not np.isfinite(f_max) or f_max <= 0:
+        return 1
+    factor = max(int(sfreq // (margin * f_max)), 1)
+    if divides is not None:
+        while divides % factor:
+            factor -= 1
+    return factor
+
+
+def antialias_kernel(sfreq: float, factor: int, margin=DECIMATION_MARGIN, attenuation=DECIMATION_ATTENUATION):
+    """
+    Returns low-pass FIR filter (Kaiser window) applied before decimation. It passes frequencies up to
+    sfreq / factor / margin and attenuates frequencies which alias into them (from sfreq / factor minus the passband)
+    by attenuation dB. Kernels are cached for every (sfreq, factor, margin, attenuation).
+    :param sfreq: Sampling rate before decimation in Hz
+    :param factor: Decimation factor
+    :param margin: Ratio of the sampling rate after decimation and the highest passed frequency
+    :param attenuation: Stopband attenuation in dB, passband ripple is about the same (80 dB gives 1e-4)
+    :return: kernel array of odd length
+    """
+    def build():
+        from scipy.signal import firwin, kaiserord
+        rate = sfreq / factor
+        width = rate - 2 * rate / margin  # Transition band from the highest passed frequency to the first aliased one
+        n_taps, beta = kaiserord(attenuation, width / (sfreq / 2))
+        n_taps += 1 - n_taps % 2  # Odd length, so the delay of the filter is a whole number of samples
+        return firwin(n_taps, rate / 2, window=('kaiser', beta), fs=sfreq), None
+
+    return _cached(('decimate', sfreq, factor, margin, attenuation), build)[0]
+
+
+def downsample(data, sfreq: float, factor: int, **kwargs):
+    """
+    Decimates every epoch and channel: data is filtered with zero-phase anti-aliasing filter (see antialias_kernel(),
+    edges are padded with edge values) and every factor-th sample is kept. Only kept samples are calculated
+    (polyphase filtering with scipy upfirdn()).
+    :param data: array of shape (..., samples), for example (epochs, channels, samples). float32 data is filtered in
+    single precision
+    :param sfreq: Sampling rate in Hz
+    :param factor: Decimation factor, see decimation_factor()
+    :param kwargs: Other parameters of antialias_kernel()
+    :return: array of shape (..., ceil(samples / factor)), sample k is sample k * factor of filtered data, so the
+    sampling rate is sfreq / factor and the first sample is the same
+    """
+    if factor == 1:
+        return data
+    from scipy.signal import upfirdn
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    kernel = antialias_kernel(sfreq, factor, **kwargs).astype(dtype)
+    half, n_samples = len(kernel) // 2, data.shape[-1]
+    n_out = -(-n_samples // factor)
+    skip = -(-2 * half // factor)  # Outputs of upfirdn() which only see padding before the first sample
+    left = skip * factor - half  # Padding before the first sample (at least half), so outputs are centered
+    right = max((n_out - 1) * factor + half - (n_samples - 1), 0)
+    padding = [(0, 0)] * (data.ndim - 1) + [(left, right)]
+    padded = np.pad(data.astype(dtype, copy=False), padding, mode='edge')
+    return upfirdn(kernel, padded, down=factor, axis=-1)[..., skip:skip + n_out]
+
+
+def export_cache():
+    """
+    :return: copy of tapers and windows cache, which can be handed to worker processes (see load_cache())
+    """
+    return dict(_cache)
+
+
+def load_cache(cache: dict):
+    """
+    Adds tapers and windows built in another process (see export_cache()) into cache of this process.
+    :param cache: dictionary returned by export_cache()
+    """
+    _cache.update(cache)
+
+
+def cache_info(since=None):
+    """
+    :param since: Statistics returned by an earlier cache_info() call, for example, before a job started. Default
+    (None) counts from the start of the process
+    :return: dictionary with number of cache hits, misses, entries and time saved by the cache (in seconds). Hits of
+    tapers built in another process (see load_cache()) save their build time too
+    """
+    info = dict(_stats, entries=len(_cache))
+    if since is not None:
+        for key in _stats:
+            info[key] -= since[key]
+    return info
+
+
+def total_cache_info(infos):
+    """
+    Sums statistics of many jobs, for example, cache_info(since=...) of every job run in worker processes.
+    :param infos: iterable of dictionaries returned by cache_info(), None (job which did not report them) is skipped
+    :return: dictionary with total number of hits and misses and time saved by the cache (in seconds)
+    """
+    total = {key: 0 for key in _stats}
+    for info in infos:
+        if info is not None:
+            for key in total:
+                total[key] += info[key]
+    return total
+
+
+def psd_array(data, sfreq: float, f_min=0.0, f_max=np.inf, method='multitaper', bandwidth=MULTITAPER_BANDWIDTH,
+              n_fft=WELCH_N_FFT):
+    """
+    Calculates power spectral density of every epoch and channel with cached tapers/windows. Results are the same as
+    mne compute_psd() gives with default parameters ('length' normalization, mean removed, non-adaptive multitaper,
+    Welch segments without overlap).
+    :param data: array of shape (..., samples) in V, for example (epochs, channels, samples). float32 data is
+    transformed in single precision
+    :param sfreq: Sampling rate in Hz
+    :param f_min: Lowest frequency to keep
+    :param f_max: Highest frequency to keep
+    :param method: 'multitaper' or 'welch'
+    :param bandwidth: Bandwidth of the multitaper window function in Hz
+    :param n_fft: Length of FFT used in Welch method
+    :return: tuple (psds of shape (..., freqs) in V^2/Hz with the same precision as data, freqs)
+    """
+    from scipy.fft import rfft, rfftfreq  # scipy is imported on first transform, not with this module
+    n_samples = data.shape[-1]
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    x = data - data.mean(axis=-1, keepdims=True)
+
+    if method == 'multitaper':
+        tapers, eigenvalues = multitaper_tapers(n_samples, sfreq, bandwidth)
+        freqs = rfftfreq(n_samples, 1.0 / sfreq)
+        mask = (freqs >= f_min) & (freqs <= f_max)
+        x_mt = rfft(x[..., np.newaxis, :] * tapers.astype(dtype, copy=False), n=n_samples)
+        x_mt[..., 0] /= np.sqrt(2.0)  # Adjust DC and Nyquist of one-sided spectrum
+        if n_samples % 2 == 0:
+            x_mt[..., -1] /= np.sqrt(2.0)
+        weights = np.sqrt(eigenvalues)[:, np.newaxis].astype(dtype, copy=False)
+        x_mt = weights * x_mt[..., mask]
+        psds = (x_mt.real ** 2 + x_mt.imag ** 2).sum(axis=-2) * (2 / (weights ** 2).sum())
+
+    elif method == 'welch':
+        if n_fft > n_samples:
+            raise ValueError(f"n_fft ({n_fft}) can not be longer than time window ({n_samples} samples)")
+        window = welch_window(n_samples, n_fft).astype(dtype, copy=False)
+        n_per_seg = len(window)
+        freqs = np.arange(n_fft // 2 + 1, dtype=float) * (sfreq / n_fft)
+        mask = (freqs >= f_min) & (freqs <= f_max)
+        n_segments = 1 + (n_samples - n_per_seg) // n_per_seg
+        segments = x[..., :n_segments * n_per_seg].reshape(x.shape[:-1] + (n_segments, n_per_seg))
+        segments = segments - segments.mean(axis=-1, keepdims=True)  # Remove mean of every segment
+        spectrum = rfft(segments * window, n=n_fft)[..., mask]
+        psds = spectrum.real ** 2 + spectrum.imag ** 2
+        psds *= 1.0 / (sfreq * (window ** 2).sum())
+        # One-sided spectrum: power of every frequency except DC (and Nyquist for even n_fft) is doubled
+        doubled = (freqs[mask] > 0) & ~((n_fft % 2 == 0) & (np.arange(len(freqs))[mask] == n_fft // 2))
+        psds[..., doubled] *= 2
+        psds = psds.mean(axis=-2)
+
+    else:
+        raise ValueError(f"Wrong method '{method}', use 'multitaper' or 'welch'")
+
+    return psds, freqs[mask]
+
+
+def psd_sum(data, sfreq: float, windows=None, f_min=0.0, f_max=np.inf, method='multitaper',
+            bandwidth=MULTITAPER_BANDWIDTH, n_fft=WELCH_N_FFT):
+    """
+    Calculates power spectral density summed over epochs in uV^2 for one or several time windows of the same epochs.
+    Sums of consecutive chunks of epochs can be added together, so long recordings can be processed chunk by chunk
+    (see psd_mean()). Windows of equal length are stacked, so they are transformed and summed in one vectorized pass.
+    :param data: array of shape (epochs, channels, samples) in V, float64 or float32 (see psd_array())
+    :param sfreq: Sampling rate in Hz
+    :param windows: List of slice objects of window samples, for example [slice(400, 1801), slice(2400, 3801)].
+    Default (None) uses whole epochs
+    :param f_min: Lowest frequency to keep
+    :param f_max: Highest frequency to keep
+    :param method: 'multitaper' or 'welch'
+    :param bandwidth: Bandwidth of the multitaper window function in Hz
+    :param n_fft: Length of FFT used in Welch method
+    :return: list of tuples (power of shape (channels, freqs) in uV^2, freqs), one tuple for every window
+    """
+    if windows is None:
+        windows = [slice(None)]
+    lengths = [len(range(*window.indices(data.shape[-1]))) for window in windows]
+    results = [None] * len(windows)
+    for length in sorted(set(lengths)):
+        indices = [i for i, n in enumerate(lengths) if n == length]
+        stacked = np.stack([data[..., windows[i]] for i in indices])  # (windows, epochs, channels, samples)
+        psds, freqs = psd_array(stacked, sfreq, f_min=f_min, f_max=f_max, method=method, bandwidth=bandwidth,
+                                n_fft=n_fft)
+        power = psds.sum(axis=1, dtype=np.float64) * 1e12  # Sum over epochs (in double precision) in uV^2
+        for i, window_power in zip(indices, power):
+            results[i] = (window_power, freqs)
+    return results
+
+
+def psd_mean(data, sfreq: float, windows=None, f_min=0.0, f_max=np.inf, method='multitaper',
+             bandwidth=MULTITAPER_BANDWIDTH, n_fft=WELCH_N_FFT):
+    """
+    Calculates mean power spectral density over epochs in uV^2 for one or several time windows of the same epochs.
+    Data can also be an iterable of (epochs, channels, samples) chunks of the same recording, then power is summed
+    chunk by chunk (see psd_sum()) and only one chunk is held in memory at a time.
+    Parameters are the same as in psd_sum().
+    :return: list of tuples (power of shape (channels, freqs) in uV^2, freqs), one tuple for every window
+    """
+    chunks = [data] if isinstance(data, np.ndarray) else data
+    totals, n_epochs = None, 0
+    for chunk in chunks:
+        sums = psd_sum(chunk, sfreq, windows, f_min=f_min, f_max=f_max, method=method, bandwidth=bandwidth,
+                       n_fft=n_fft)
+        totals = sums if totals is None else [(total + power, freqs) for (total, _), (power, freqs) in
+                                              zip(totals, sums)]
+        n_epochs += chunk.shape[0]
+    if totals is None:
+        raise ValueError("No epochs to calculate power spectral density")
+    return [(total / n_epochs, freqs) for total, freqs in totals]
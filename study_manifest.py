@@ -0,0 +1,147 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from abf_reader import open_abf
+
+INDEX_COLUMNS = ['week', 'drug', 'phase', 'mouse']  # Columns which identify a recording, rows are sorted by them
+METADATA_COLUMNS = ['file_size', 'mtime', 'sweep_count', 'sampling_rate', 'sweep_length', 'duration',
+                    'channel_names']
+INTEGER_COLUMNS = ['file_size', 'mtime', 'sweep_count', 'sampling_rate', 'sweep_length']  # Stored as Int64 type
+
+
+def flatten_study(mice_data: dict, mouse_names: list, data_dir=''):
+    """
+    Flattens nested study dictionary (data.mice_data) into a table. Files of every experiment phase are paired with
+    mouse_names by their position in the list.
+    :param mice_data: Dictionary {week: {drug: {phase: [files]}}}, for example, data.mice_data
+    :param mouse_names: List of mice names in the same order as files of every phase, for example, data.mouse_names
+    :param data_dir: Folder of the recordings, which is added in front of every file name
+    :return: DataFrame with columns week, drug, phase, mouse and path sorted by (week, drug, phase, mouse)
+    """
+    rows = []
+    for week, drugs in mice_data.items():
+        for drug, phases in drugs.items():
+            for phase, files in phases.items():
+                if len(files) != len(mouse_names):
+                    raise ValueError(f"{week}/{drug}/{phase} has {len(files)} files, but there are "
+                                     f"{len(mouse_names)} mice names")
+                rows += [(week, drug, phase, mouse, os.path.join(data_dir, path))
+                         for mouse, path in zip(mouse_names, files)]
+    manifest = pd.DataFrame(rows, columns=INDEX_COLUMNS + ['path'])
+    # Identifying values are only columns (index is a plain row number), so they can be used in groupby()
+    return manifest.sort_values(INDEX_COLUMNS, ignore_index=True)
+
+
+def header_metadata(path: str):
+    """
+    Reads metadata of the recording from .abf header only, sample data is not loaded.
+    :param path: .abf file
+    :return: dictionary with METADATA_COLUMNS values (NaN values if file can not be read)
+    """
+    metadata = dict.fromkeys(METADATA_COLUMNS, np.nan)
+    try:
+        stat = os.stat(path)
+        reader = open_abf(path)
+        if reader is not None:
+            sweep_count, sampling_rate = reader.sweep_count, reader.sampling_rate
+            sweep_length, channel_names = reader.sweep_length, reader.adc_names
+        else:
+            import pyabf
+            abf = pyabf.ABF(path, loadData=False)
+            sweep_count, sampling_rate = abf.sweepCount, abf.dataRate
+            sweep_length, channel_names = abf.sweepPointCount, abf.adcNames
+    except (OSError, ValueError, NotImplementedError):
+        return metadata
+    metadata.update(file_size=stat.st_size, mtime=stat.st_mtime_ns, sweep_count=sweep_count,
+                    sampling_rate=sampling_rate, sweep_length=sweep_length,
+                    duration=sweep_count * sweep_length / sampling_rate, channel_names=tuple(channel_names))
+    return metadata
+
+
+def add_metadata(manifest, n_workers=8, previous=None):
+    """
+    Adds header metadata (METADATA_COLUMNS) of every file into manifest. Headers are read in parallel threads.
+    :param manifest: DataFrame returned by flatten_study()
+    :param n_workers: Number of threads which read headers
+    :param previous: Manifest with metadata from earlier run (for example, from load_manifest()). Metadata of files
+    which size and modification time did not change is taken from it instead of reading headers again
+    :return: manifest with metadata columns
+    """
+    known = {}
+    if previous is not None:
+        known = {row.path: row for row in previous.itertuples(index=False)}
+
+    def metadata(path):
+        row = known.get(path)
+        if row is not None and not pd.isna(row.mtime):
+            try:
+                stat = os.stat(path)
+                if (stat.st_size, stat.st_mtime_ns) == (row.file_size, row.mtime):
+                    return {column: getattr(row, column) for column in METADATA_COLUMNS}
+            except OSError:
+                pass
+        return header_metadata(path)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        rows = list(executor.map(metadata, manifest['path']))
+    # Integer columns are built as Int64 directly, so large values (mtime in ns) are not rounded through float. Other
+    # columns are filled into object arrays, so tuples of channel names are kept as one value of every row
+    columns = {}
+    for column in METADATA_COLUMNS:
+        if column in INTEGER_COLUMNS:
+            columns[column] = pd.array([row[column] for row in rows], dtype='Int64')
+        else:
+            values = np.empty(len(rows), dtype=object)
+            values[:] = [row[column] for row in rows]
+            columns[column] = pd.array(values)
+    return manifest.assign(**{column: pd.Series(values, index=manifest.index) for column, values in columns.items()})
+
+
+def save_manifest(manifest, filename: str):
+    """
+    Stores manifest in a binary file for fast repeat lookup.
+    :param manifest: DataFrame returned by add_metadata() or flatten_study()
+    :param filename: name of the file, for example, 'manifest.pkl'
+    """
+    manifest.to_pickle(filename)
+
+
+def load_manifest(filename: str):
+    """
+    :param filename: name of the file stored with save_manifest()
+    :return: manifest DataFrame
+    """
+    return pd.read_pickle(filename)
+
+
+def study_manifest(mice_data: dict, mouse_names: list, data_dir='', filename=None, n_workers=8):
+    """
+    Builds manifest of the study with header metadata. If filename is given, manifest is stored in it and metadata of
+    unchanged files is reused on the next call.
+    :param mice_data: Dictionary {week: {drug: {phase: [files]}}}, for example, data.mice_data
+    :param mouse_names: List of mice names, for example, data.mouse_names
+    :param data_dir: Folder of the recordings
+    :param filename: File where manifest is stored, for example, 'manifest.pkl'. None means manifest is not stored
+    :param n_workers: Number of threads which read headers
+    :return: manifest DataFrame, one row of every recording sorted by (week, drug, phase, mouse)
+    """
+    previous = load_manifest(filename) if filename is not None and os.path.exists(filename) else None
+    manifest = add_metadata(flatten_study(mice_data, mouse_names, data_dir), n_workers=n_workers, previous=previous)
+    if filename is not None:
+        save_manifest(manifest, filename)
+    return manifest
+
+
+def query_manifest(manifest, week=None, drug=None, phase=None, mouse=None):
+    """
+    Selects rows of the manifest. Every parameter can be one value, list of values or None (any value).
+    For example, query_manifest(manifest, week='week_2', drug='Ketamine', phase='after_1_h') returns every
+    after_1_h Ketamine recording of week 2.
+    :return: DataFrame of selected rows, rows keep their manifest index
+    """
+    selection = np.ones(len(manifest), dtype=bool)
+    for column, value in zip(INDEX_COLUMNS, (week, drug, phase, mouse)):
+        if value is not None:
+            selection &= manifest[column].isin([value] if isinstance(value, str) else list(value)).to_numpy()
+    return manifest[selection]
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from bands import ASSR_BAND, FREQUENCY_BANDS, band_table
+from batch_runner import run_group_tfr
+from power_calculation import (WINDOWS, ASSR_FREQS, ITPC_FREQS, ITPC_N_CYCLES, CHANNEL_NAMES, CHANNEL_TYPES,
+                               CHANNEL_ADC_NAMES, CHANNEL_UNITS, psd_windows, import_ecog, calc_assr, build_tapers)
+from result_cache import result_key
+from result_store import ResultStore
+from spectral import MULTITAPER_BANDWIDTH, export_cache, load_cache, cache_info
+
+STUDY_CHANNELS = ['Aux1', 'PFC']  # Channels analysed by run_study()
+STUDY_BANDS = FREQUENCY_BANDS + ASSR_BAND  # Bands stored in 'bands' dataset
+CALCS = list(WINDOWS) + ['ratio']  # Stored spectra: every window of WINDOWS and ratio of signal and baseline
+RECORDING_DATASETS = ('spectra', 'bands', 'assr')  # Datasets written for every recording, part name is mouse name
+SPECTRA_RANGE = (0, 101)  # f_min and f_max of stored spectra in Hz
+
+# One recording of the study (one row of the study manifest)
+StudyTask = namedtuple('StudyTask', ['week', 'drug', 'phase', 'mouse', 'path'])
+# Result of one task: status is 'done', 'skipped' (results were already stored) or 'failed' (error is the traceback).
+# cache is the spectral.cache_info() of the task (tapers reused and built by it), see spectral.total_cache_info()
+StudyResult = namedtuple('StudyResult', ['task', 'status', 'error', 'cache'], defaults=[None])
+
+
+def study_tasks(manifest):
+    """
+    :param manifest: DataFrame returned by study_manifest.study_manifest() (or flatten_study())
+    :return: list of StudyTask objects, one for every recording
+    """
+    return [StudyTask(row.week, row.drug, row.phase, row.mouse, row.path)
+            for row in manifest.itertuples(index=False)]
+
+
+def recording_tables(path: str, mouse: str, channels: list):
+    """
+    Calculates every result of one recording: power spectra of baseline and signal windows and their ratio, mean
+    power of every frequency band (STUDY_BANDS) and 40 Hz ASSR parameters. Spectra are the same as
+    psd_frequency_bands(all_freq=True) returns, bands and ASSR as psd_frequency_bands() and calc_assr().
+    :param path: .abf file
+    :param mouse: Name of the mouse
+    :param channels: List of channels, for example ['Aux1', 'PFC']
+    :return: dictionary {dataset: long table with brain_area column} of RECORDING_DATASETS
+    """
+    spectra = psd_windows(path, channels=channels, f_min=SPECTRA_RANGE[0], f_max=SPECTRA_RANGE[1])  # Both windows
+    spectra['ratio'] = spectra['signal'] / spectra['baseline']  # The same ratio as psd_frequency_bands(calc='ratio')
+
+    spectra_tables, band_tables = [], []
+    for calc in CALCS:
+        long = spectra[calc].melt(var_name='brain_area', value_name='power', ignore_index=False)
+        spectra_tables.append(long.assign(calc=calc))
+        bands = band_table(spectra[calc], STUDY_BANDS).melt(id_vars=['band_name'], var_name='brain_area',
+                                                            value_name='power')
+        band_tables.append(bands.assign(calc=calc))
+    assr = calc_assr(import_ecog(path, channels=channels)).reset_index()
+    tables = {'spectra': pd.concat(spectra_tables), 'bands': pd.concat(band_tables, ignore_index=True),
+              'assr': assr}
+    return {dataset: table.assign(mouse=mouse) for dataset, table in tables.items()}
+
+
+def _partition(task: StudyTask):
+    return {'week': task.week, 'drug': task.drug, 'phase': task.phase}
+
+
+def _source(paths: list, params: dict):
+    """
+    :param paths: .abf files of the result
+    :param params: dictionary of analysis parameters
+    :return: hash of identity of every file (path, size and modification time), parameters and library versions (see
+    result_cache.result_key()), which is stored with the result, so results of changed inputs are not skipped
+    """
+    keys = [result_key(path, params)[0] for path in paths]
+    return hashlib.sha1(json.dumps(keys).encode()).hexdigest()
+
+
+def _analysis_params(dataset: str, **params):
+    # Parameters of stored results which are module constants (the same for every recording)
+    return {'dataset': dataset, 'layout': [CHANNEL_NAMES, CHANNEL_TYPES, CHANNEL_ADC_NAMES, CHANNEL_UNITS],
+            'itpc_freqs': ITPC_FREQS.tolist(), 'n_cycles': ITPC_N_CYCLES.tolist(), **params}
+
+
+def _run_task(store: ResultStore, task: StudyTask, channels: list, overwrite: bool):
+    # Calculates and stores results of one recording, skips it if every result is already stored from the same file
+    # and parameters
+    before = cache_info()
+    try:
+        source = _source([task.path], _analysis_params('recording', windows=WINDOWS, spectra_range=SPECTRA_RANGE,
+                                                       bands=STUDY_BANDS, bandwidth=MULTITAPER_BANDWIDTH,
+                                                       assr_freqs=ASSR_FREQS.tolist()))
+        if not overwrite and all(store.has_part(dataset, task.mouse, source, channel=channel, **_partition(task))
+                                 for dataset in RECORDING_DATASETS for channel in channels):
+            return StudyResult(task, 'skipped', None, cache_info(since=before))
+        for dataset, table in recording_tables(task.path, task.mouse, channels).items():
+            store.write(table, dataset, part=task.mouse, source=source, **_partition(task))
+        return StudyResult(task, 'done', None, cache_info(since=before))
+    except Exception:
+        return StudyResult(task, 'failed', traceback.format_exc(), cache_info(since=before))
+
+
+def run_recordings(store: ResultStore, tasks: list, channels=STUDY_CHANNELS, n_workers=None, overwrite=False):
+    """
+    Calculates and stores results of every recording (see recording_tables()) in a pool of processes. Every recording
+    is stored as soon as it is calculated, so interrupted run continues from the first recording which is not stored.
+    Stored results of a recording whose .abf file or analysis parameters changed are calculated again. Tapers of the
+    spectra are built in this process before the pool starts and handed to every worker (see
+    power_calculation.build_tapers()).
+    Note: on Windows and macOS scripts which call this function must be protected by `if __name__ == '__main__':`
+    :param store: ResultStore object
+    :param tasks: list of StudyTask objects (see study_tasks())
+    :param channels: List of channels
+    :param n_workers: Number of worker processes. Default is number of CPU cores, 1 runs tasks in this process
+    :param overwrite: If True, stored results are calculated again even if their inputs did not change
+    :return: list of StudyResult objects in the same order as tasks, spectral.total_cache_info() of StudyResult.cache
+    of the results counts tapers reused and built by the workers
+    """
+    tasks = list(tasks)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1 or len(tasks) <= 1:
+        return [_run_task(store, task, channels, overwrite) for task in tasks]
+
+    build_tapers([task.path for task in tasks], f_max=SPECTRA_RANGE[1])
+    results = []
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks)), initializer=load_cache,
+                             initargs=(export_cache(),)) as executor:
+        futures = [executor.submit(_run_task, store, task, channels, overwrite) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                results.append(future.result())
+            except Exception:  # For example, worker process was killed
+                results.append(StudyResult(task, 'failed', traceback.format_exc()))
+    return results
+
+
+def run_group_tfrs(store: ResultStore, tasks: list, channels=STUDY_CHANNELS, freqs=None, n_workers=None,
+                   overwrite=False):
+    """
+    Calculates group mean power and itc (calc_itpc_power()) of every week, drug and phase and stores them in 'tfr'
+    dataset (part 'mean'), which is read by read_tfr().
+    :param store: ResultStore object
+    :param tasks: list of StudyTask objects (see study_tasks())
+    :param channels: List of channels
+    :param freqs: Frequencies of interest in Hz (see calc_itpc_power()), for example, np.linspace(20, 70, 51)
+    :param n_workers: Number of worker processes (see batch_runner.run_group_tfr())
+    :param overwrite: If True, stored results are calculated again
+    :return: list of StudyResult objects, task of every result is the first recording of the group
+    """
+    groups = {}
+    for task in tasks:
+        groups.setdefault((task.week, task.drug, task.phase), []).append(task)
+    results = []
+    for group_tasks in groups.values():
+        partition = _partition(group_tasks[0])
+        try:
+            source = _source([task.path for task in group_tasks],
+                             _analysis_params('tfr', freqs=None if freqs is None else np.asarray(freqs).tolist()))
+            if not overwrite and all(store.has_part('tfr', 'mean', source, channel=channel, **partition)
+                                     for channel in channels):
+                results.append(StudyResult(group_tasks[0], 'skipped', None))
+                continue
+            group = run_group_tfr([task.path for task in group_tasks], channels, n_workers=n_workers, freqs=freqs)
+            power, itc = group.mean('power'), group.mean('itc')
+            freq_grid, time_grid = np.meshgrid(power.freqs, power.times, indexing='ij')
+            for i, channel in enumerate(power.ch_names):
+                table = pd.DataFrame({'freq': freq_grid.ravel(), 'time': time_grid.ravel(),
+                                      'power': power.data[i].ravel(), 'itc': itc.data[i].ravel(),
+                                      'count': group.count})
+                store.write(table, 'tfr', part='mean', source=source, channel=channel, **partition)
+            results.append(StudyResult(group_tasks[0], 'done', None))
+        except Exception:
+            results.append(StudyResult(group_tasks[0], 'failed', traceback.format_exc()))
+    return results
+
+
+def run_study(manifest, store: ResultStore, channels=STUDY_CHANNELS, tfr_freqs=None, n_workers=None,
+              overwrite=False):
+    """
+    Calculates every result of the study once: spectra, band power and ASSR of every recording and channel, and group
+    TFR of every week, drug and phase if tfr_freqs are given. Results are read by figure scripts with read_spectra(),
+    read_bands(), read_assr() and read_tfr(). Results already stored from the same .abf files and parameters are
+    skipped, so the run can be resumed.
+    Note: on Windows and macOS scripts which call this function must be protected by `if __name__ == '__main__':`
+    :param manifest: DataFrame returned by study_manifest.study_manifest()
+    :param store: ResultStore object
+    :param channels: List of channels
+    :param tfr_freqs: Frequencies of group TFR in Hz, None (default) skips TFR
+    :param n_workers: Number of worker processes, default is number of CPU cores
+    :param overwrite: If True, stored results are calculated again
+    :return: list of StudyResult objects
+    """
+    tasks = study_tasks(manifest)
+    results = run_recordings(store, tasks, channels, n_workers=n_workers, overwrite=overwrite)
+    if tfr_freqs is not None:
+        results += run_group_tfrs(store, tasks, channels, freqs=tfr_freqs, n_workers=n_workers, overwrite=overwrite)
+    return results
+
+
+def read_spectra(store: ResultStore, calc: str, week: str, drug: str, phase: str, channel: str,
+                 experiment_phase='default_phase'):
+    """
+    Reads stored spectra of every mouse in the same format as psd_frequency_bands(all_freq=True) returns them
+    concatenated, for example, read_spectra(store, 'baseline', 'week_0', 'Ketamine', 'after_5_min', 'Aux1',
+    'After KET').
+    :param store: ResultStore object
+    :param calc: 'baseline', 'signal' or 'ratio'
+    :param week: Week, for example 'week_0'
+    :param drug: Drug, for example 'Ketamine'
+    :param phase: Experiment phase of the manifest, for example 'after_5_min'
+    :param channel: Channel, for example 'Aux1'
+    :param experiment_phase: Label written into experiment_phase column
+    :return: DataFrame indexed by freq with columns channel (power), calc, mouse, experiment_phase
+    """
+    table = store.read('spectra', columns=['power', 'mouse'], filters=[('calc', '==', calc)], week=week, drug=drug,
+                       phase=phase, channel=channel)
+    return pd.DataFrame({channel: table['power'], 'calc': calc, 'mouse': table['mouse'].astype(str),
+                         'experiment_phase': experiment_phase}, index=table.index)
+
+
+def read_bands(store: ResultStore, calc: str, week: str, drug: str, phase: str, channels=STUDY_CHANNELS,
+               experiment_phase='default_phase', band_names=None):
+    """
+    Reads stored band power of every mouse in the same format as table_of_frequency_bands() returns it.
+    :param store: ResultStore object
+    :param calc: 'baseline', 'signal' or 'ratio'
+    :param week: Week, for example 'week_0'
+    :param drug: Drug, for example 'Ketamine'
+    :param phase: Experiment phase of the manifest, for example 'after_5_min'
+    :param channels: List of channels
+    :param experiment_phase: Label written into experiment_phase column
+    :param band_names: List of bands, default is every band of FREQUENCY_BANDS (['40 hz'] gives ASSR band)
+    :return: DataFrame with columns mouse, experiment_phase, band_name, calc, brain_area and Power (Ratio if calc is
+    'ratio')
+    """
+    if band_names is None:
+        band_names = [band.name for band in FREQUENCY_BANDS]
+    table = store.read('bands', columns=['mouse', 'band_name', 'brain_area', 'power'],
+                       filters=[('calc', '==', calc), ('band_name', 'in', band_names)], week=week, drug=drug,
+                       phase=phase, channel=channels)
+    table = table.assign(experiment_phase=experiment_phase, calc=calc).reset_index(drop=True)
+    table = table[['mouse', 'experiment_phase', 'band_name', 'calc', 'brain_area', 'power']].astype({'mouse': str})
+    return table.rename(columns={'power': 'Ratio' if calc == 'ratio' else 'Power'})
+
+
+def read_assr(store: ResultStore, week: str, drug: str, phase: str, channel: str):
+    """
+    :return: DataFrame of stored 40 Hz ASSR parameters (see calc_assr()) with columns mouse_name, baseline_mean,
+    response_mean, ratio and plf of every mouse
+    """
+    columns = ['mouse', 'baseline_mean', 'response_mean', 'ratio', 'plf']
+    table = store.read('assr', columns=columns, week=week, drug=drug, phase=phase, channel=channel)
+    return table[columns].rename(columns={'mouse': 'mouse_name'}).reset_index(drop=True)
+
+
+def read_tfr(store: ResultStore, week: str, drug: str, phase: str, channel: str):
+    """
+    :return: tuple (freqs, times, power, itc, count) of stored group TFR, power and itc are arrays of shape
+    (freqs, times) and count is the number of recordings in the group
+    """
+    table = store.read('tfr', columns=['freq', 'time', 'power', 'itc', 'count'], week=week, drug=drug, phase=phase,
+                       channel=channel)
+    if table.empty:
+        raise ValueError(f"TFR of {week}/{drug}/{phase}/{channel} is not stored, run run_study() with tfr_freqs")
+    freqs, times = np.unique(table['freq']), np.unique(table['time'])
+    shape = (len(freqs), len(times))
+    return (freqs, times, table['power'].to_numpy().reshape(shape), table['itc'].to_numpy().reshape(shape),
+            int(table['count'].iloc[0]))
@@ -0,0 +1,181 @@
+import os
+import struct
+import numpy as np
+from abf_reader import (BLOCK_SIZE, EPISODIC_MODE, PROTOCOL_SECTION, ADC_SECTION, STRINGS_SECTION, DATA_SECTION,
+                        SYNCH_ARRAY_SECTION)
+
+DAC_SECTION = 108  # Byte position of DAC section descriptor in the ABF2 header
+ADC_RANGE = 10.0  # Input range of the digitizer in V
+ADC_RESOLUTION = 32768  # Number of int16 levels in ADC_RANGE
+
+SAMPLING_RATE = 2000  # Hz, the same as in the recordings of the study
+SWEEP_LENGTH = 6000  # Samples of one sweep (3 s)
+STIMULUS = (1.0, 2.0)  # Time window of the click train in seconds
+CLICK_RATE = 40  # Clicks per second (40 Hz ASSR)
+ADC_NAMES = ['IN 0', 'IN 1', 'IN 2']  # ADC names of STI, Aux1 and PFC channels (power_calculation.CHANNEL_ADC_NAMES)
+ADC_UNITS = ['V', 'uV', 'uV']
+
+
+def write_abf(filename: str, data, sampling_rate: int, adc_names=ADC_NAMES, adc_units=ADC_UNITS):
+    """
+    Writes episodic ABF2 file with int16 data, which can be read by pyabf and abf_reader.ABFMemmap. Every channel is
+    scaled so its largest value fits into the ADC range.
+    :param filename: name of the .abf file
+    :param data: array of shape (sweeps, channels, samples) in units of the channels
+    :param sampling_rate: Sampling rate in Hz
+    :param adc_names: ADC name of every channel
+    :param adc_units: Units of every channel
+    :return: array of the step (in channel units) of one ADC level of every channel
+    """
+    n_sweeps, n_channels, n_samples = data.shape
+    peak = np.abs(data).max(axis=(0, 2)) * 1.05 + 1e-12
+    scale_factors = ADC_RANGE / peak
+    gains = ADC_RANGE / (ADC_RESOLUTION * scale_factors)
+    raw = np.round(data / gains[None, :, None]).clip(-ADC_RESOLUTION, ADC_RESOLUTION - 1).astype('<i2')
+    interleaved = raw.transpose(0, 2, 1).reshape(-1)  # Samples of all channels are interleaved in ABF files
+
+    strings = [b'Clampex', b'C:\\protocols\\assr_40hz.pro']
+    for name, unit in zip(adc_names, adc_units):
+        strings += [name.encode(), unit.encode('latin-1')]
+    string_index = {}
+    for i, string in enumerate(strings, start=1):
+        string_index.setdefault(string, i)
+    strings_blob = b'\x00\x00' + b'\x00'.join(strings) + b'\x00'
+
+    def n_blocks(n_bytes):
+        return -(-n_bytes // BLOCK_SIZE)
+
+    protocol_block = 1
+    adc_block = protocol_block + 1
+    dac_block = adc_block + n_blocks(128 * n_channels)
+    strings_block = dac_block + n_blocks(256 * n_channels)
+    synch_block = strings_block + n_blocks(len(strings_blob))
+    data_block = synch_block + n_blocks(8 * n_sweeps)
+    header = bytearray(BLOCK_SIZE * data_block)
+    struct.pack_into('<4s4BII', header, 0, b'ABF2', 0, 0, 6, 2, BLOCK_SIZE, n_sweeps)
+    struct.pack_into('<I', header, 16, 20220726)  # Start date
+    struct.pack_into('<H', header, 30, 0)  # int16 data
+    struct.pack_into('<4BI', header, 56, 0, 0, 6, 2, 1)  # Creator version
+    struct.pack_into('<I', header, 72, 2)
+    for position, block, entry_size, count in [(PROTOCOL_SECTION, protocol_block, BLOCK_SIZE, 1),
+                                               (ADC_SECTION, adc_block, 128, n_channels),
+                                               (DAC_SECTION, dac_block, 256, n_channels),
+                                               (STRINGS_SECTION, strings_block, len(strings_blob), 1),
+                                               (DATA_SECTION, data_block, 2, interleaved.size),
+                                               (SYNCH_ARRAY_SECTION, synch_block, 8, n_sweeps)]:
+        struct.pack_into('<IIq', header, position, block, entry_size, count)
+
+    protocol = BLOCK_SIZE * protocol_block
+    struct.pack_into('<hf', header, protocol, EPISODIC_MODE, 1e6 / sampling_rate)
+    struct.pack_into('<i', header, protocol + 22, n_samples * n_channels)
+    struct.pack_into('<i', header, protocol + 30, n_sweeps)
+    struct.pack_into('<f', header, protocol + 62, n_samples / sampling_rate)
+    struct.pack_into('<f', header, protocol + 110, ADC_RANGE)
+    struct.pack_into('<i', header, protocol + 118, ADC_RESOLUTION)
+
+    for i in range(n_channels):
+        adc = BLOCK_SIZE * adc_block + i * 128
+        struct.pack_into('<h', header, adc, i)
+        struct.pack_into('<hh', header, adc + 24, i, i)
+        struct.pack_into('<ff', header, adc + 28, 1.0, 1.0)  # Programmable gain, instrument scale factor
+        struct.pack_into('<f', header, adc + 40, float(scale_factors[i]))
+        struct.pack_into('<f', header, adc + 48, 1.0)  # Signal gain
+        struct.pack_into('<ii', header, adc + 74, string_index[adc_names[i].encode()],
+                         string_index[adc_units[i].encode('latin-1')])
+        struct.pack_into('<h', header, BLOCK_SIZE * dac_block + i * 256, i)
+    for k in range(n_sweeps):
+        struct.pack_into('<ii', header, BLOCK_SIZE * synch_block + 8 * k, k * n_samples * n_channels,
+                         n_samples * n_channels)
+    strings_start = BLOCK_SIZE * strings_block
+    header[strings_start:strings_start + len(strings_blob)] = strings_blob
+
+    with open(filename, 'wb') as fb:
+        fb.write(header)
+        fb.write(interleaved.tobytes())
+    return gains
+
+
+def pink_noise(shape: tuple, sampling_rate: int, exponent=1.0, rng=None):
+    """
+    :param shape: Shape of the result, noise is generated along the last axis
+    :param sampling_rate: Sampling rate in Hz
+    :param exponent: Exponent of the power spectrum 1/f^exponent (1 is pink noise, 2 is brown noise)
+    :param rng: numpy Generator
+    :return: array of noise with unit standard deviation
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    spectrum = np.fft.rfft(rng.standard_normal(shape), axis=-1)
+    freqs = np.fft.rfftfreq(shape[-1], 1 / sampling_rate)
+    freqs[0] = freqs[1]  # No infinite power at 0 Hz
+    noise = np.fft.irfft(spectrum / freqs ** (exponent / 2), n=shape[-1], axis=-1)
+    noise -= noise.mean(axis=-1, keepdims=True)
+    return noise / noise.std()
+
+
+def synthetic_sweeps(n_sweeps: int, sweep_length=SWEEP_LENGTH, sampling_rate=SAMPLING_RATE, background=(60., 40.),
+                     response=(8., 4.), exponent=1.0, phase_jitter=0.5, seed=0):
+    """
+    Generates recording of 40 Hz auditory steady-state response (ASSR) experiment: STI channel with click train in
+    STIMULUS window and two ECoG channels (Aux1 and PFC) with 1/f background and 40 Hz response to the clicks.
+    :param n_sweeps: Number of sweeps
+    :param sweep_length: Number of samples of every sweep
+    :param sampling_rate: Sampling rate in Hz
+    :param background: Standard deviation of 1/f background of Aux1 and PFC in uV
+    :param response: Amplitude of 40 Hz response of Aux1 and PFC in uV
+    :param exponent: Exponent of the background power spectrum 1/f^exponent
+    :param phase_jitter: Standard deviation of response phase between sweeps in radians, 0 gives phase locking 1
+    :param seed: Seed of the random generator, the same seed gives the same recording
+    :return: array of shape (sweeps, 3, samples), STI in V and ECoG in uV
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(sweep_length) / sampling_rate
+    stimulus = (t >= STIMULUS[0]) & (t < STIMULUS[1])
+    clicks = stimulus & (np.floor(t * CLICK_RATE) != np.floor((t - 1 / sampling_rate) * CLICK_RATE))
+    data = np.empty((n_sweeps, 3, sweep_length))
+    data[:, 0] = np.where(clicks, 5.0, 0.0)  # 5 V click pulse at the start of every click period
+    phases = rng.normal(0, phase_jitter, size=(n_sweeps, 1))
+    for channel, (noise_std, amplitude) in enumerate(zip(background, response), start=1):
+        data[:, channel] = noise_std * pink_noise((n_sweeps, sweep_length), sampling_rate, exponent, rng)
+        data[:, channel] += stimulus * amplitude * np.sin(2 * np.pi * CLICK_RATE * (t - STIMULUS[0]) + phases)
+    return data
+
+
+def write_synthetic_abf(filename: str, n_sweeps: int, sweep_length=SWEEP_LENGTH, sampling_rate=SAMPLING_RATE,
+                        seed=0, **kwargs):
+    """
+    Writes synthetic ASSR recording (see synthetic_sweeps()) into .abf file with STI, Aux1 and PFC channels.
+    For example, write_synthetic_abf('test.abf', n_sweeps=100).
+    :param filename: name of the .abf file
+    :param n_sweeps: Number of sweeps
+    :param sweep_length: Number of samples of every sweep
+    :param sampling_rate: Sampling rate in Hz
+    :param seed: Seed of the random generator
+    :param kwargs: Other parameters of synthetic_sweeps()
+    :return: filename
+    """
+    write_abf(filename, synthetic_sweeps(n_sweeps, sweep_length, sampling_rate, seed=seed, **kwargs), sampling_rate)
+    return filename
+
+
+def synthetic_study(folder: str, mouse_names: list, groups: dict, n_sweeps=100, **kwargs):
+    """
+    Writes synthetic recordings of the whole study, one file for every mouse of every week, drug and phase.
+    :param folder: Folder of the recordings
+    :param mouse_names: List of mice names, for example ['M1', 'M2']
+    :param groups: Dictionary {week: {drug: [phases]}}, for example {'week_0': {'Ketamine': ['after_5_min']}}
+    :param n_sweeps: Number of sweeps of every recording
+    :param kwargs: Other parameters of synthetic_sweeps()
+    :return: dictionary {week: {drug: {phase: [files]}}} in the same format as data.mice_data
+    """
+    os.makedirs(folder, exist_ok=True)
+    mice_data, seed = {}, 0
+    for week, drugs in groups.items():
+        for drug, phases in drugs.items():
+            for phase in phases:
+                files = []
+                for mouse in mouse_names:
+                    filename = os.path.join(folder, f'{week}_{drug}_{phase}_{mouse}.abf')
+                    files.append(write_synthetic_abf(filename, n_sweeps, seed=seed, **kwargs))
+                    seed += 1
+                mice_data.setdefault(week, {}).setdefault(drug, {})[phase] = files
+    return mice_data
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class LongTableBuilder:
+    """
+    Collects rows of a long (melted) table, for example, results of psd_frequency_bands() of many recordings, into
+    preallocated columnar arrays and creates the table once at the end, so building takes linear time instead of
+    repeated pd.concat(). Label columns are stored as integer codes of categories, so repeated strings (mouse,
+    experiment phase, band, calc, brain area) take memory only once.
+    """
+
+    def __init__(self, label_columns: list, value_columns: list, capacity=1024):
+        """
+        :param label_columns: Names of text columns, for example ['mouse', 'experiment_phase', 'band_name', 'calc',
+        'brain_area']
+        :param value_columns: Names of numeric columns, for example ['Power']
+        :param capacity: Number of rows allocated at the start, arrays are doubled when they are full
+        """
+        self.label_columns = list(label_columns)
+        self.value_columns = list(value_columns)
+        self._codes = {column: np.empty(capacity, dtype=np.int32) for column in self.label_columns}
+        self._values = {column: np.empty(capacity) for column in self.value_columns}
+        self._categories = {column: {} for column in self.label_columns}  # label -> code of every label column
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    def _reserve(self, rows: int):
+        # Doubles arrays until rows more rows fit into them
+        capacity = len(next(iter(self._values.values())))
+        if self._rows + rows <= capacity:
+            return
+        while self._rows + rows > capacity:
+            capacity *= 2
+        for arrays in (self._codes, self._values):
+            for column, array in arrays.items():
+                grown = np.empty(capacity, dtype=array.dtype)
+                grown[:self._rows] = array[:self._rows]
+                arrays[column] = grown
+
+    def append(self, frame=None, **columns):
+        """
+        Adds rows. Columns can be given as a dataframe and/or as keyword arguments, single values are repeated for
+        every row. For example, builder.append(psd_frequency_bands(...)) or
+        builder.append(Power=[1.0, 2.0], mouse='M1', brain_area=['Aux1', 'PFC'], ...).
+        :param frame: DataFrame which has every label and value column (other columns are ignored)
+        :param columns: Values of columns which are not in frame
+        """
+        import pandas as pd
+        if frame is not None:
+            columns = {**{column: frame[column].to_numpy() for column in self.label_columns + self.value_columns
+                          if column in frame.columns}, **columns}
+        missing = [column for column in self.label_columns + self.value_columns if column not in columns]
+        if missing:
+            raise ValueError(f"Columns {missing} are missing")
+        rows = max(np.size(value) if np.ndim(value) else 1 for value in columns.values())
+        self._reserve(rows)
+        new = slice(self._rows, self._rows + rows)
+
+        for column in self.label_columns:
+            categories = self._categories[column]
+            codes, uniques = pd.factorize(np.broadcast_to(np.asarray(columns[column], dtype=object), rows))
+            mapping = np.array([categories.setdefault(label, len(categories)) for label in uniques], dtype=np.int32)
+            self._codes[column][new] = mapping[codes]
+        for column in self.value_columns:
+            self._values[column][new] = columns[column]
+        self._rows += rows
+
+    def build(self):
+        """
+        :return: DataFrame with label columns (categorical) followed by value columns
+        """
+        import pandas as pd
+        table = {}
+        for column in self.label_columns:
+            categories = list(self._categories[column])
+            table[column] = pd.Categorical.from_codes(self._codes[column][:self._rows], categories=categories)
+        for column in self.value_columns:
+            table[column] = self._values[column][:self._rows].copy()
+        return pd.DataFrame(table)
+
+
+def remove_unused_categories(table):
+    """
+    Removes categories which do not appear in the table (for example, after filtering of the table built with
+    LongTableBuilder), so plots and groupby do not show empty groups.
+    :param table: DataFrame
+    :return: DataFrame with the same values
+    """
+    import pandas as pd
+    return table.apply(lambda column: column.cat.remove_unused_categories()
+                       if isinstance(column.dtype, pd.CategoricalDtype) else column)
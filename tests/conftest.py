@@ -0,0 +1,39 @@
+import pytest
+import power_calculation
+import spectral
+from ecog_cache import RecordingCache
+from result_cache import ResultCache
+from synthetic_abf import SAMPLING_RATE, synthetic_sweeps, write_synthetic_abf
+
+N_SWEEPS = 6  # Sweeps of test recordings, enough for averages over epochs and small enough for fast tests
+
+
+@pytest.fixture(scope='session')
+def abf_file(tmp_path_factory):
+    """Synthetic ASSR recording (STI, Aux1 and PFC channels, 3 s sweeps at 2000 Hz), see synthetic_abf.py"""
+    return write_synthetic_abf(str(tmp_path_factory.mktemp('abf') / 'recording.abf'), n_sweeps=N_SWEEPS)
+
+
+@pytest.fixture(scope='session')
+def sweeps():
+    """Array of shape (sweeps, 2, samples) of synthetic Aux1 and PFC sweeps in V"""
+    return synthetic_sweeps(N_SWEEPS)[:, 1:] * 1e-6
+
+
+@pytest.fixture
+def sampling_rate():
+    return SAMPLING_RATE
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    """Recording and result caches of every test are stored in its temporary folder, not in the user's home"""
+    monkeypatch.setattr(power_calculation, 'recording_cache', RecordingCache(str(tmp_path / 'recordings')))
+    monkeypatch.setattr(power_calculation, 'result_cache', ResultCache(str(tmp_path / 'results')))
+
+
+@pytest.fixture
+def empty_spectral_cache(monkeypatch):
+    """Tapers, windows and filters of the test are built again, the cache of spectral.py starts empty"""
+    monkeypatch.setattr(spectral, '_cache', {})
+    monkeypatch.setattr(spectral, '_stats', {'hits': 0, 'misses': 0, 'saved_seconds': 0.0})
@@ -0,0 +1,45 @@
+import numpy as np
+import pyabf
+import pytest
+from abf_reader import ABFMemmap, compare_with_pyabf, open_abf, sample_range
+
+
+@pytest.fixture(scope='module')
+def pyabf_sweeps(abf_file):
+    abf = pyabf.ABF(abf_file)
+    return abf, abf.data.reshape(abf.channelCount, abf.sweepCount, abf.sweepPointCount).transpose(1, 0, 2)
+
+
+def test_header_matches_pyabf(abf_file, pyabf_sweeps):
+    abf, _ = pyabf_sweeps
+    reader = ABFMemmap(abf_file)
+    assert reader.adc_names == abf.adcNames
+    assert reader.adc_units == abf.adcUnits
+    assert reader.sampling_rate == abf.dataRate
+    assert reader.shape == (abf.sweepCount, abf.channelCount, abf.sweepPointCount)
+
+
+def test_read_matches_pyabf(abf_file, pyabf_sweeps):
+    _, expected = pyabf_sweeps
+    data = open_abf(abf_file).read()
+    assert data.dtype == np.float32
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_read_window_and_channels(abf_file, pyabf_sweeps):
+    abf, expected = pyabf_sweeps
+    samples = sample_range(0.2, 0.9, abf.dataRate, abf.sweepPointCount)
+    assert (samples.start, samples.stop) == (400, 1801)  # Both ends are included, the same as mne tmin and tmax
+    data = ABFMemmap(abf_file).read([2, 1], t_min=0.2, t_max=0.9, sweeps=slice(1, 4))
+    np.testing.assert_array_equal(data, expected[1:4][:, [2, 1], samples])
+
+
+def test_iter_sweeps_gives_every_sweep(abf_file):
+    reader = ABFMemmap(abf_file)
+    chunks = list(reader.iter_sweeps(4, channels=[1], t_max=1.0))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    np.testing.assert_array_equal(np.concatenate(chunks), reader.read([1], t_max=1.0))
+
+
+def test_compare_with_pyabf(abf_file):
+    assert compare_with_pyabf(abf_file) == 0
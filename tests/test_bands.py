@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+from bands import ASSR_BAND, FREQUENCY_BANDS, Band, band_bins, band_power, band_table
+
+FREQS = np.arange(0, 101, 0.5)
+
+
+def _between_means(spectra, freqs, bands):
+    # Mean of every band the way psd_frequency_bands() took it before, with pandas between()
+    index = pd.Series(freqs)
+    return np.stack([spectra[..., index.between(band.f_min, band.f_max, inclusive=band.inclusive).to_numpy()]
+                     .mean(axis=-1) for band in bands], axis=-1)
+
+
+@pytest.mark.parametrize('bands', [FREQUENCY_BANDS, ASSR_BAND, FREQUENCY_BANDS + ASSR_BAND])
+def test_band_power_matches_pandas_between(bands):
+    spectra = np.random.default_rng(0).random((3, 2, FREQS.size))
+    power = band_power(spectra, FREQS, bands)
+    assert power.shape == (3, 2, len(bands))
+    np.testing.assert_allclose(power, _between_means(spectra, FREQS, bands), rtol=1e-12)
+
+
+def test_band_bins_of_band_ends():
+    starts, stops = band_bins(FREQS, [Band('a', 38, 42, 'neither'), Band('b', 38, 42), ('c', 100, 100)])
+    np.testing.assert_array_equal(FREQS[starts], [38.5, 38, 100])
+    np.testing.assert_array_equal(FREQS[stops - 1], [41.5, 42, 100])
+    power = band_power(np.ones(FREQS.size), FREQS, [Band('empty', 38.1, 38.4), Band('above', 200, 300)])
+    assert np.isnan(power).all()  # Bands without frequency bins
+    with pytest.raises(ValueError, match='left'):
+        band_bins(FREQS, [Band('a', 1, 2, 'left')])
+
+
+def test_band_table():
+    spectra = pd.DataFrame({'Aux1': FREQS, 'PFC': 2 * FREQS}, index=pd.Index(FREQS, name='freq'))
+    table = band_table(spectra, [Band('x', 10, 20), Band('y', 30, 40)])
+    assert table.columns.tolist() == ['Aux1', 'PFC', 'band_name']
+    assert table['band_name'].tolist() == ['x', 'y']
+    np.testing.assert_allclose(table[['Aux1', 'PFC']].to_numpy(), [[15, 30], [35, 70]])
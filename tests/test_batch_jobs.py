@@ -0,0 +1,117 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import power_calculation
+from batch_jobs import load_spec, main, plan_jobs, run_plan, spec_manifest
+from result_store import ResultStore
+from synthetic_abf import write_synthetic_abf
+
+DATA = """mice_data = {'week_0': {'Ketamine': {'after': ['k0.abf', 'k1.abf']},
+                       'Saline': {'after': ['s0.abf', 's1.abf']}}}
+mouse_names = ['M1', 'M2']
+"""
+
+
+@pytest.fixture
+def spec(tmp_path):
+    for i, name in enumerate(['k0.abf', 'k1.abf', 's0.abf']):  # s1.abf is missing
+        write_synthetic_abf(str(tmp_path / name), n_sweeps=2, seed=i)
+    (tmp_path / 'data.py').write_text(DATA)
+    return {'data': {'file': str(tmp_path / 'data.py'), 'data_dir': str(tmp_path)},
+            'targets': [{'name': 'aux_baseline', 'output': 'spectra', 'channels': ['Aux1'],
+                         'conditions': {'drug': 'Ketamine'}, 'file': str(tmp_path / 'tables' / 'aux.csv')},
+                        {'name': 'pfc_ratio', 'output': 'bands', 'calc': ['ratio'], 'channels': ['PFC'],
+                         'conditions': [{'drug': 'Ketamine', 'mouse': 'M1'}, {'drug': 'Saline'}]},
+                        {'name': 'assr', 'output': 'assr', 'conditions': {'drug': 'Ketamine'}}]}
+
+
+def _write_spec(tmp_path, spec):
+    filename = str(tmp_path / 'jobs.json')
+    with open(filename, 'w') as f:
+        json.dump(spec, f)
+    return filename
+
+
+def test_load_spec_rejects_unknown_keys(tmp_path, spec):
+    assert load_spec(_write_spec(tmp_path, spec)) == spec
+    with pytest.raises(ValueError, match='storage'):
+        load_spec(_write_spec(tmp_path, {**spec, 'storage': 'store'}))
+    spec['targets'][0]['chanels'] = ['Aux1']
+    with pytest.raises(ValueError, match='chanels'):
+        load_spec(_write_spec(tmp_path, spec))
+
+
+def test_identical_calculations_are_merged(spec):
+    manifest = spec_manifest(spec)
+    plan = plan_jobs(spec, manifest)
+    assert [target.name for target in plan.targets] == ['aux_baseline', 'pfc_ratio', 'assr']
+    assert plan.requests == 2 + 3 + 2
+    spectra = {computation.path.rsplit('/', 1)[-1]: channels for computation, channels in plan.computations.items()
+               if computation.kind == 'spectra'}
+    windows = power_calculation.WINDOWS
+    assert spectra['k0.abf'] == (['Aux1', 'PFC'], {name: tuple(windows[name]) for name in ('baseline', 'signal')})
+    assert spectra['k1.abf'] == (['Aux1'], {'baseline': tuple(windows['baseline'])})
+    assert sorted(spectra) == ['k0.abf', 'k1.abf', 's0.abf', 's1.abf']
+    assert sum(computation.kind == 'assr' for computation in plan.computations) == 2
+
+
+@pytest.mark.parametrize('target, match', [({'output': 'table'}, 'Wrong output'),
+                                           ({'output': 'spectra', 'conditions': {'dose': 1}}, 'dose'),
+                                           ({'output': 'spectra', 'conditions': {'drug': 'Water'}}, 'no recordings'),
+                                           ({'output': 'spectra', 'windows': {'baseline': [0.1, 0.5]}}, 'differs'),
+                                           ({'output': 'spectra', 'calc': ['late']}, 'late')])
+def test_wrong_targets_are_rejected(spec, target, match):
+    spec['targets'].append({'name': 'wrong', **target})
+    with pytest.raises(ValueError, match=match):
+        plan_jobs(spec, spec_manifest(spec))
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_tables_match_direct_calculation(spec, n_workers, empty_spectral_cache):
+    manifest = spec_manifest(spec).set_index(['drug', 'mouse'])
+    tables, results, report = run_plan(plan_jobs(spec, spec_manifest(spec)), n_workers=n_workers, verbose=False)
+    assert (report['computations'], report['done'], report['failed']) == (6, 5, 1)
+    failed, = [result for result in results if result.status == 'failed']
+    assert failed.computation.path.endswith('s1.abf') and 's1.abf' in failed.error
+    assert {'taper_hits', 'tapers_built', 'taper_saved_s'} <= set(report)
+    if n_workers > 1:
+        assert report['tapers_built'] == 0 and report['taper_hits'] > 0  # Built before the pool started
+
+    path = manifest.loc[('Ketamine', 'M2'), 'path']
+    spectra = tables['aux_baseline']
+    rows = spectra[spectra['mouse'] == 'M2']
+    windows = {'baseline': power_calculation.WINDOWS['baseline']}
+    expected = power_calculation.psd_windows(path, ['Aux1'], windows=windows, f_min=0, f_max=101)['baseline']
+    np.testing.assert_allclose(rows['freq'], expected.index)
+    np.testing.assert_allclose(rows['power'], expected['Aux1'], rtol=1e-12)
+
+    bands = tables['pfc_ratio']
+    assert sorted(bands[['drug', 'mouse']].drop_duplicates().astype(str).values.tolist()) == [['Ketamine', 'M1'],
+                                                                                              ['Saline', 'M1']]
+    path = manifest.loc[('Ketamine', 'M1'), 'path']
+    direct = power_calculation.psd_frequency_bands(path, ['PFC'], 'M1', calc='ratio')
+    rows = bands[bands['drug'] == 'Ketamine']
+    assert rows['band_name'].astype(str).tolist() == direct['band_name'].astype(str).tolist()
+    np.testing.assert_allclose(rows['power'], direct['Ratio'].to_numpy(float), rtol=1e-12)
+
+    assr = tables['assr'].astype({'mouse': str, 'brain_area': str}).set_index(['mouse', 'brain_area'])
+    calculated = power_calculation.calc_assr(power_calculation.import_ecog(path, channels=['Aux1', 'PFC']))
+    np.testing.assert_allclose(assr.loc[('M1', 'PFC'), calculated.columns].to_numpy(float),
+                               calculated.loc['PFC'].to_numpy(float), rtol=1e-12)
+
+
+def test_main_dry_run_and_outputs(tmp_path, spec, capsys):
+    filename = _write_spec(tmp_path, {**spec, 'store': str(tmp_path / 'store')})
+    assert main([filename, '--dry-run']) == 0
+    output = capsys.readouterr().out
+    assert '7 requested calculations, 6 after merging identical ones (4 spectra, 2 assr)' in output
+    assert not (tmp_path / 'tables').exists()
+
+    assert main([filename, '--workers', '1', '--quiet']) == 1  # s1.abf is missing
+    captured = capsys.readouterr()
+    assert 'Failed: spectra' in captured.err and 'Tapers and windows:' in captured.out
+    table = pd.read_csv(tmp_path / 'tables' / 'aux.csv')
+    assert set(table['mouse']) == {'M1', 'M2'} and set(table['brain_area']) == {'Aux1'}
+    stored = ResultStore(str(tmp_path / 'store')).read('assr', filters=[('brain_area', '==', 'PFC')])
+    assert sorted(stored['mouse'].astype(str)) == ['M1', 'M2']
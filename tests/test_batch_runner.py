@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+import power_calculation
+from batch_runner import BandJob, band_jobs, concat_results, failed_jobs, run_band_jobs
+from synthetic_abf import write_synthetic_abf
+
+
+@pytest.fixture
+def study_files(tmp_path):
+    return [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(3)]
+
+
+def test_band_jobs_pair_files_and_mice(study_files):
+    jobs = band_jobs(study_files, ['M1', 'M2', 'M3'], 'after', 'ratio', ['Aux1'], all_freq=True)
+    assert [(job.filename, job.mouse_name) for job in jobs] == list(zip(study_files, ['M1', 'M2', 'M3']))
+    assert jobs[0] == BandJob(study_files[0], 'M1', 'after', 'ratio', ['Aux1'], False, True)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_results_match_psd_frequency_bands(study_files, tmp_path, n_workers):
+    files = study_files[:1] + [str(tmp_path / 'missing.abf')] + study_files[1:]
+    jobs = band_jobs(files, ['M1', 'M0', 'M2', 'M3'], 'after', 'baseline', ['Aux1', 'PFC'])
+    results = run_band_jobs(jobs, n_workers=n_workers)
+    assert [result.job for result in results] == jobs
+    assert failed_jobs(results) == [results[1]]
+    assert results[1].result is None and 'missing.abf' in results[1].error
+    expected = pd.concat([power_calculation.psd_frequency_bands(job.filename, job.channels, job.mouse_name,
+                                                                job.experiment_phase, job.calc, use_cache=False)
+                          for job in jobs if job.mouse_name != 'M0'])
+    pd.testing.assert_frame_equal(concat_results(results), expected)
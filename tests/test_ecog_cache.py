@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import power_calculation
+from ecog_cache import RecordingCache, recording_key
+from synthetic_abf import write_synthetic_abf
+
+LAYOUT = (power_calculation.CHANNEL_NAMES, power_calculation.CHANNEL_TYPES)
+
+
+class CountingLoader:
+    # Loader of RecordingCache.get() which counts how many times recordings are decoded
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, filename):
+        self.calls += 1
+        return power_calculation._decode_abf(filename)
+
+
+def test_recording_key_changes_with_file_and_layout(tmp_path):
+    filename = write_synthetic_abf(str(tmp_path / 'a.abf'), n_sweeps=2)
+    key, digest = recording_key(filename, LAYOUT)
+    assert recording_key(filename, LAYOUT) == (key, digest)
+    assert recording_key(filename, LAYOUT + ('other',))[1] != digest
+    write_synthetic_abf(filename, n_sweeps=3)
+    assert recording_key(filename, LAYOUT)[1] != digest
+
+
+def test_memory_and_disk_hits(abf_file, tmp_path):
+    loader = CountingLoader()
+    cache = RecordingCache(str(tmp_path / 'store'))
+    data, sampling_rate = cache.get(abf_file, LAYOUT, loader)
+    assert cache.get(abf_file, LAYOUT, loader)[0] is data
+    assert not data.flags.writeable  # Cached arrays are shared, so they are read-only
+    # Another process (a new cache with the same folder) opens the stored recording without decoding it
+    other = RecordingCache(str(tmp_path / 'store'))
+    stored, stored_rate = other.get(abf_file, LAYOUT, loader)
+    assert loader.calls == 1
+    assert stored_rate == sampling_rate
+    assert isinstance(stored, np.memmap) and not stored.flags.writeable
+    np.testing.assert_array_equal(stored, data)
+    assert (cache.info()['misses'], cache.info()['hits'], other.info()['disk_hits']) == (1, 1, 1)
+
+
+def test_memory_limit_keeps_recent_recordings(tmp_path):
+    files = [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(3)]
+    cache = RecordingCache(str(tmp_path / 'store'), max_bytes=1, use_disk=False)
+    for filename in files:
+        cache.get(filename, LAYOUT, power_calculation._decode_abf)
+    info = cache.info()
+    assert (info['entries'], info['disk_bytes']) == (1, 0)
+    assert info['memory_bytes'] == cache.get(files[-1], LAYOUT, power_calculation._decode_abf)[0].nbytes
+
+
+def test_disk_limit_evicts_least_recently_used(tmp_path):
+    files = [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(3)]
+    store = str(tmp_path / 'store')
+    writer = RecordingCache(store)
+    for age, filename in zip((300, 200), files[:2]):
+        writer.get(filename, LAYOUT, power_calculation._decode_abf)
+        data_path = writer._paths(recording_key(filename, LAYOUT)[1])[0]
+        os.utime(data_path, ns=(os.stat(data_path).st_mtime_ns - age * 10 ** 9,) * 2)  # Used age seconds ago
+    size = writer.info()['disk_bytes'] // 2
+
+    reader = RecordingCache(store, max_disk_bytes=2 * size)
+    reader.get(files[0], LAYOUT, power_calculation._decode_abf)  # Disk hit marks the oldest recording as used
+    reader.get(files[2], LAYOUT, power_calculation._decode_abf)
+    stored = {digest for _, _, digest in reader._stored()}
+    assert stored == {recording_key(files[i], LAYOUT)[1] for i in (0, 2)}
+    assert (reader.info()['evictions'], reader.info()['disk_bytes']) == (1, 2 * size)
+
+
+def test_stale_entries_are_deleted(tmp_path):
+    filename = write_synthetic_abf(str(tmp_path / 'a.abf'), n_sweeps=2)
+    cache = RecordingCache(str(tmp_path / 'store'))
+    cache.get(filename, LAYOUT, power_calculation._decode_abf)
+    write_synthetic_abf(filename, n_sweeps=3)  # The file is recorded again
+    data, _ = cache.get(filename, LAYOUT, power_calculation._decode_abf)
+    assert data.shape[0] == 3
+    assert cache.info()['evictions'] == 1
+    assert [digest for _, _, digest in cache._stored()] == [recording_key(filename, LAYOUT)[1]]
+
+
+def test_import_ecog_uses_recording_cache(abf_file):
+    epochs = power_calculation.import_ecog(abf_file)
+    again = power_calculation.import_ecog(abf_file)
+    expected = power_calculation.import_ecog(abf_file, use_cache=False)
+    info = power_calculation.recording_cache.info()
+    assert (info['misses'], info['hits']) == (1, 1)
+    assert epochs.ch_names == power_calculation.CHANNEL_NAMES
+    np.testing.assert_array_equal(epochs.get_data(), expected.get_data())
+    epochs._data *= 2  # Every EpochsArray has its own data, the cached recording is not changed
+    np.testing.assert_array_equal(again.get_data(), expected.get_data())
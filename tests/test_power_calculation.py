@@ -0,0 +1,201 @@
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pyabf
+import pytest
+import power_calculation
+from benchmark import _reference_psd, _reference_psd_frequency_bands
+from synthetic_abf import synthetic_sweeps, write_abf, write_synthetic_abf
+
+
+def _sweep_by_sweep(filename: str):
+    # Sweeps of every channel read one by one with pyabf, the way import_ecog() read them before
+    abf = pyabf.ABF(filename)
+    data = np.empty((abf.sweepCount, abf.channelCount, abf.sweepPointCount))
+    for sweep in abf.sweepList:
+        for channel in range(abf.channelCount):
+            abf.setSweep(sweep, channel=channel)
+            data[sweep, channel] = abf.sweepY
+    return data * 1e-6
+
+
+def _write(tmp_path, adc_names: list, adc_units: list, n_channels=3):
+    data = synthetic_sweeps(2)
+    data = np.concatenate([data, data[:, 1:]], axis=1)[:, :n_channels]
+    filename = str(tmp_path / 'layout.abf')
+    write_abf(filename, data, 2000, adc_names, adc_units)
+    return filename
+
+
+@pytest.mark.parametrize('reader', ['memmap', 'pyabf'])
+def test_decode_matches_sweep_by_sweep_reading(abf_file, monkeypatch, reader):
+    if reader == 'pyabf':
+        monkeypatch.setattr(power_calculation, 'open_abf', lambda filename: None)
+    data, sampling_rate = power_calculation._decode_abf(abf_file)
+    assert sampling_rate == 2000
+    np.testing.assert_array_equal(data, _sweep_by_sweep(abf_file))
+    subset, _ = power_calculation._decode_abf(abf_file, ['PFC', 'Aux1'], t_min=0.2, t_max=0.9)
+    np.testing.assert_array_equal(subset, data[:, [2, 1], 400:1801])
+
+
+@pytest.mark.parametrize('adc_units, n_channels', [(['V', 'uV', 'uV', 'uV'], 4),  # Unexpected extra channel
+                                                   (['uV', 'V', 'uV'], 3),  # Stimulus channel is not the first one
+                                                   (['V', 'mV', 'mV'], 3)])  # ECoG is not recorded in uV
+def test_unexpected_layout_is_rejected(tmp_path, adc_units, n_channels):
+    filename = _write(tmp_path, [f'IN {i}' for i in range(n_channels)], adc_units, n_channels)
+    with pytest.raises(ValueError, match='layout.abf'):
+        power_calculation.import_ecog(filename)
+    with pytest.raises(ValueError):
+        power_calculation.psd(filename, ['Aux1'], use_cache=False)
+
+
+def test_channels_found_by_adc_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(power_calculation, 'CHANNEL_ADC_NAMES', ['Stim', 'Ctx', 'Pfc'])
+    filename = _write(tmp_path, ['Pfc', 'Stim', 'Extra', 'Ctx'], ['uV', 'V', 'uV', 'uV'], n_channels=4)
+    expected = _sweep_by_sweep(filename)
+    data, _ = power_calculation._decode_abf(filename, ['Aux1', 'PFC', 'STI'])
+    np.testing.assert_array_equal(data, expected[:, [3, 0, 1]])
+    monkeypatch.setattr(power_calculation, 'CHANNEL_ADC_NAMES', ['Stim', 'Ctx', 'Missing'])
+    with pytest.raises(ValueError, match='Missing'):
+        power_calculation._decode_abf(filename)
+
+
+def test_windows_are_read_without_caching_the_recording(abf_file, monkeypatch):
+    expected = _sweep_by_sweep(abf_file)[:, [2, 1], 400:1801]
+    data, sampling_rate = power_calculation._load_array(abf_file, channels=['PFC', 'Aux1'], t_min=0.2, t_max=0.9)
+    np.testing.assert_array_equal(data, expected)
+    info = power_calculation.recording_cache.info()
+    assert (info['misses'], info['entries']) == (0, 0)
+    # pyabf reads whole files, so windows of files it reads are sliced from the cached recording
+    monkeypatch.setattr(power_calculation, 'open_abf', lambda filename: None)
+    for _ in range(2):
+        data, _ = power_calculation._load_array(abf_file, channels=['PFC', 'Aux1'], t_min=0.2, t_max=0.9)
+        assert data.flags.writeable
+        np.testing.assert_array_equal(data, expected)
+    info = power_calculation.recording_cache.info()
+    assert (info['misses'], info['hits']) == (1, 1)
+
+
+def test_windows_are_calculated_from_one_load(abf_file, monkeypatch):
+    loads = []
+    load_array = power_calculation._load_array
+    monkeypatch.setattr(power_calculation, '_load_array', lambda *args, **kwargs: loads.append(args) or
+                        load_array(*args, **kwargs))
+    spectra = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], use_cache=False)
+    assert len(loads) == 1
+    for name, (t_min, t_max) in power_calculation.WINDOWS.items():
+        expected = power_calculation.psd(abf_file, ['Aux1', 'PFC'], t_min=t_min, t_max=t_max, use_cache=False)
+        pd.testing.assert_frame_equal(spectra[name], expected, rtol=1e-12)
+    ratio = power_calculation.psd_calc([abf_file], ['Aux1', 'PFC'], calc='ratio', use_cache=False)
+    pd.testing.assert_frame_equal(ratio, spectra['signal'] / spectra['baseline'], rtol=1e-12)
+
+
+@pytest.mark.parametrize('method, filter_data', [('multitaper', False), ('welch', False), ('multitaper', True)])
+def test_psd_matches_mne_data_frame_path(abf_file, method, filter_data):
+    # The same spectra as mne compute_psd(), to_data_frame() and groupby mean over epochs gave before
+    expected = _reference_psd(abf_file, ['Aux1', 'PFC'], method=method, filter_data=filter_data)
+    result = power_calculation.psd(abf_file, ['Aux1', 'PFC'], method=method, filter_data=filter_data)
+    np.testing.assert_allclose(result.index, expected.index)
+    np.testing.assert_allclose(result.to_numpy(), expected[['Aux1', 'PFC']].to_numpy(), rtol=1e-9)
+
+
+@pytest.mark.parametrize('calc, frequency_40', [('baseline', False), ('ratio', False), ('signal', True)])
+def test_psd_frequency_bands_matches_mne_data_frame_path(abf_file, calc, frequency_40):
+    expected = _reference_psd_frequency_bands(abf_file, ['Aux1', 'PFC'], 'M1', calc=calc, frequency_40=frequency_40)
+    result = power_calculation.psd_frequency_bands(abf_file, ['Aux1', 'PFC'], 'M1', calc=calc,
+                                                   frequency_40=frequency_40)
+    value = 'Ratio' if calc == 'ratio' else 'Power'
+    assert list(result.columns) == list(expected.columns)
+    for column in ['mouse', 'experiment_phase', 'band_name', 'calc', 'brain_area']:
+        assert result[column].astype(str).tolist() == expected[column].astype(str).tolist()
+    np.testing.assert_allclose(result[value].to_numpy(float), expected[value].to_numpy(float), rtol=1e-9)
+
+
+@pytest.mark.parametrize('reader', ['memmap', 'pyabf'])
+def test_stream_ecog_chunks_join_into_the_recording(abf_file, monkeypatch, reader):
+    if reader == 'pyabf':
+        monkeypatch.setattr(power_calculation, 'open_abf', lambda filename: None)
+    chunks, sampling_rate = power_calculation.stream_ecog(abf_file, 4, ['PFC', 'Aux1'], t_min=0.2, t_max=1.9)
+    chunks = list(chunks)
+    assert sampling_rate == 2000 and [chunk.shape[0] for chunk in chunks] == [4, 2]
+    expected, _ = power_calculation._decode_abf(abf_file, ['PFC', 'Aux1'], t_min=0.2, t_max=1.9)
+    np.testing.assert_array_equal(np.concatenate(chunks), expected)
+
+
+@pytest.mark.parametrize('method, filter_data', [('multitaper', False), ('welch', False), ('multitaper', True)])
+def test_streamed_spectra_match_spectra_of_whole_recording(abf_file, method, filter_data):
+    expected = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], method=method, filter_data=filter_data,
+                                             use_cache=False)
+    for chunk_size in (1, 4):
+        spectra = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], method=method, filter_data=filter_data,
+                                                use_cache=False, chunk_size=chunk_size)
+        for name in power_calculation.WINDOWS:
+            pd.testing.assert_frame_equal(spectra[name], expected[name], rtol=1e-12)
+
+
+@pytest.mark.parametrize('reader, stored_dtype', [('memmap', np.int16), ('pyabf', np.float32)])
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+def test_cached_recording_is_raw_and_converted_after_slicing(abf_file, monkeypatch, reader, stored_dtype, precision):
+    if reader == 'pyabf':
+        monkeypatch.setattr(power_calculation, 'open_abf', lambda filename: None)
+    data, _ = power_calculation._load_array(abf_file, precision=precision)
+    expected, _ = power_calculation._decode_abf(abf_file, precision=precision)
+    assert data.dtype == np.dtype(precision)
+    np.testing.assert_array_equal(data, expected)
+    window, _ = power_calculation._load_array(abf_file, channels=['PFC'], t_min=0.2, t_max=0.9, precision=precision)
+    np.testing.assert_array_equal(window, expected[:, [2], 400:1801])
+
+    recording_cache = power_calculation.recording_cache
+    (_, _, digest), = recording_cache._stored()
+    stored = np.load(recording_cache._paths(digest)[0], mmap_mode='r')
+    assert stored.dtype == stored_dtype and stored.shape == expected.shape
+    assert recording_cache.info()['memory_bytes'] == stored.nbytes
+
+
+def test_float32_results_are_close_to_float64(abf_file):
+    deviation = power_calculation.precision_deviation(abf_file, ['Aux1', 'PFC'])
+    assert max(deviation.values()) < 1e-4
+
+
+@pytest.mark.parametrize('calc, freq_40', [('ratio', False), ('baseline', True)])
+def test_table_of_frequency_bands_matches_concatenated_files(tmp_path, calc, freq_40):
+    files = [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(2)]
+    table = power_calculation.table_of_frequency_bands(files, ['Aux1', 'PFC'], ['M1', 'M2'], 'Daytime', calc,
+                                                       freq_40)
+    expected = pd.concat([power_calculation.psd_frequency_bands(filename, ['Aux1', 'PFC'], mouse_name, 'Daytime',
+                                                                calc, frequency_40=freq_40)
+                          for filename, mouse_name in zip(files, ['M1', 'M2'])], ignore_index=True)
+    pd.testing.assert_frame_equal(table.astype({column: str for column in table.columns[:5]}),
+                                  expected.astype({column: str for column in expected.columns[:5]}))
+    with pytest.raises(ValueError, match='mice names'):
+        power_calculation.table_of_frequency_bands(files, ['Aux1'], ['M1'], 'Daytime', calc, freq_40)
+
+
+@pytest.mark.parametrize('module', ['power_calculation', 'batch_runner'])
+def test_heavy_modules_are_imported_on_first_use(module):
+    # A new interpreter imports the module the same way as a spawned worker process (see benchmark.import_times())
+    code = (f"import json, sys; import {module}; "
+            f"print(json.dumps([name for name in ['pandas', 'mne', 'scipy', 'pyabf'] if name in sys.modules]))")
+    folder = os.path.dirname(os.path.abspath(power_calculation.__file__))
+    output = subprocess.run([sys.executable, '-c', code], cwd=folder, capture_output=True, text=True, check=True).stdout
+    assert json.loads(output) == []
+
+
+@pytest.mark.parametrize('f_max', [100, 101])
+def test_decimated_welch_spectra_keep_frequencies(abf_file, f_max):
+    full, decimated = [power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], f_max=f_max, method='welch',
+                                                     decimate=decimate) for decimate in (False, True)]
+    for name in power_calculation.WINDOWS:
+        np.testing.assert_array_equal(decimated[name].index, full[name].index)
+        # Window lengths are rounded to decimated samples, so power of single frequencies differs by a few percent
+        np.testing.assert_allclose(decimated[name], full[name], rtol=5e-2)
+
+
+def test_decimation_deviation(abf_file):
+    deviation = power_calculation.decimation_deviation(abf_file, ['Aux1', 'PFC'], f_max=101)
+    assert (deviation['psd_factor'], deviation['welch_factor'], deviation['tfr_factor']) == (7, 5, 8)
+    assert max(deviation[key] for key in ('psd_welch', 'bands_multitaper')) < 5e-2
+    assert max(deviation[key] for key in ('bands_welch', 'tfr_power', 'itc')) < 1e-2
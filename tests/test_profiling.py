@@ -0,0 +1,75 @@
+import json
+import time
+import numpy as np
+import pytest
+import power_calculation
+import profiling
+from profiling import StageProfiler
+
+
+def test_disabled_profiler_records_nothing():
+    recorder = StageProfiler()
+    with recorder.stage('spectra', file='a.abf'):
+        pass
+    assert recorder.records == [] and recorder.to_frame().empty and recorder.summary().empty
+
+
+def test_nested_stages_and_errors():
+    recorder = StageProfiler(enabled=True)
+    with recorder.stage('spectra', file='a.abf'):
+        with recorder.stage('filter', method='fir'):
+            time.sleep(0.02)
+        with pytest.raises(KeyError):
+            with recorder.stage('psd_frame'):
+                raise KeyError('freq')
+    table = recorder.to_frame().set_index('stage')
+    assert table.loc['filter', 'parent'] == table.loc['psd_frame', 'parent'] == 'spectra'
+    assert table.loc['psd_frame', 'error'] == 'KeyError' and table.loc['filter', 'tag_method'] == 'fir'
+    outer = table.loc['spectra']
+    assert outer['tag_file'] == 'a.abf' and outer['wall'] >= table.loc['filter', 'wall'] >= 0.02
+    np.testing.assert_allclose(outer['self_wall'], outer['wall'] - table.loc[['filter', 'psd_frame'], 'wall'].sum())
+    assert outer['allocated'] is None  # Allocations are traced only with memory=True
+
+
+def test_memory_tracing_measures_the_stage_peak():
+    recorder = StageProfiler(enabled=True, memory=True)
+    try:
+        with recorder.stage('spectra'):
+            with recorder.stage('morlet'):
+                data = np.ones(10 ** 6)  # 8 MB which are freed when the stage ends
+                del data
+            kept = np.ones(10 ** 5)
+    finally:
+        recorder.disable()
+    table = recorder.to_frame().set_index('stage')
+    assert table.loc['morlet', 'peak_allocated'] >= 8 * 10 ** 6 > table.loc['morlet', 'allocated']
+    assert table.loc['spectra', 'peak_allocated'] >= table.loc['morlet', 'peak_allocated']
+    assert table.loc['spectra', 'allocated'] >= kept.nbytes
+    if profiling.resource is not None:  # RSS high-water mark of the process never decreases
+        assert table.loc['spectra', 'process_peak_rss'] >= table.loc['morlet', 'process_peak_rss'] > 0
+
+
+def test_summary_and_trace(tmp_path):
+    recorder = StageProfiler(enabled=True)
+    for _ in range(2):
+        with recorder.stage('spectra', file='a.abf'):
+            with recorder.stage('filter'):
+                pass
+    summary = recorder.summary()
+    assert summary.loc['spectra', 'calls'] == 2 and 'process_peak_rss' in summary.columns
+    np.testing.assert_allclose(summary['self_share'].sum(), 1)
+    filename = str(tmp_path / 'trace.json')
+    recorder.export_trace(filename)
+    with open(filename) as f:
+        events = json.load(f)['traceEvents']
+    assert [event['name'] for event in events] == ['filter', 'spectra'] * 2
+    assert events[1]['args']['file'] == 'a.abf' and 'process_peak_rss' in events[1]['args']
+
+
+def test_profiling_records_analysis_stages(abf_file):
+    enabled = profiling.profiler.enabled
+    with profiling.profiling() as recorded:
+        power_calculation.psd(abf_file, ['Aux1'], use_cache=False)
+    assert profiling.profiler.enabled == enabled
+    stages = set(recorded.to_frame()['stage'])
+    assert {'decode_abf', 'spectra', 'psd_frame'} <= stages
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+import power_calculation
+from ratio import condition_ratio, study_ratio
+from study_manifest import flatten_study
+from synthetic_abf import write_synthetic_abf
+
+
+def _bands(mice, power):
+    return pd.DataFrame({'mouse': np.repeat(mice, 2), 'band_name': ['delta', 'theta'] * len(mice),
+                         'Power': power})
+
+
+def test_rows_are_paired_by_keys():
+    numerator = _bands(['M1', 'M2'], [2.0, 4.0, 6.0, 8.0])
+    denominator = _bands(['M2', 'M1'], [3.0, 4.0, 1.0, 2.0]).iloc[::-1]  # Other mouse order and reversed rows
+    result = condition_ratio(numerator, denominator, ['Power'])
+    np.testing.assert_allclose(result['Power'], [2.0, 2.0, 2.0, 2.0])
+    assert result.index.equals(numerator.index) and numerator['Power'].tolist() == [2.0, 4.0, 6.0, 8.0]
+
+
+def test_frequencies_of_the_index_are_keys():
+    freqs = pd.Index([1.0, 2.0, 1.0, 2.0], name='freq')
+    numerator = pd.DataFrame({'Aux1': [1.0, 2.0, 3.0, 4.0], 'mouse': ['M1', 'M1', 'M2', 'M2']}, index=freqs)
+    denominator = pd.DataFrame({'Aux1': [4.0, 3.0, 2.0, 1.0], 'mouse': ['M2', 'M2', 'M1', 'M1']},
+                               index=pd.Index([2.0, 1.0, 2.0, 1.0], name='freq'))
+    result = condition_ratio(numerator, denominator, ['Aux1'])
+    np.testing.assert_allclose(result['Aux1'], [1.0, 2.0 / 2.0, 3.0 / 3.0, 4.0 / 4.0])
+
+
+def test_rows_without_pair():
+    numerator = _bands(['M1', 'M2'], [2.0, 4.0, 6.0, 8.0])
+    denominator = _bands(['M1'], [1.0, 2.0])
+    assert condition_ratio(numerator, denominator, ['Power'])['Power'].isna().tolist() == [False, False, True, True]
+    assert condition_ratio(numerator, denominator, ['Power'], missing='drop')['mouse'].tolist() == ['M1', 'M1']
+    with pytest.raises(ValueError, match='2 numerator rows'):
+        condition_ratio(numerator, denominator, ['Power'], missing='raise')
+    with pytest.raises(ValueError, match='more than one row'):
+        condition_ratio(numerator, pd.concat([denominator, denominator]), ['Power'])
+    with pytest.raises(ValueError):
+        condition_ratio(numerator, denominator, ['Power'], missing='zero')
+
+
+@pytest.mark.parametrize('all_freq', [False, True])
+def test_study_ratio_of_drugs(tmp_path, all_freq):
+    mice_data = {'week_0': {drug: {'after': [f'{drug}_{i}.abf' for i in range(2)]} for drug in ('Ketamine', 'Saline')}}
+    for seed, name in enumerate(['Ketamine_0.abf', 'Ketamine_1.abf', 'Saline_0.abf', 'Saline_1.abf']):
+        write_synthetic_abf(str(tmp_path / name), n_sweeps=2, seed=seed)
+    manifest = flatten_study(mice_data, ['M1', 'M2'], str(tmp_path))
+    result = study_ratio(manifest, {'drug': 'Ketamine'}, {'drug': 'Saline'}, ['Aux1'], all_freq=all_freq,
+                         missing='raise')
+    value = 'Aux1' if all_freq else 'Power'
+    for i, mouse in enumerate(['M1', 'M2']):
+        ketamine, saline = [power_calculation.psd_frequency_bands(str(tmp_path / f'{drug}_{i}.abf'), ['Aux1'], mouse,
+                                                                  all_freq=all_freq)
+                            for drug in ('Ketamine', 'Saline')]
+        rows = result[result['mouse'] == mouse]
+        assert (rows['drug'] == 'Ketamine').all() and (rows['experiment_phase'] == 'Ketamine').all()
+        np.testing.assert_allclose(rows[value], ketamine[value].to_numpy() / saline[value].to_numpy(), rtol=1e-12)
@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+import power_calculation
+from result_cache import ResultCache, result_key
+from synthetic_abf import write_synthetic_abf
+
+
+class CountingCompute:
+    # compute function of ResultCache.get() which counts how many times the result is calculated
+
+    def __init__(self, value=1.0):
+        self.calls = 0
+        self.value = value
+
+    def __call__(self):
+        self.calls += 1
+        return {'power': np.full((2, 3), self.value), 'freqs': np.arange(3.0)}
+
+
+def test_result_key_changes_with_file_and_params(abf_file, tmp_path):
+    key, digest = result_key(abf_file, {'method': 'welch'})
+    assert result_key(abf_file, {'method': 'welch'}) == (key, digest)
+    assert result_key(abf_file, {'method': 'multitaper'})[1] != digest
+    filename = write_synthetic_abf(str(tmp_path / 'a.abf'), n_sweeps=2)
+    digest = result_key(filename, {})[1]
+    write_synthetic_abf(filename, n_sweeps=3)
+    assert result_key(filename, {})[1] != digest
+
+
+def test_results_are_stored_and_shared(abf_file, tmp_path):
+    compute = CountingCompute()
+    cache = ResultCache(str(tmp_path / 'store'))
+    arrays = cache.get(abf_file, {'a': 1}, compute)
+    other = ResultCache(str(tmp_path / 'store'))  # Another process reads the stored result
+    stored = other.get(abf_file, {'a': 1}, compute)
+    assert compute.calls == 1
+    assert stored.keys() == arrays.keys()
+    for name in arrays:
+        np.testing.assert_array_equal(stored[name], arrays[name])
+    cache.get(abf_file, {'a': 2}, compute)
+    assert compute.calls == 2
+    assert (cache.info()['misses'], other.info()['hits'], other.info()['entries']) == (2, 1, 2)
+    assert ResultCache(str(tmp_path / 'off'), enabled=False).get(abf_file, {}, compute) is not None
+    assert compute.calls == 3 and not os.path.exists(tmp_path / 'off')
+
+
+def test_least_recently_used_results_are_evicted(abf_file, tmp_path):
+    cache = ResultCache(str(tmp_path / 'store'))
+    cache.get(abf_file, {'a': 0}, CountingCompute())
+    size = cache.info()['disk_bytes']
+    cache.max_bytes = 2 * size
+    for age, a in zip((200, 100), (0, 1)):
+        cache.get(abf_file, {'a': a}, CountingCompute())
+        path = cache._path(result_key(abf_file, {'a': a})[1])
+        os.utime(path, ns=(os.stat(path).st_mtime_ns - age * 10 ** 9,) * 2)  # Used age seconds ago
+    cache.get(abf_file, {'a': 0}, CountingCompute())  # Hit marks the oldest result as used
+    cache.get(abf_file, {'a': 2}, CountingCompute())
+    info = cache.info()
+    assert (info['entries'], info['evictions']) == (2, 1)
+    assert not os.path.exists(cache._path(result_key(abf_file, {'a': 1})[1]))
+
+
+def test_psd_windows_uses_result_cache(abf_file):
+    spectra = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'])
+    again = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'])
+    power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], method='welch')
+    info = power_calculation.result_cache.info()
+    assert (info['misses'], info['hits'], info['entries']) == (2, 1, 2)
+    expected = power_calculation.psd_windows(abf_file, ['Aux1', 'PFC'], use_cache=False)
+    for name in power_calculation.WINDOWS:
+        pd.testing.assert_frame_equal(again[name], spectra[name])
+        pd.testing.assert_frame_equal(spectra[name], expected[name])
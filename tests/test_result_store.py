@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+from result_store import ResultStore
+
+PARTITION = {'week': 'week_0', 'drug': 'Ketamine', 'phase': 'after_5_min'}
+
+
+def _spectra(scale=1.0):
+    freqs = pd.Index([1.0, 2.0, 3.0, 1.0, 2.0, 3.0], name='freq')
+    return pd.DataFrame({'Aux1': np.arange(6) * scale, 'mouse': ['M1'] * 3 + ['M2'] * 3}, index=freqs)
+
+
+def _bands():
+    return pd.DataFrame({'mouse': ['M1', 'M1', 'M2', 'M2'], 'band_name': ['delta', 'theta'] * 2,
+                         'brain_area': ['Aux1', 'PFC', 'Aux1', 'PFC'], 'Power': [1.0, 2.0, 3.0, 4.0]})
+
+
+def test_round_trip_restores_index_and_labels(tmp_path):
+    store = ResultStore(str(tmp_path))
+    table = _spectra()
+    store.write(table, 'spectra', part='baseline', channel='Aux1', **PARTITION)
+    result = store.read('spectra', **PARTITION)
+    assert result.index.name == 'freq' and isinstance(result['mouse'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(result[['Aux1']], table[['Aux1']])
+    assert result['mouse'].astype(str).tolist() == table['mouse'].tolist()
+    assert result['channel'].astype(str).tolist() == ['Aux1'] * 6
+    store.write(_spectra(2.0), 'spectra', part='baseline', channel='Aux1', **PARTITION)  # Replaces the part
+    np.testing.assert_array_equal(store.read('spectra')['Aux1'], np.arange(6) * 2.0)
+
+
+def test_table_is_split_by_partition_columns(tmp_path):
+    store = ResultStore(str(tmp_path))
+    files = store.write(_bands(), 'bands', part='ratio', **PARTITION)
+    assert len(files) == 2
+    assert [values['channel'] for _, values in store.partitions('bands')] == ['Aux1', 'PFC']
+    pfc = store.read('bands', channel='PFC')
+    assert pfc['Power'].tolist() == [2.0, 4.0]
+    assert pfc['brain_area'].astype(str).tolist() == pfc['channel'].astype(str).tolist() == ['PFC', 'PFC']
+    with pytest.raises(ValueError, match='week'):
+        store.write(_bands(), 'bands', drug='Ketamine', phase='after_5_min')
+
+
+def test_filters_and_columns_select_rows(tmp_path):
+    store = ResultStore(str(tmp_path))
+    for drug in ('Ketamine', 'Saline'):
+        store.write(_spectra(), 'spectra', part='baseline', **{**PARTITION, 'drug': drug, 'channel': 'Aux1'})
+    result = store.read('spectra', columns=['Aux1'], filters=[('freq', '<=', 2), ('drug', '!=', 'Saline'),
+                                                             ('mouse', 'in', ['M2'])])
+    assert list(result.columns) == ['Aux1', 'week', 'drug', 'phase', 'channel']
+    assert result.index.tolist() == [1.0, 2.0] and result['Aux1'].tolist() == [3.0, 4.0]
+    assert result['drug'].astype(str).unique().tolist() == ['Ketamine']
+    assert len(store.read('spectra', drug=['Ketamine', 'Saline'])) == 12
+    assert store.read('spectra', filters=[('freq', '>', 10)]).empty
+    assert store.read('spectra', week='week_9').empty
+    with pytest.raises(ValueError, match='missing'):
+        store.read('spectra', filters=[('missing', '==', 1)])
+
+
+def test_has_part_checks_source(tmp_path):
+    store = ResultStore(str(tmp_path))
+    partition = {**PARTITION, 'channel': 'Aux1'}
+    assert not store.has_part('spectra', 'baseline', **partition)
+    store.write(_spectra(), 'spectra', part='baseline', source='inputs-1', **partition)
+    assert store.has_part('spectra', 'baseline', **partition)
+    assert store.has_part('spectra', 'baseline', source='inputs-1', **partition)
+    assert not store.has_part('spectra', 'baseline', source='inputs-2', **partition)
+    assert not store.has_part('spectra', 'signal', source='inputs-1', **partition)
+
+
+def test_partition_values_are_quoted(tmp_path):
+    store = ResultStore(str(tmp_path))
+    store.write(_spectra(), 'spectra', part='a/b', **{**PARTITION, 'channel': 'Aux 1/2'})
+    (_, values), = store.partitions('spectra')
+    assert values['channel'] == 'Aux 1/2'
+    assert len(store.read('spectra', channel='Aux 1/2')) == 6
+
+
+def test_export_csv(tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    store.write(_bands(), 'bands', part='ratio', **PARTITION)
+    filename = str(tmp_path / 'bands.csv')
+    store.export_csv('bands', filename, columns=['mouse', 'Power'], channel='Aux1')
+    exported = pd.read_csv(filename, index_col=0)
+    assert exported['Power'].tolist() == [1.0, 3.0] and exported['mouse'].tolist() == ['M1', 'M2']
@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+from mne.filter import filter_data
+from mne.time_frequency import psd_array_multitaper, psd_array_welch
+from scipy.signal import sosfiltfilt, sosfreqz
+import power_calculation
+import spectral
+from batch_runner import band_jobs, run_band_jobs
+from spectral import (MULTITAPER_BANDWIDTH, WELCH_N_FFT, band_filter, cache_info, decimation_factor, downsample,
+                      export_cache, fir_kernel, iir_sos, load_cache, multitaper_tapers, psd_array, psd_mean,
+                      total_cache_info, welch_window)
+from synthetic_abf import write_synthetic_abf
+
+WINDOW = slice(400, 1801)  # Baseline window (0.2-0.9 s) of 2000 Hz sweeps
+
+
+def test_tapers_are_built_once(empty_spectral_cache):
+    tapers, _ = multitaper_tapers(1401, 2000)
+    assert multitaper_tapers(1401, 2000.0)[0] is tapers  # The same key for int and float sampling rates
+    assert welch_window(1401) is welch_window(1401)
+    info = cache_info()
+    assert (info['hits'], info['misses'], info['entries']) == (2, 2, 2)
+    assert info['saved_seconds'] > 0
+
+
+def test_cache_info_since_and_totals(empty_spectral_cache):
+    before = cache_info()
+    multitaper_tapers(1401, 2000)
+    first = cache_info(since=before)
+    before = cache_info()
+    multitaper_tapers(1401, 2000)
+    second = cache_info(since=before)
+    assert (first['misses'], first['hits'], second['misses'], second['hits']) == (1, 0, 0, 1)
+    total = total_cache_info([first, None, second])
+    assert (total['misses'], total['hits'], total['saved_seconds']) == (1, 1, second['saved_seconds'])
+
+
+def test_loaded_tapers_save_their_build_time(empty_spectral_cache, monkeypatch):
+    tapers, _ = multitaper_tapers(1401, 2000)
+    exported = export_cache()
+    monkeypatch.setattr(spectral, '_cache', {})  # Cache of a new worker process
+    load_cache(exported)
+    before = cache_info()
+    assert multitaper_tapers(1401, 2000)[0] is tapers
+    info = cache_info(since=before)
+    assert (info['misses'], info['hits']) == (0, 1) and info['saved_seconds'] > 0
+
+
+@pytest.mark.parametrize('method, decimate', [('multitaper', False), ('welch', False), ('multitaper', True),
+                                              ('welch', True)])
+def test_build_tapers_prepares_every_window(abf_file, empty_spectral_cache, method, decimate):
+    power_calculation.build_tapers([abf_file, 'missing.abf'], method=method, decimate=decimate)
+    before = cache_info()
+    power_calculation.psd_windows(abf_file, ['Aux1'], method=method, decimate=decimate, use_cache=False)
+    assert cache_info(since=before)['misses'] == 0
+
+
+def test_workers_reuse_tapers_of_the_parent(tmp_path, empty_spectral_cache):
+    jobs = band_jobs([tmp_path / 'missing.abf'], ['M0'], 'phase', 'ratio', ['Aux1'])
+    files = [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(2)]
+    jobs += band_jobs(files, ['M1', 'M2'], 'phase', 'ratio', ['Aux1'])
+    results = run_band_jobs(jobs, n_workers=2)
+    assert results[0].error is not None and results[0].cache is not None
+    total = total_cache_info(result.cache for result in results)
+    assert total['misses'] == 0 and total['hits'] == 2  # Both windows have the same length, tapers of every file
+    assert total['saved_seconds'] > 0
+    assert results[1].error is None and np.isfinite(results[1].result['Ratio']).all()
+
+
+def test_multitaper_matches_mne(sweeps, sampling_rate):
+    data = sweeps[..., WINDOW]
+    psds, freqs = psd_array(data, sampling_rate, f_min=1, f_max=100, method='multitaper')
+    expected, expected_freqs = psd_array_multitaper(data, sampling_rate, fmin=1, fmax=100,
+                                                    bandwidth=MULTITAPER_BANDWIDTH, verbose='error')
+    np.testing.assert_allclose(freqs, expected_freqs)
+    np.testing.assert_allclose(psds, expected, rtol=1e-10)
+
+
+def test_welch_matches_mne(sweeps, sampling_rate):
+    data = sweeps[..., WINDOW]
+    psds, freqs = psd_array(data, sampling_rate, f_min=1, f_max=100, method='welch')
+    expected, expected_freqs = psd_array_welch(data, sampling_rate, fmin=1, fmax=100, n_fft=WELCH_N_FFT,
+                                               verbose='error')
+    np.testing.assert_allclose(freqs, expected_freqs)
+    np.testing.assert_allclose(psds, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('method', ['multitaper', 'welch'])
+def test_float32_is_close_to_float64(sweeps, sampling_rate, method):
+    data = sweeps[..., WINDOW]
+    psds, _ = psd_array(data.astype(np.float32), sampling_rate, f_max=100, method=method)
+    expected, _ = psd_array(data, sampling_rate, f_max=100, method=method)
+    assert psds.dtype == np.float32
+    np.testing.assert_allclose(psds, expected, rtol=1e-3)
+
+
+def test_psd_mean_of_windows(sweeps, sampling_rate):
+    windows = [slice(400, 1801), slice(2400, 3801)]
+    results = psd_mean(sweeps, sampling_rate, windows, f_max=100)
+    for (mean, freqs), window in zip(results, windows):
+        psds, expected_freqs = psd_array(sweeps[..., window], sampling_rate, f_max=100)
+        np.testing.assert_allclose(freqs, expected_freqs)
+        np.testing.assert_allclose(mean, psds.mean(axis=0) * 1e12, rtol=1e-12)  # psd_mean() returns uV^2
+
+
+def test_psd_mean_of_chunks(sweeps, sampling_rate):
+    windows = [slice(400, 1801), slice(2400, 3801)]
+    chunked = psd_mean(iter([sweeps[:1], sweeps[1:4], sweeps[4:]]), sampling_rate, windows, f_max=100)
+    for (mean, freqs), (expected, expected_freqs) in zip(chunked, psd_mean(sweeps, sampling_rate, windows, f_max=100)):
+        np.testing.assert_array_equal(freqs, expected_freqs)
+        np.testing.assert_allclose(mean, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('l_freq, h_freq', [(0.5, 100), (None, 40), (1, None)])
+def test_fir_filter_matches_mne(sweeps, sampling_rate, l_freq, h_freq):
+    filtered = band_filter(sweeps, sampling_rate, l_freq, h_freq)
+    expected = filter_data(sweeps, sampling_rate, l_freq, h_freq, pad='edge', verbose='error')
+    np.testing.assert_allclose(filtered, expected, rtol=1e-10, atol=1e-12 * np.abs(expected).max())
+    data = sweeps.copy()
+    assert band_filter(data, sampling_rate, l_freq, h_freq, out=data) is data  # Filtered in place
+    np.testing.assert_array_equal(data, filtered)
+
+
+def test_iir_filter_matches_scipy(sweeps, sampling_rate):
+    filtered = band_filter(sweeps.astype(np.float32), sampling_rate, 0.5, 100, method='iir')
+    n_samples = sweeps.shape[-1]
+    expected = sosfiltfilt(iir_sos(sampling_rate, 0.5, 100), sweeps, padtype='odd', padlen=n_samples - 1)
+    assert filtered.dtype == np.float32
+    np.testing.assert_allclose(filtered, expected, rtol=1e-4, atol=1e-5 * np.abs(expected).max())
+    with pytest.raises(ValueError, match='fft'):
+        band_filter(sweeps, sampling_rate, 0.5, 100, method='fft')
+
+
+def test_iir_sos_response(sampling_rate):
+    freqs, response = sosfreqz(iir_sos(sampling_rate, 0.5, 100), worN=[0.5, 40, 100, 300], fs=sampling_rate)
+    np.testing.assert_allclose(np.abs(response[:3]), [2 ** -0.5, 1, 2 ** -0.5], atol=1e-3)
+    assert np.abs(response[3]) < 0.01
+
+
+def test_filters_are_designed_once(sweeps, sampling_rate, empty_spectral_cache):
+    for method in ('fir', 'iir'):
+        band_filter(sweeps, sampling_rate, 0.5, 100, method=method)
+        band_filter(sweeps, sampling_rate, 0.5, 100, method=method)
+    assert fir_kernel(sampling_rate, 0.5, 100) is fir_kernel(sampling_rate, 0.5, 100)
+    # Kernel and its spectrum of FIR filter and sections of IIR filter
+    assert cache_info()['misses'] == 3
+
+
+def test_decimation_factor(sampling_rate):
+    assert decimation_factor(sampling_rate, 100) == 8
+    assert decimation_factor(sampling_rate, 101) == 7
+    assert decimation_factor(sampling_rate, 101, divides=WELCH_N_FFT) == 5  # Welch frequencies stay the same
+    assert decimation_factor(sampling_rate, 900) == decimation_factor(sampling_rate, np.inf) == 1
+
+
+def test_downsample_keeps_low_frequencies(sampling_rate):
+    factor = decimation_factor(sampling_rate, 100)
+    t = np.arange(6000) / sampling_rate
+    signal, alias = np.sin(2 * np.pi * 40 * t + 0.3), np.sin(2 * np.pi * 420 * t)
+    decimated = downsample((signal + alias)[np.newaxis], sampling_rate, factor)[0]
+    assert decimated.shape == signal[::factor].shape
+    # Edges are padded with edge values, so only samples away from them are compared
+    np.testing.assert_allclose(decimated[20:-20], signal[::factor][20:-20], atol=1e-3)
+    assert downsample(signal, sampling_rate, 1) is signal
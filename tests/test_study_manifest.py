@@ -0,0 +1,62 @@
+import os
+import pytest
+import study_manifest
+from study_manifest import flatten_study, load_manifest, query_manifest, study_manifest as build_manifest
+from synthetic_abf import SAMPLING_RATE, SWEEP_LENGTH, write_synthetic_abf
+
+MICE = ['M2', 'M1']
+
+
+@pytest.fixture
+def study(tmp_path):
+    mice_data = {'week_0': {'Saline': {'after': ['s0.abf', 's1.abf']}, 'Ketamine': {'after': ['k0.abf', 'k1.abf']}}}
+    for i, name in enumerate(['s0.abf', 's1.abf', 'k0.abf']):  # k1.abf is missing
+        write_synthetic_abf(str(tmp_path / name), n_sweeps=i + 1, seed=i)
+    return mice_data, str(tmp_path)
+
+
+def test_flatten_study_pairs_files_and_mice(study):
+    mice_data, data_dir = study
+    manifest = flatten_study(mice_data, MICE, data_dir)
+    assert manifest[['drug', 'mouse']].values.tolist() == [['Ketamine', 'M1'], ['Ketamine', 'M2'],
+                                                           ['Saline', 'M1'], ['Saline', 'M2']]
+    assert manifest['path'].tolist()[0] == os.path.join(data_dir, 'k1.abf')
+    with pytest.raises(ValueError, match='Saline/after'):
+        flatten_study(mice_data, ['M1'], data_dir)
+
+
+def test_header_metadata_of_every_file(study):
+    mice_data, data_dir = study
+    manifest = build_manifest(mice_data, MICE, data_dir).set_index('path')
+    row = manifest.loc[os.path.join(data_dir, 's1.abf')]
+    assert (row.sweep_count, row.sampling_rate, row.sweep_length) == (2, SAMPLING_RATE, SWEEP_LENGTH)
+    assert row.duration == 2 * SWEEP_LENGTH / SAMPLING_RATE
+    assert row.channel_names == ('IN 0', 'IN 1', 'IN 2')
+    assert row.mtime == os.stat(os.path.join(data_dir, 's1.abf')).st_mtime_ns
+    missing = manifest.loc[os.path.join(data_dir, 'k1.abf')]
+    assert missing.isna()[study_manifest.METADATA_COLUMNS].all()
+
+
+def test_stored_metadata_of_unchanged_files_is_reused(study, monkeypatch):
+    mice_data, data_dir = study
+    filename = os.path.join(data_dir, 'manifest.pkl')
+    first = build_manifest(mice_data, MICE, data_dir, filename=filename)
+    write_synthetic_abf(os.path.join(data_dir, 's0.abf'), n_sweeps=4)  # Recorded again
+    read = []
+    header_metadata = study_manifest.header_metadata
+    monkeypatch.setattr(study_manifest, 'header_metadata', lambda path: read.append(path) or header_metadata(path))
+    second = build_manifest(mice_data, MICE, data_dir, filename=filename)
+    assert sorted(read) == [os.path.join(data_dir, name) for name in ('k1.abf', 's0.abf')]
+    assert second.loc[second['path'].str.endswith('s0.abf'), 'sweep_count'].tolist() == [4]
+    assert second.drop(columns=['file_size', 'mtime', 'sweep_count', 'duration']).equals(
+        first.drop(columns=['file_size', 'mtime', 'sweep_count', 'duration']))
+    assert load_manifest(filename).equals(second)
+
+
+def test_query_manifest(study):
+    mice_data, data_dir = study
+    manifest = flatten_study(mice_data, MICE, data_dir)
+    assert len(query_manifest(manifest)) == 4
+    selected = query_manifest(manifest, drug='Saline', mouse=['M1', 'M3'])
+    assert selected.index.tolist() == [2] and selected['mouse'].tolist() == ['M1']
+    assert query_manifest(manifest, week='week_1').empty
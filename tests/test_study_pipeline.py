@@ -0,0 +1,94 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import power_calculation
+from result_store import ResultStore
+from spectral import total_cache_info
+from study_manifest import flatten_study
+from study_pipeline import (SPECTRA_RANGE, StudyTask, read_assr, read_bands, read_spectra, read_tfr, run_recordings,
+                            run_study, study_tasks)
+from batch_runner import run_group_tfr
+from synthetic_abf import write_synthetic_abf
+
+MICE = ['M1', 'M2']
+TFR_FREQS = np.array([38.0, 40.0, 42.0])
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    mice_data = {'week_0': {'Ketamine': {'after': ['k0.abf', 'k1.abf']}}}
+    for i, name in enumerate(['k0.abf', 'k1.abf']):
+        write_synthetic_abf(str(tmp_path / name), n_sweeps=2, seed=i)
+    return flatten_study(mice_data, MICE, str(tmp_path))
+
+
+def _statuses(results):
+    return [result.status for result in results]
+
+
+def test_stored_results_match_direct_calculation(manifest, tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    results = run_recordings(store, study_tasks(manifest), n_workers=1)
+    assert _statuses(results) == ['done', 'done']
+    path = manifest.set_index('mouse').loc['M2', 'path']
+
+    spectra = read_spectra(store, 'ratio', 'week_0', 'Ketamine', 'after', 'PFC', 'After KET')
+    expected = power_calculation.psd_windows(path, ['Aux1', 'PFC'], f_min=SPECTRA_RANGE[0], f_max=SPECTRA_RANGE[1])
+    m2 = spectra[spectra['mouse'] == 'M2']
+    np.testing.assert_allclose(m2.index, expected['signal'].index)
+    np.testing.assert_allclose(m2['PFC'], (expected['signal'] / expected['baseline'])['PFC'], rtol=1e-12)
+    assert set(spectra['experiment_phase']) == {'After KET'} and set(spectra['calc']) == {'ratio'}
+
+    bands = read_bands(store, 'baseline', 'week_0', 'Ketamine', 'after', experiment_phase='After KET')
+    bands = bands.sort_values(['mouse', 'brain_area'], kind='stable').reset_index(drop=True)
+    direct = pd.concat([power_calculation.psd_frequency_bands(row.path, ['Aux1', 'PFC'], row.mouse, 'After KET')
+                        for row in manifest.itertuples()])
+    direct = direct.sort_values(['mouse', 'brain_area'], kind='stable').reset_index(drop=True)
+    assert list(bands.columns) == list(direct.columns)
+    for column in ['mouse', 'band_name', 'brain_area']:
+        assert bands[column].astype(str).tolist() == direct[column].astype(str).tolist()
+    np.testing.assert_allclose(bands['Power'].to_numpy(float), direct['Power'].to_numpy(float), rtol=1e-12)
+
+    assr = read_assr(store, 'week_0', 'Ketamine', 'after', 'Aux1').set_index('mouse_name')
+    calculated = power_calculation.calc_assr(power_calculation.import_ecog(path, channels=['Aux1', 'PFC']))
+    np.testing.assert_allclose(assr.loc['M2'].to_numpy(float), calculated.loc['Aux1', assr.columns].to_numpy(float),
+                               rtol=1e-12)
+
+
+def test_stored_results_are_skipped_until_inputs_change(manifest, tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    tasks = study_tasks(manifest)
+    run_recordings(store, tasks, n_workers=1)
+    assert _statuses(run_recordings(store, tasks, n_workers=1)) == ['skipped', 'skipped']
+    assert _statuses(run_recordings(store, tasks, channels=['Aux1', 'PFC'], n_workers=1,
+                                    overwrite=True)) == ['done', 'done']
+    write_synthetic_abf(tasks[0].path, n_sweeps=3, seed=5)  # The first file is recorded again
+    os.utime(tasks[0].path, ns=(os.stat(tasks[1].path).st_mtime_ns + 10 ** 9,) * 2)
+    assert _statuses(run_recordings(store, tasks, n_workers=1)) == ['done', 'skipped']
+
+
+def test_workers_reuse_tapers_and_report_failures(manifest, tmp_path, empty_spectral_cache):
+    store = ResultStore(str(tmp_path / 'store'))
+    tasks = study_tasks(manifest) + [StudyTask('week_0', 'Ketamine', 'after', 'M3', str(tmp_path / 'missing.abf'))]
+    results = run_recordings(store, tasks, n_workers=2)
+    assert _statuses(results) == ['done', 'done', 'failed']
+    assert 'missing.abf' in results[2].error
+    cache = total_cache_info(result.cache for result in results)
+    assert cache['hits'] > 0 and cache['misses'] == 0  # Tapers were built before the pool started
+
+
+def test_run_study_stores_group_tfr(manifest, tmp_path):
+    store = ResultStore(str(tmp_path / 'store'))
+    results = run_study(manifest, store, channels=['Aux1'], tfr_freqs=TFR_FREQS, n_workers=1)
+    assert _statuses(results) == ['done', 'done', 'done']
+    freqs, times, power, itc, count = read_tfr(store, 'week_0', 'Ketamine', 'after', 'Aux1')
+    group = run_group_tfr(manifest['path'].tolist(), ['Aux1'], n_workers=1, freqs=TFR_FREQS)
+    np.testing.assert_allclose(freqs, TFR_FREQS)
+    assert count == 2 and power.shape == (len(TFR_FREQS), len(times))
+    np.testing.assert_allclose(power, group.mean('power').data[0], rtol=1e-12)
+    np.testing.assert_allclose(itc, group.mean('itc').data[0], rtol=1e-12)
+    assert _statuses(run_study(manifest, store, channels=['Aux1'], tfr_freqs=TFR_FREQS,
+                               n_workers=1)) == ['skipped'] * 3
+    with pytest.raises(ValueError, match='PFC'):
+        read_tfr(store, 'week_0', 'Ketamine', 'after', 'PFC')
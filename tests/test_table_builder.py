@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from table_builder import LongTableBuilder, remove_unused_categories
+
+
+def test_rows_of_frames_and_columns_in_order():
+    builder = LongTableBuilder(['mouse', 'brain_area'], ['Power'], capacity=2)
+    builder.append(pd.DataFrame({'mouse': ['M1', 'M1'], 'brain_area': ['Aux1', 'PFC'], 'Power': [1.0, 2.0],
+                                 'ignored': [0, 0]}))
+    builder.append(Power=[3.0, 4.0, 5.0], mouse='M2', brain_area=['PFC', 'Aux1', 'PFC'])  # Arrays grow
+    builder.append(pd.DataFrame({'brain_area': ['Aux1'], 'Power': [6.0]}), mouse='M1')
+    assert len(builder) == 6
+    table = builder.build()
+    expected = pd.DataFrame({'mouse': ['M1', 'M1', 'M2', 'M2', 'M2', 'M1'],
+                             'brain_area': ['Aux1', 'PFC', 'PFC', 'Aux1', 'PFC', 'Aux1'],
+                             'Power': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]})
+    pd.testing.assert_frame_equal(table.astype({'mouse': str, 'brain_area': str}), expected, check_dtype=False)
+    assert isinstance(table['mouse'].dtype, pd.CategoricalDtype)
+    assert table['brain_area'].cat.categories.tolist() == ['Aux1', 'PFC']  # In order of appearance
+
+
+def test_missing_column_is_rejected():
+    builder = LongTableBuilder(['mouse'], ['Power'])
+    with pytest.raises(ValueError, match='Power'):
+        builder.append(mouse='M1')
+    assert builder.build().empty
+
+
+def test_remove_unused_categories():
+    builder = LongTableBuilder(['mouse'], ['Power'])
+    builder.append(mouse=['M1', 'M2'], Power=np.arange(2.0))
+    table = builder.build()
+    filtered = remove_unused_categories(table[table['mouse'] == 'M2'])
+    assert filtered['mouse'].cat.categories.tolist() == ['M2']
+    np.testing.assert_array_equal(filtered['Power'], [1.0])
@@ -0,0 +1,138 @@
+import mne
+import numpy as np
+import pytest
+from mne.time_frequency import tfr_morlet
+import power_calculation
+from batch_runner import run_group_tfr
+from synthetic_abf import SAMPLING_RATE, write_synthetic_abf
+from tfr import GroupTFR, RunningMean, assr_power_plf, average_tfr, morlet_power_itc
+
+FREQS = np.arange(36.0, 45.0)
+N_CYCLES = FREQS / 2
+
+
+@pytest.fixture(scope='module')
+def mne_tfr(sweeps):
+    info = mne.create_info(['Aux1', 'PFC'], SAMPLING_RATE, 'eeg')
+    epochs = mne.EpochsArray(sweeps, info, verbose='error')
+    return tfr_morlet(epochs, FREQS, N_CYCLES, use_fft=True, return_itc=True, verbose='error')
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_morlet_power_itc_matches_mne(sweeps, sampling_rate, mne_tfr, n_jobs):
+    power, itc = morlet_power_itc(sweeps, sampling_rate, FREQS, N_CYCLES, n_jobs=n_jobs)
+    expected_power, expected_itc = mne_tfr
+    np.testing.assert_allclose(power, expected_power.data, rtol=1e-8)
+    np.testing.assert_allclose(itc, expected_itc.data, rtol=1e-8, atol=1e-12)
+
+
+def test_morlet_power_itc_float32_and_outputs(sweeps, sampling_rate, mne_tfr):
+    power, itc = morlet_power_itc(sweeps, sampling_rate, FREQS, N_CYCLES, dtype=np.float32, decim=4,
+                                  output='power')
+    assert itc is None and power.dtype == np.float32
+    np.testing.assert_allclose(power, mne_tfr[0].data[..., ::4], rtol=1e-3)
+    power, itc = morlet_power_itc(sweeps, sampling_rate, FREQS, N_CYCLES, output='itc')
+    assert power is None
+    np.testing.assert_allclose(itc, mne_tfr[1].data, rtol=1e-8, atol=1e-12)
+    with pytest.raises(ValueError):
+        morlet_power_itc(sweeps, sampling_rate, FREQS, N_CYCLES, output='phase')
+
+
+def test_flat_channel_has_zero_itc(sweeps, sampling_rate):
+    data = sweeps.copy()
+    data[:, 1] = 0
+    power, itc = morlet_power_itc(data, sampling_rate, FREQS, N_CYCLES)
+    assert np.isfinite(itc).all()
+    assert not power[1].any() and not itc[1].any()
+
+
+def test_calc_itpc_power_frequency_subset(abf_file):
+    epochs = power_calculation.import_ecog(abf_file, channels=['STI', 'Aux1'])
+    power, itc = power_calculation.calc_itpc_power(epochs)
+    assert power.ch_names == ['Aux1']  # Stimulus channel is not transformed
+    freqs = power_calculation.ITPC_FREQS[10:20]
+    subset = power_calculation.calc_itpc_power(epochs, freqs=freqs, decim=2, output='itc')
+    assert isinstance(subset, mne.time_frequency.AverageTFR)
+    np.testing.assert_allclose(subset.freqs, freqs)
+    np.testing.assert_allclose(subset.data, itc.data[:, 10:20, ::2], rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(subset.times, itc.times[::2])
+
+
+@pytest.mark.parametrize('windows', [[slice(400, 1801), slice(2400, 3801)], [slice(0, 30), slice(5000, 6000)]])
+def test_assr_power_plf_is_close_to_window_means(sweeps, sampling_rate, windows):
+    power, plf = assr_power_plf(sweeps, sampling_rate, FREQS, N_CYCLES, windows)
+    full_power, full_itc = morlet_power_itc(sweeps, sampling_rate, FREQS, N_CYCLES)
+    assert power.shape == plf.shape == (len(windows), sweeps.shape[1])
+    for i, window in enumerate(windows):
+        np.testing.assert_allclose(power[i], full_power[..., window].mean(axis=(1, 2)), rtol=2e-3)
+        np.testing.assert_allclose(plf[i], full_itc[..., window].mean(axis=(1, 2)), rtol=2e-3)
+
+
+def test_assr_of_flat_channel_is_zero(sweeps, sampling_rate):
+    data = sweeps.copy()
+    data[:, 1] = 0
+    power, plf = assr_power_plf(data, sampling_rate, FREQS, N_CYCLES, [slice(400, 1801)])
+    assert np.isfinite(plf).all()
+    assert power[0, 1] == plf[0, 1] == 0
+
+
+def test_calc_assr_table(abf_file):
+    epochs = power_calculation.import_ecog(abf_file)
+    table = power_calculation.calc_assr(epochs)
+    assert table.index.tolist() == ['Aux1', 'PFC']
+    assert table.columns.tolist() == ['baseline_mean', 'response_mean', 'ratio', 'plf']
+    np.testing.assert_allclose(table['ratio'], table['response_mean'] / table['baseline_mean'])
+    power, itc = power_calculation.calc_itpc_power(epochs, freqs=power_calculation.ASSR_FREQS)
+    signal = epochs.time_as_index(power_calculation.WINDOWS['signal'])
+    np.testing.assert_allclose(table['response_mean'], power.data[..., signal[0]:signal[1] + 1].mean(axis=(1, 2)),
+                               rtol=2e-3)
+    np.testing.assert_allclose(table['plf'], itc.data[..., signal[0]:signal[1] + 1].mean(axis=(1, 2)), rtol=2e-3)
+    window = power_calculation.import_ecog(abf_file, t_min=0.1, t_max=2.5)  # Windows keep their times
+    np.testing.assert_allclose(power_calculation.calc_assr(window), table, rtol=2e-3)
+    np.testing.assert_allclose(power_calculation.calc_assr(epochs, precision='float32'), table, rtol=1e-5)
+
+
+def test_running_mean_matches_numpy():
+    values = np.random.default_rng(0).normal(size=(7, 3, 4))
+    first, second = RunningMean(), RunningMean()
+    for array in values[:3]:
+        first.add(array)
+    for array in values[3:]:
+        second.add(array)
+    first.merge(second)
+    assert first.count == len(values)
+    np.testing.assert_allclose(first.mean, values.mean(axis=0))
+    np.testing.assert_allclose(first.variance(), values.var(axis=0, ddof=1))
+    np.testing.assert_allclose(first.variance(ddof=0), values.var(axis=0))
+    with pytest.raises(ValueError):
+        RunningMean().variance()
+
+
+def test_group_tfr_of_average_tfrs(mne_tfr):
+    power, itc = mne_tfr
+    group, other = GroupTFR(), GroupTFR()
+    group.add(power, itc)
+    other.add(average_tfr(power.info, power.data * 3, power.times, power.freqs, power.nave), itc)
+    group.merge(other)
+    assert group.count == 2
+    mean = group.mean()
+    assert isinstance(mean, mne.time_frequency.AverageTFR)
+    assert mean.nave == 2
+    np.testing.assert_allclose(mean.data, power.data * 2)
+    np.testing.assert_allclose(mean.times, power.times)
+    np.testing.assert_allclose(group.mean('itc').data, itc.data)
+    np.testing.assert_allclose(group.variance().data, 2 * power.data ** 2)
+    with pytest.raises(ValueError):
+        GroupTFR().mean()
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_run_group_tfr_matches_mean_of_recordings(tmp_path, n_workers):
+    files = [write_synthetic_abf(str(tmp_path / f'{i}.abf'), n_sweeps=2, seed=i) for i in range(3)]
+    results = [power_calculation.calc_itpc_power(power_calculation.import_ecog(filename, channels=['Aux1']),
+                                                 freqs=FREQS) for filename in files]
+    group = run_group_tfr(files, ['Aux1'], n_workers=n_workers, freqs=FREQS)
+    assert group.count == 3
+    for i, name in enumerate(('power', 'itc')):
+        np.testing.assert_allclose(group.mean(name).data, np.mean([result[i].data for result in results], axis=0),
+                                   rtol=1e-12)
@@ -0,0 +1,259 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+OUTPUTS = ('both', 'power', 'itc')  # Results which can be requested from morlet_power_itc()
+BAND_TOLERANCE = 1e-6  # Spectrum bins of the wavelet below this part of its maximum are left out of the band
+DEMODULATION_OVERSAMPLING = 4  # Demodulated signal of assr_power_plf() has this many samples per bin of the band
+
+
+def morlet_power_itc(data, sfreq: float, freqs, n_cycles, dtype=np.float64, decim=1, output='both', n_jobs=1):
+    """
+    Calculates average power and inter trial coherence (itc) with Morlet wavelets, the same as
+    mne.time_frequency.tfr_morlet(use_fft=True, return_itc=True) does, but every epoch of a channel is transformed
+    with one FFT, only requested results are calculated and calculation can be done in single precision.
+    :param data: array of shape (epochs, channels, times) in V
+    :param sfreq: Sampling rate in Hz
+    :param freqs: Frequencies of interest in Hz
+    :param n_cycles: Number of cycles in the wavelet, either a fixed number or one per frequency
+    :param dtype: np.float64 or np.float32, precision of FFTs and returned arrays. Averages over epochs are always
+    summed in double precision
+    :param decim: Only every decim-th time point of the result is kept (the same as decim of tfr_morlet(), applied
+    after the transform)
+    :param output: 'both', 'power' or 'itc'
+    :param n_jobs: Number of threads, every channel and frequency pair is a separate task. -1 uses every CPU core
+    :return: tuple (power, itc), arrays of shape (channels, freqs, times), result which was not requested is None
+    """
+    from scipy.fft import fft, ifft, next_fast_len
+    from mne.time_frequency import morlet  # scipy and mne are imported on first transform, not with this module
+    if output not in OUTPUTS:
+        raise ValueError(f"Wrong output '{output}', use one of {OUTPUTS}")
+    complex_dtype = np.result_type(dtype, np.complex64)
+    data = np.asarray(data, dtype=dtype)
+    n_epochs, n_channels, n_times = data.shape
+    wavelets = morlet(sfreq, freqs, n_cycles=n_cycles, zero_mean=True)
+    n_fft = next_fast_len(n_times + max(wavelet.size for wavelet in wavelets) - 1)
+    data_fft = fft(data, n_fft, axis=-1)
+    wavelets_fft = [fft(wavelet.astype(complex_dtype), n_fft) for wavelet in wavelets]
+
+    shape = (n_channels, len(wavelets), len(range(0, n_times, decim)))
+    power = np.empty(shape, dtype=dtype) if output in ('both', 'power') else None
+    itc = np.empty(shape, dtype=dtype) if output in ('both', 'itc') else None
+
+    def transform(task):
+        channel, i = task
+        start = (wavelets[i].size - 1) // 2  # Convolution is centered the same way as in mne ('same' mode)
+        tfr = ifft(data_fft[:, channel] * wavelets_fft[i], axis=-1)[:, start:start + n_times:decim]
+        amplitude = np.abs(tfr)
+        if power is not None:
+            power[channel, i] = (amplitude ** 2).sum(axis=0, dtype=np.float64) / n_epochs
+        if itc is not None:
+            amplitude[amplitude == 0] = 1  # Zero coefficients (for example, flat channel) have zero phase, as in mne
+            tfr /= amplitude  # Phase of every epoch
+            itc[channel, i] = np.abs(tfr.sum(axis=0, dtype=np.complex128)) / n_epochs
+
+    tasks = [(channel, i) for channel in range(n_channels) for i in range(len(wavelets))]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs is None or n_jobs <= 1:
+        for task in tasks:
+            transform(task)
+    else:
+        # FFTs and array operations release GIL, so threads run in parallel without copying data to processes
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(transform, tasks))
+    return power, itc
+
+
+def _divisor_length(n: int, minimum: int):
+    # The shortest length of at least minimum samples which divides n (n is a fast FFT length, so is the divisor)
+    return next(length for length in range(min(minimum, n), n + 1) if n % length == 0)
+
+
+def assr_power_plf(data, sfreq: float, freqs, n_cycles, windows: list, dtype=np.float64):
+    """
+    Calculates mean power and phase locking factor (plf, the same as itc) of Morlet wavelets of a few frequencies
+    (for example, 39-41 Hz around 40 Hz stimulation) in given time windows by complex demodulation. Every epoch is
+    transformed with one real FFT, then for every frequency only spectrum bins inside the wavelet band are shifted
+    to zero frequency and transformed back with a short inverse FFT (DEMODULATION_OVERSAMPLING samples per bin of
+    the band), so the result is the band-limited analytic signal multiplied by a carrier which is the same in every
+    epoch, sampled at every step-th time point. Power and plf of every window are means over these time points
+    weighted by the number of window samples nearest to each of them, so they are close to the means of
+    morlet_power_itc() over every window sample (relative deviation below about 1e-3), but unneeded frequencies and
+    time points are not calculated.
+    :param data: array of shape (epochs, channels, times) in V
+    :param sfreq: Sampling rate in Hz
+    :param freqs: Frequencies of interest in Hz
+    :param n_cycles: Number of cycles in the wavelet, either a fixed number or one per frequency
+    :param windows: List of slice objects of window samples, for example [slice(400, 1801), slice(2400, 3801)]
+    :param dtype: np.float64 or np.float32, precision of FFTs
+    :return: tuple (power, plf), arrays of shape (windows, channels) averaged over frequencies and window samples
+    """
+    from scipy.fft import fft, ifft, rfft, next_fast_len
+    from mne.time_frequency import morlet
+    data = np.asarray(data, dtype=dtype)
+    n_epochs, n_channels, n_times = data.shape
+    wavelets = morlet(sfreq, freqs, n_cycles=n_cycles, zero_mean=True)
+    n_fft = next_fast_len(n_times + max(wavelet.size for wavelet in wavelets) - 1)
+    spectrum = rfft(data, n_fft, axis=-1)  # Wavelets have no negative frequencies, so one-sided spectrum is enough
+    power = np.zeros((len(windows), n_channels))
+    plf = np.zeros((len(windows), n_channels))
+    for wavelet in wavelets:
+        wavelet_fft = fft(wavelet, n_fft)[:spectrum.shape[-1]]
+        band = np.flatnonzero(np.abs(wavelet_fft) > BAND_TOLERANCE * np.abs(wavelet_fft).max())
+        band = np.arange(band[0], band[-1] + 1)
+        # Inverse FFT of length which divides n_fft gives every step-th sample of the inverse FFT of n_fft samples
+        length = _divisor_length(n_fft, DEMODULATION_OVERSAMPLING * band.size)
+        step = n_fft // length
+        baseband = np.zeros((n_epochs, n_channels, length), dtype=spectrum.dtype)
+        baseband[..., :band.size] = spectrum[..., band] * wavelet_fft[band].astype(spectrum.dtype)
+        demodulated = ifft(baseband, axis=-1, overwrite_x=True)
+        demodulated *= length / n_fft  # The same scale as the inverse FFT of n_fft samples
+        start = (wavelet.size - 1) // 2  # Convolution is centered the same way as in mne ('same' mode)
+        for i, window in enumerate(windows):
+            # Every window sample is represented by the nearest time point of the grid (convolution is periodic)
+            nearest = (np.arange(window.start + start, window.stop + start) + step // 2) // step % length
+            points, counts = np.unique(nearest, return_counts=True)
+            weights = counts / counts.sum()
+            analytic = demodulated[..., points]
+            amplitude = np.abs(analytic)
+            power[i] += (amplitude ** 2).mean(axis=0, dtype=np.float64) @ weights
+            amplitude[amplitude == 0] = 1  # Zero coefficients (for example, flat channel) have zero phase, as in mne
+            plf[i] += np.abs((analytic / amplitude).sum(axis=0, dtype=np.complex128)) @ weights / n_epochs
+    return power / len(wavelets), plf / len(wavelets)
+
+
+def average_tfr(info, data, times, freqs, nave: int, method='morlet'):
+    """
+    Wraps array of average power or itc into mne AverageTFR object, the same object as tfr_morlet() returns.
+    mne 1.7 and later construct it from arrays with AverageTFRArray, older versions (such as mne 1.5.1 of
+    requirements.txt) with AverageTFR itself.
+    :param info: Info object of the channels
+    :param data: array of shape (channels, freqs, times)
+    :param times: Time points in seconds
+    :param freqs: Frequencies in Hz
+    :param nave: Number of averaged epochs (or recordings)
+    :param method: Name of the transform, 'morlet'
+    :return: AverageTFR object
+    """
+    from mne import time_frequency
+    if hasattr(time_frequency, 'AverageTFRArray'):
+        return time_frequency.AverageTFRArray(info=info, data=data, times=times, freqs=freqs, nave=nave,
+                                              method=method)
+    return time_frequency.AverageTFR(info, data, times, freqs, nave, method=method)
+
+
+class RunningMean:
+    """
+    Running mean and variance of arrays of the same shape (Welford's algorithm). Arrays are added one at a time, so
+    only the running mean and sum of squared deviations are kept in memory. Partial results (for example, calculated
+    in different processes) can be merged.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None  # Sum of squared deviations from the mean
+
+    def add(self, values):
+        """
+        :param values: array, every array added must have the same shape
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = values.copy()
+            self._m2 = np.zeros_like(self.mean)
+            return
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+
+    def merge(self, other):
+        """
+        Adds every array added to other RunningMean (Chan's parallel algorithm).
+        :param other: RunningMean object
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self._m2 = other.count, other.mean.copy(), other._m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self._m2 += other._m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+
+    def variance(self, ddof=1):
+        """
+        :param ddof: Delta degrees of freedom, 1 (default) gives sample variance, 0 population variance
+        :return: array of variance of every element
+        """
+        if self.count - ddof <= 0:
+            raise ValueError(f"Variance needs more than {ddof} added arrays, got {self.count}")
+        return self._m2 / (self.count - ddof)
+
+
+class GroupTFR:
+    """
+    Accumulates group average of power and inter trial coherence (itc) of many recordings, for example, results of
+    power_calculation.calc_itpc_power() of every mouse. Recordings are added one at a time, so only one recording's
+    TFR has to be in memory, and partial groups calculated in parallel can be merged. Averages are divided by the
+    number of added recordings.
+    """
+
+    def __init__(self):
+        self.results = {'power': RunningMean(), 'itc': RunningMean()}
+        self._template = None  # (info, times, freqs, method) of the first added AverageTFR
+
+    @property
+    def count(self):
+        """Number of added recordings"""
+        return max(result.count for result in self.results.values())
+
+    def add(self, power=None, itc=None):
+        """
+        Adds results of one recording.
+        :param power: AverageTFR object (or array) of power, None if only itc is accumulated
+        :param itc: AverageTFR object (or array) of itc, None if only power is accumulated
+        """
+        for name, tfr in (('power', power), ('itc', itc)):
+            if tfr is None:
+                continue
+            if self._template is None and hasattr(tfr, 'info'):
+                self._template = (tfr.info, tfr.times, tfr.freqs, tfr.method)
+            self.results[name].add(getattr(tfr, 'data', tfr))
+
+    def merge(self, other):
+        """
+        Adds every recording of other GroupTFR, for example, group calculated in another process.
+        :param other: GroupTFR object
+        """
+        for name, result in self.results.items():
+            result.merge(other.results[name])
+        if self._template is None:
+            self._template = other._template
+
+    def mean(self, name='power'):
+        """
+        :param name: 'power' or 'itc'
+        :return: AverageTFR of group mean (nave is number of recordings) or array if arrays were added
+        """
+        return self._wrap(self.results[name].mean, self.results[name].count)
+
+    def variance(self, name='power', ddof=1):
+        """
+        :param name: 'power' or 'itc'
+        :param ddof: Delta degrees of freedom, see RunningMean.variance()
+        :return: AverageTFR of variance between recordings or array if arrays were added
+        """
+        return self._wrap(self.results[name].variance(ddof), self.results[name].count)
+
+    def _wrap(self, data, count):
+        if data is None:
+            raise ValueError("No recordings were added")
+        if self._template is None:
+            return data
+        info, times, freqs, method = self._template
+        return average_tfr(info, data, times, freqs, count, method)